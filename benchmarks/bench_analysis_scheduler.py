@@ -0,0 +1,95 @@
+"""
+Fairness and rate limiting of photo analyses against a stub vision model.
+
+One heavy user sends --heavy-photos photos at once, then --users light users send one photo each
+over --spread seconds. Every analysis awaits a stub model call of --latency-ms (+- --jitter-ms).
+The run is done once with every request in one FIFO line (same concurrency and token buckets)
+and once with the AnalysisScheduler's per-user round-robin, and reports the light users' waiting times,
+when the heavy user finished, the most requests started within --window seconds and the
+queue-position updates sent.
+
+Usage:
+    python benchmarks/bench_analysis_scheduler.py --users 50 --heavy-photos 20 --concurrency 8 --rpm 300
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.scheduler import AnalysisScheduler
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def simulate(args, fair: bool) -> dict:
+    rng = random.Random(0)
+    scheduler = AnalysisScheduler(args.concurrency, rpm=args.rpm, tpm=args.tpm, burst=args.burst)
+    start = time.perf_counter()
+    starts, latencies = [], {}
+    position_updates = 0
+
+    async def model_call():
+        starts.append(time.perf_counter() - start)
+        await asyncio.sleep(max(args.latency_ms + rng.uniform(-args.jitter_ms, args.jitter_ms), 0) / 1000)
+
+    def on_position(position: int) -> None:
+        nonlocal position_updates
+        position_updates += 1
+
+    async def analyse(user_id: int, delay: float):
+        await asyncio.sleep(delay)
+        sent = time.perf_counter()
+        # Queued under one key, all requests are served in arrival order
+        async with scheduler.slot(user_id if fair else None, cost=args.tokens, on_position=on_position):
+            await model_call()
+        latencies.setdefault(user_id, []).append(time.perf_counter() - sent)
+
+    jobs = [analyse(0, 0) for _ in range(args.heavy_photos)]
+    jobs += [analyse(user_id, rng.uniform(0.01, args.spread)) for user_id in range(1, args.users + 1)]
+    await asyncio.gather(*jobs)
+
+    light = [latency for user_id, values in latencies.items() if user_id != 0 for latency in values]
+    busiest_window = max(sum(1 for s in starts if t <= s < t + args.window) for t in starts)
+    return {
+        "light_p50": percentile(light, 0.5),
+        "light_p99": percentile(light, 0.99),
+        "light_max": max(light),
+        "heavy_done": max(latencies[0]),
+        "elapsed": time.perf_counter() - start,
+        "busiest_window": busiest_window,
+        "position_updates": position_updates,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50, help="light users sending one photo each")
+    parser.add_argument("--heavy-photos", type=int, default=20, help="photos the heavy user sends at once")
+    parser.add_argument("--spread", type=float, default=0.5, help="seconds over which light users arrive")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=float, default=300, help="request bucket of the scheduler")
+    parser.add_argument("--tpm", type=float, default=600000, help="token bucket of the scheduler")
+    parser.add_argument("--burst", type=float, default=10, help="seconds of quota usable in one burst")
+    parser.add_argument("--tokens", type=int, default=2000, help="estimated tokens per analysis")
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--window", type=float, default=10, help="window for the busiest-window count")
+    args = parser.parse_args()
+
+    for name, fair in (("fifo", False), ("scheduler", True)):
+        r = asyncio.run(simulate(args, fair))
+        print(f"{name:>9}: light users wait p50 {r['light_p50']:.2f}s p99 {r['light_p99']:.2f}s "
+              f"max {r['light_max']:.2f}s | heavy user done after {r['heavy_done']:.2f}s | "
+              f"total {r['elapsed']:.2f}s | {r['busiest_window']} requests in the busiest {args.window:g}s | "
+              f"{r['position_updates']} position updates")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Nutrition chart rendering throughput and memory.
+
+Renders --count charts with varying macros, first on the calling thread and then through the
+worker pool used by the bot, and reports charts/sec and the process RSS afterwards.
+
+Usage:
+    python benchmarks/bench_chart.py --count 10000
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.chart import create_nutrition_chart, render_nutrition_chart
+
+
+def rss_mb() -> float:
+    # Current resident set size from /proc, falling back to the peak reported by getrusage
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def sample_meals(count: int) -> list:
+    rng = random.Random(0)
+    return [
+        {
+            "calories": rng.randint(50, 1500),
+            "carbohydrates": rng.randint(0, 150),
+            "protein": rng.randint(1, 80),
+            "fats": rng.randint(0, 70),
+        }
+        for _ in range(count)
+    ]
+
+
+async def render_pooled(meals: list) -> None:
+    await asyncio.gather(*(render_nutrition_chart(meal) for meal in meals))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10000)
+    args = parser.parse_args()
+
+    meals = sample_meals(args.count)
+    create_nutrition_chart(meals[0])  # build the cached layout before timing
+    print(f"RSS after warm-up: {rss_mb():.1f} MB")
+
+    start = time.perf_counter()
+    for meal in meals:
+        create_nutrition_chart(meal)
+    elapsed = time.perf_counter() - start
+    print(f"single thread: {args.count / elapsed:7.1f} charts/s, RSS {rss_mb():.1f} MB")
+
+    start = time.perf_counter()
+    asyncio.run(render_pooled(meals))
+    elapsed = time.perf_counter() - start
+    print(f"worker pool:   {args.count / elapsed:7.1f} charts/s, RSS {rss_mb():.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
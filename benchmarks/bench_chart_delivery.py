@@ -0,0 +1,69 @@
+"""
+Per-request cost of handing a rendered chart to reply_photo.
+
+Compares the former pipeline (base64 encode in the chart module, base64 decode in replyPhoto,
+PIL re-open and PNG re-encode into a BytesIO) with passing the PNG bytes straight through.
+Reports CPU time and peak Python allocation per chart.
+
+Usage:
+    python benchmarks/bench_chart_delivery.py --count 200
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from utils.chart import create_nutrition_chart
+
+
+def legacy_delivery(png: bytes) -> BytesIO:
+    chart_base64 = base64.b64encode(png).decode('utf-8')
+    chart_bytes = base64.b64decode(chart_base64)
+    chart_image = Image.open(BytesIO(chart_bytes))
+    image_binary = BytesIO()
+    chart_image.save(image_binary, format='PNG')
+    image_binary.seek(0)
+    return image_binary
+
+
+def direct_delivery(png: bytes) -> bytes:
+    return png
+
+
+def measure(deliver, png: bytes, count: int) -> tuple:
+    start = time.process_time()
+    for _ in range(count):
+        deliver(png)
+    cpu_ms = (time.process_time() - start) * 1000 / count
+
+    tracemalloc.start()
+    deliver(png)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_ms, peak / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200)
+    args = parser.parse_args()
+
+    png = create_nutrition_chart({"calories": 650, "carbohydrates": 70, "protein": 30, "fats": 20})
+    print(f"chart size: {len(png) / 1024:.1f} KiB")
+
+    legacy_cpu, legacy_peak = measure(legacy_delivery, png, args.count)
+    direct_cpu, direct_peak = measure(direct_delivery, png, args.count)
+    print(f"legacy: {legacy_cpu:7.3f} ms CPU, {legacy_peak:8.1f} KiB peak allocation per chart")
+    print(f"direct: {direct_cpu:7.3f} ms CPU, {direct_peak:8.1f} KiB peak allocation per chart")
+    print(f"saved:  {legacy_cpu - direct_cpu:7.3f} ms CPU, {legacy_peak - direct_peak:8.1f} KiB per chart")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Throughput of the update processor against stubbed Telegram and OpenAI latencies.
+
+Every simulated update awaits a fake GPT call and a fake Telegram send, the same shape as
+replyPhoto. The run is repeated with sequential processing and with ChatOrderedUpdateProcessor,
+and the per-chat order of handled updates is checked for both.
+
+Usage:
+    python benchmarks/bench_concurrent_updates.py --users 50 --photos 3 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+from utils.update_processor import ChatOrderedUpdateProcessor
+
+
+def make_updates(users: int, photos: int) -> list:
+    # Interleave the users the way a burst arrives from getUpdates
+    updates = []
+    now = datetime.now(timezone.utc)
+    for n in range(photos):
+        for chat_id in range(1, users + 1):
+            update_id = len(updates) + 1
+            message = Message(
+                message_id=update_id,
+                date=now,
+                chat=Chat(id=chat_id, type=Chat.PRIVATE),
+                from_user=User(id=chat_id, first_name=f"user{chat_id}", is_bot=False),
+                text=str(n),
+            )
+            updates.append(Update(update_id=update_id, message=message))
+    return updates
+
+
+async def stub_handler(update: Update, handled: dict, gpt_latency: float, telegram_latency: float):
+    await asyncio.sleep(telegram_latency)  # loading message
+    await asyncio.sleep(gpt_latency)       # GPT-4o vision call
+    await asyncio.sleep(telegram_latency)  # edit + chart upload
+    handled.setdefault(update.effective_chat.id, []).append(int(update.message.text))
+
+
+async def run(processor, updates: list, gpt_latency: float, telegram_latency: float) -> tuple:
+    handled = {}
+    await processor.initialize()
+    start = time.perf_counter()
+    if processor.max_concurrent_updates > 1:
+        # Mirrors Application._update_fetcher: one task per update when concurrency is enabled
+        tasks = [
+            asyncio.create_task(processor.process_update(u, stub_handler(u, handled, gpt_latency, telegram_latency)))
+            for u in updates
+        ]
+        await asyncio.gather(*tasks)
+    else:
+        for u in updates:
+            await processor.process_update(u, stub_handler(u, handled, gpt_latency, telegram_latency))
+    elapsed = time.perf_counter() - start
+    await processor.shutdown()
+
+    in_order = all(seq == sorted(seq) for seq in handled.values())
+    return elapsed, in_order
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--photos", type=int, default=3, help="photos sent by each user")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--gpt-latency", type=float, default=0.5)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    updates = make_updates(args.users, args.photos)
+    for name, processor in (
+        ("sequential", SimpleUpdateProcessor(1)),
+        ("chat-ordered", ChatOrderedUpdateProcessor(args.concurrency)),
+    ):
+        elapsed, in_order = await run(processor, updates, args.gpt_latency, args.telegram_latency)
+        print(f"{name:>13}: {len(updates)} updates in {elapsed:7.2f}s "
+              f"-> {len(updates) / elapsed:8.1f} updates/s, per-chat order kept: {in_order}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
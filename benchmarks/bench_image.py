@@ -0,0 +1,58 @@
+"""
+Vision image preprocessing: upload size, estimated GPT-4o image tokens and CPU time.
+
+Usage:
+    python benchmarks/bench_image.py user_photo.jpg [more images ...] --max-edge 512 --quality 75
+"""
+import argparse
+import base64
+import math
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from utils.image import VISION_JPEG_QUALITY, VISION_MAX_EDGE, preprocess_image
+
+
+def vision_tokens(width: int, height: int) -> int:
+    # GPT-4o "high" detail pricing: fit in 2048x2048, shortest side to 768, 170 tokens per 512px tile + 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", nargs="*", default=["user_photo.jpg"])
+    parser.add_argument("--max-edge", type=int, default=VISION_MAX_EDGE)
+    parser.add_argument("--quality", type=int, default=VISION_JPEG_QUALITY)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for path in args.images:
+        with open(path, "rb") as f:
+            original = f.read()
+
+        start = time.process_time()
+        for _ in range(args.repeat):
+            processed = preprocess_image(original, args.max_edge, args.quality)
+        cpu_ms = (time.process_time() - start) * 1000 / args.repeat
+
+        before = Image.open(BytesIO(original)).size
+        after = Image.open(BytesIO(processed)).size
+        print(f"{path}:")
+        print(f"  original  {before[0]}x{before[1]}, {len(base64.b64encode(original)) / 1024:7.1f} KiB as base64, "
+              f"~{vision_tokens(*before)} image tokens")
+        print(f"  processed {after[0]}x{after[1]}, {len(base64.b64encode(processed)) / 1024:7.1f} KiB as base64, "
+              f"~{vision_tokens(*after)} image tokens, {cpu_ms:.1f} ms CPU")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+"""
+Load test of the whole bot against local fakes of Telegram, OpenAI and the backend.
+
+Starts benchmarks/fake_services.py in its own process (see there for the latency and error
+profiles), points the Application from main.build_application at it (Bot API base_url,
+OPENAI_BASE_URL, API_BASE_URL) and puts updates straight into its update queue, as polling or the
+webhook would. Each of --users simulated users goes through /start -> "Press to continue" -> goal
+button -> photo -> save button -> a question, sending the next update once the bot has handled the
+previous one (plus --think-ms); users arrive evenly over --ramp seconds. --replay feeds a recorded
+trace instead (UPDATE_TRACE_PATH of a production bot, or --record of an earlier run) at its
+original pace times --speed.
+
+Reported: latency p50/p99 per step (update queued until all its handlers returned; work moved to
+background tasks, such as album analyses, is not included), handled updates/s, RSS and CPU time of
+the bot process (the image workers are separate processes), event-loop lag, the mean time per
+stage from the metrics registry and the requests the fakes answered. --json saves the report,
+--compare prints the change against a saved one, so a regression shows up before a deploy.
+
+Usage:
+    python benchmarks/bench_load.py --users 1000 --ramp 30
+    python benchmarks/bench_load.py --users 200 --openai 1500:500:0.05 --telegram 50:20:0.02 --record trace.jsonl
+    python benchmarks/bench_load.py --replay trace.jsonl --speed 2 --json after.json --compare before.json
+    python benchmarks/bench_load.py --users 500 --env TELEGRAM_GLOBAL_RATE=1000 --env ANALYSIS_CONCURRENCY=32
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from fake_services import add_profile_arguments
+
+TOKEN = "123456:load-test"
+FIRST_USER_ID = 10_000_000
+# Handler group after all of the bot's groups; it runs once an update went through all of them
+DONE_GROUP = 1000
+
+SCRIPT = ("start", "continue", "goal", "photo", "save", "question")
+GOALS = ("Moderate", "Fit", "Bodybuilder")
+QUESTIONS = ("How much protein should I eat per day?", "Is this meal good before a workout?",
+             "How can I eat less sugar?", "What is a healthy snack in the evening?")
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def message(update_id: int, user_id: int, **fields) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+        "from": user(user_id), **fields}}
+
+
+def make_update(step: str, update_id: int, user_id: int, rng: random.Random, photo_variants: int) -> dict:
+    if step == "start":
+        return message(update_id, user_id, text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+    if step == "continue":
+        return message(update_id, user_id, text="Press to continue")
+    if step == "photo":
+        file_id = f"photo-{rng.randrange(photo_variants)}"
+        return message(update_id, user_id, photo=[
+            {"file_id": f"thumb-{file_id}", "file_unique_id": f"thumb-{file_id}", "width": 320, "height": 320},
+            {"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 800},
+        ])
+    if step == "question":
+        return message(update_id, user_id, text=rng.choice(QUESTIONS))
+    data = f"goal_{rng.choice(GOALS)}" if step == "goal" else rng.choice(("save_yes", "save_yes", "save_no"))
+    # The button sits on a message the bot sent before
+    bot_message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": 1, "is_bot": True, "first_name": "Lipo-Out"}, "text": "..."}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user(user_id), "chat_instance": str(user_id), "data": data,
+        "message": bot_message}}
+
+
+def update_kind(update: dict) -> str:
+    # Step name of a recorded update that has none
+    if "callback_query" in update:
+        return "button:" + update["callback_query"].get("data", "").split("_")[0]
+    msg = update.get("message") or {}
+    if "photo" in msg:
+        return "album photo" if "media_group_id" in msg else "photo"
+    text = msg.get("text", "")
+    if text.startswith("/"):
+        return text.split()[0]
+    return "text" if text else "other"
+
+
+def load_trace(path: str, max_gap: float) -> list:
+    """(offset seconds, step, update) of a trace, idle gaps shortened to max_gap."""
+    with open(path, encoding="utf-8") as f:
+        entries = sorted((json.loads(line) for line in f if line.strip()), key=lambda entry: entry["ts"])
+    trace, offset, previous = [], 0.0, None
+    for entry in entries:
+        if previous is not None:
+            offset += min(entry["ts"] - previous, max_gap)
+        previous = entry["ts"]
+        trace.append((offset, entry.get("step") or update_kind(entry["update"]), entry["update"]))
+    return trace
+
+
+class Tracker:
+    """Puts updates into the application's queue and notes when each one has been handled."""
+
+    def __init__(self, application, record: bool = False):
+        self.application = application
+        self.record = record
+        self.recorded = []
+        self.latencies = {}
+        self.handled = 0
+        self.timeouts = 0
+        self._update_ids = 0
+        # update_id -> (future, step, perf_counter when queued)
+        self._pending = {}
+
+    def next_update_id(self) -> int:
+        self._update_ids += 1
+        return self._update_ids
+
+    async def send(self, update: dict, step: str) -> asyncio.Future:
+        if self.record:
+            self.recorded.append({"ts": round(time.time(), 3), "step": step, "update": update})
+        future = asyncio.get_running_loop().create_future()
+        self._pending[update["update_id"]] = (future, step, time.perf_counter())
+        await self.application.update_queue.put(Update.de_json(update, self.application.bot))
+        return future
+
+    async def done(self, update: Update, context) -> None:
+        entry = self._pending.pop(update.update_id, None)
+        if entry is None:
+            return
+        future, step, queued = entry
+        self.latencies.setdefault(step, []).append(time.perf_counter() - queued)
+        self.handled += 1
+        if not future.done():
+            future.set_result(None)
+
+
+async def simulate_user(index: int, tracker: Tracker, args, rng: random.Random) -> None:
+    await asyncio.sleep(index * args.ramp / args.users)
+    user_id = FIRST_USER_ID + index
+    for step in SCRIPT:
+        update = make_update(step, tracker.next_update_id(), user_id, rng, args.photo_variants)
+        try:
+            await asyncio.wait_for(await tracker.send(update, step), args.step_timeout)
+        except asyncio.TimeoutError:
+            # The user gives up; the rest of the script would not match the conversation state
+            tracker.timeouts += 1
+            return
+        if args.think_ms:
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * args.think_ms / 1000)
+
+
+async def replay(trace: list, tracker: Tracker, args) -> None:
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    futures = []
+    for offset, step, update in trace:
+        delay = start + offset / args.speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Traces may be concatenated, update ids are only unique within this run
+        update = dict(update, update_id=tracker.next_update_id())
+        futures.append(await tracker.send(update, step))
+    if futures:
+        _, pending = await asyncio.wait(futures, timeout=args.step_timeout)
+        tracker.timeouts += len(pending)
+
+
+async def monitor_loop_lag(samples: list, interval: float = 0.01) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def start_fakes(args) -> tuple:
+    command = [sys.executable, os.path.join(BENCH_DIR, "fake_services.py"),
+               "--telegram", args.telegram, "--openai", args.openai, "--openai-tps", str(args.openai_tps),
+               "--backend", args.backend, "--photo", args.photo, "--photo-variants", str(args.photo_variants)]
+    for setting in args.openai_model:
+        command += ["--openai-model", setting]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        raise SystemExit("fake services did not start")
+    return process, json.loads(line)
+
+
+def bot_environment(ports: dict, workdir: str, persistence: bool = False) -> dict:
+    # Settings pointing the bot at the fakes, with its files in workdir
+    return {
+        "BOT_TOKEN": TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{ports['telegram']}",
+        "OPENAI_API_KEY": "sk-load-test",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{ports['openai']}/v1",
+        "API_BASE_URL": f"http://127.0.0.1:{ports['backend']}",
+        "PERSISTENCE_PATH": os.path.join(workdir, "state.sqlite3") if persistence else "",
+        "SAVE_QUEUE_PATH": os.path.join(workdir, "save_queue.jsonl"),
+        "ROLLUP_PATH": os.path.join(workdir, "rollups.sqlite3"),
+        "PENDING_DIR": os.path.join(workdir, "pending_uploads"),
+        "PHOTO_CACHE_PATH": "",
+        "CHART_CACHE_PATH": "",
+        "UPDATE_TRACE_PATH": "",
+        "METRICS_PORT": "0",
+    }
+
+
+def configure_environment(args, ports: dict, workdir: str) -> None:
+    os.environ.update(bot_environment(ports, workdir, args.persistence))
+    for setting in args.env:
+        key, _, value = setting.partition("=")
+        os.environ[key] = value
+
+
+def stage_means(metrics) -> dict:
+    # Mean seconds per stage, OpenAI model and backend call, from the bot's metrics registry
+    histograms = metrics.snapshot()["histograms"]
+    names = {"bot_stage_seconds": "{stage}", "openai_first_token_seconds": "openai first token {model}",
+             "openai_request_seconds": "openai {model}", "backend_request_seconds": "backend {method} {path}"}
+    means = {}
+    for name, template in names.items():
+        for key, counts in histograms.get(name, {}).items():
+            if counts[-1]:
+                means[template.format(**dict(key))] = counts[-2] / counts[-1]
+    return means
+
+
+async def run(args, ports: dict) -> dict:
+    # Imported only now: the bot's modules read their settings from the environment on import
+    bot = importlib.import_module("main")
+    metrics = importlib.import_module("utils.metrics").metrics
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    base = f"http://127.0.0.1:{ports['telegram']}"
+    application = bot.build_application(TOKEN, base_url=f"{base}/bot", base_file_url=f"{base}/file/bot")
+    tracker = Tracker(application, record=bool(args.record))
+    application.add_handler(TypeHandler(Update, tracker.done), group=DONE_GROUP)
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    lag = []
+    lag_monitor = asyncio.create_task(monitor_loop_lag(lag))
+    rss_start, cpu_start, start = rss_mb(), time.process_time(), time.perf_counter()
+    if args.replay:
+        await replay(load_trace(args.replay, args.max_gap), tracker, args)
+    else:
+        rng = random.Random(args.seed)
+        await asyncio.gather(*(simulate_user(index, tracker, args, rng) for index in range(args.users)))
+    elapsed, cpu, rss_end = time.perf_counter() - start, time.process_time() - cpu_start, rss_mb()
+    lag_monitor.cancel()
+
+    await application.stop()
+    await application.post_shutdown(application)
+    await application.shutdown()
+
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in tracker.recorded)
+
+    return {
+        "updates": tracker.handled,
+        "elapsed": elapsed,
+        "updates_per_second": tracker.handled / elapsed,
+        "timeouts": tracker.timeouts,
+        "handler_errors": int(sum(metrics.snapshot()["counters"].get("bot_handler_errors_total", {}).values())),
+        "steps": {step: {"count": len(values), "p50": percentile(values, 0.5), "p99": percentile(values, 0.99),
+                         "max": max(values)} for step, values in tracker.latencies.items()},
+        "loop_lag": {"p50": percentile(lag, 0.5), "p99": percentile(lag, 0.99), "max": max(lag)} if lag else {},
+        "rss_mb": {"start": rss_start, "end": rss_end, "peak": peak_rss_mb()},
+        "cpu_seconds": cpu,
+        "stages": stage_means(metrics),
+    }
+
+
+def print_report(report: dict, previous: dict = None) -> None:
+    def change(value: float, old: float) -> str:
+        return f" ({(value - old) / old:+.0%})" if old else ""
+
+    def compare(path: tuple, value: float) -> str:
+        old = previous
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+        return change(value, old) if isinstance(old, (int, float)) else ""
+
+    print(f"{report['updates']} updates handled in {report['elapsed']:.1f}s -> "
+          f"{report['updates_per_second']:.1f} updates/s{compare(('updates_per_second',), report['updates_per_second'])}, "
+          f"{report['timeouts']} timeouts, {report['handler_errors']} handler errors")
+    print(f"{'step':>14} {'count':>7} {'p50':>16} {'p99':>16} {'max':>8}")
+    for step, s in report["steps"].items():
+        print(f"{step:>14} {s['count']:>7} {s['p50']:>7.3f}s{compare(('steps', step, 'p50'), s['p50']):<8} "
+              f"{s['p99']:>7.3f}s{compare(('steps', step, 'p99'), s['p99']):<8} {s['max']:>7.3f}s")
+    if report["loop_lag"]:
+        lag = report["loop_lag"]
+        print(f"event loop lag: p50 {lag['p50'] * 1000:.1f}ms, p99 {lag['p99'] * 1000:.1f}ms"
+              f"{compare(('loop_lag', 'p99'), lag['p99'])}, max {lag['max'] * 1000:.1f}ms")
+    rss = report["rss_mb"]
+    print(f"memory: RSS {rss['start']:.0f} MB at start, {rss['end']:.0f} MB at end, {rss['peak']:.0f} MB peak"
+          f"{compare(('rss_mb', 'peak'), rss['peak'])}; CPU {report['cpu_seconds']:.1f}s, "
+          f"{report['cpu_seconds'] / max(report['updates'], 1) * 1000:.2f}ms per update")
+    print("mean time per stage: " + ", ".join(f"{name} {seconds * 1000:.0f}ms"
+                                              for name, seconds in sorted(report["stages"].items())))
+    if report.get("fakes"):
+        print("fake services: " + ", ".join(f"{name} {count}" for name, count in sorted(report["fakes"].items())))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200, help="simulated users, each runs the whole conversation once")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which users arrive")
+    parser.add_argument("--think-ms", type=float, default=500, help="mean pause of a user between two updates")
+    parser.add_argument("--step-timeout", type=float, default=120, help="seconds before an unanswered update counts as lost")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="trace (JSON lines) to replay instead of the simulated users")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up")
+    parser.add_argument("--max-gap", type=float, default=5.0, help="longest idle gap of a replayed trace, in seconds")
+    parser.add_argument("--record", help="write the updates sent to this trace file")
+    parser.add_argument("--persistence", action="store_true", help="use the SQLite conversation persistence")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="bot setting, may be repeated")
+    parser.add_argument("--json", help="save the report to this file")
+    parser.add_argument("--compare", help="report saved by an earlier run with --json")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's log and print output")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    fakes, ports = start_fakes(args)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            configure_environment(args, ports, workdir)
+            with contextlib.ExitStack() as stack:
+                if not args.verbose:
+                    stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+                report = asyncio.run(run(args, ports))
+        report["fakes"] = httpx.get(f"http://127.0.0.1:{ports['telegram']}/_stats").json()
+    finally:
+        fakes.terminate()
+        fakes.wait()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
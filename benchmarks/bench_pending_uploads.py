@@ -0,0 +1,78 @@
+"""
+Memory held by idle sessions that never answered the save question.
+
+Each simulated session leaves one downloaded photo behind, the way replyPhoto does before the
+Yes/No answer. The former layout (bytes in user_data) is compared with the pending upload store
+(handles in user_data, every photo in a directory, the newest within the memory budget also in
+memory). Each layout runs in its own process so the RSS numbers do not mix; the store run then
+lets the photos expire and sweeps.
+
+Usage:
+    python benchmarks/bench_pending_uploads.py --sessions 3000 --photo-kb 300 --budget-mb 32
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(layout: str, sessions: int, photo_kb: int, budget_mb: int) -> None:
+    from utils.pending_uploads import PendingUploadStore
+
+    base = rss_mb()
+    workdir = tempfile.TemporaryDirectory()
+    store = PendingUploadStore(memory_budget=budget_mb * 2**20, ttl=2.0, path=workdir.name)
+    user_data = {}
+    start = time.perf_counter()
+    for user_id in range(sessions):
+        photo = bytearray(os.urandom(photo_kb * 1024))
+        if layout == "user_data":
+            user_data[user_id] = {"photo_bytes": photo}
+        else:
+            user_data[user_id] = {"photo_handle": store.put(photo)}
+    elapsed = time.perf_counter() - start
+    print(f"{layout:>9}: {sessions} idle sessions, RSS +{rss_mb() - base:.0f} MB, "
+          f"{elapsed / sessions * 1e6:.0f} us per photo kept")
+
+    if layout == "store":
+        print(f"           {store.stats()}")
+        time.sleep(store.ttl)
+        start = time.perf_counter()
+        swept = store.sweep()
+        print(f"           sweep after TTL: {swept} expired in {(time.perf_counter() - start) * 1000:.0f} ms, "
+              f"{store.stats()}")
+        store.clear()
+    workdir.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=3000)
+    parser.add_argument("--photo-kb", type=int, default=300)
+    parser.add_argument("--budget-mb", type=int, default=32)
+    parser.add_argument("--layout", choices=["user_data", "store"], help="run one layout in this process")
+    args = parser.parse_args()
+
+    if args.layout:
+        run(args.layout, args.sessions, args.photo_kb, args.budget_mb)
+        return
+    for layout in ("user_data", "store"):
+        subprocess.run([sys.executable, __file__, "--layout", layout, "--sessions", str(args.sessions),
+                        "--photo-kb", str(args.photo_kb), "--budget-mb", str(args.budget_mb)], check=True)
+
+
+if __name__ == "__main__":
+    main()
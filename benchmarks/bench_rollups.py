@@ -0,0 +1,117 @@
+"""
+Cost of /stats from the nutrition rollups, and of rebuilding them from the backend.
+
+Reads the summary (today, this and last week, the trend days) --reads times for users with
+--histories days of saved meals, to show the read does not grow with the history. Then seeds
+the fake backend (fake_services.py, --backend latency) with --rebuild-meals food rows and
+rebuilds one user's totals from it page by page, which is roughly what every /stats would cost
+if it added up the backend's rows itself.
+
+Usage:
+    python benchmarks/bench_rollups.py --histories 30,365,3650 --rebuild-meals 3000
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+TELEGRAM_ID = 30_000_000
+MEALS_PER_DAY = 3
+
+
+def history_buckets(days: int, now: float) -> dict:
+    buckets = {}
+    for day in range(days):
+        for meal in range(MEALS_PER_DAY):
+            rollups_module._add_totals(buckets, now - day * 86400 - meal * 3600, (1, 600, 70, 30, 20))
+    return buckets
+
+
+async def bench_reads(histories: list, reads: int) -> None:
+    now = time.time()
+    with tempfile.TemporaryDirectory() as workdir:
+        for days in histories:
+            rollups = rollups_module.NutritionRollups(os.path.join(workdir, f"rollups_{days}.sqlite3"))
+            rollups._replace(TELEGRAM_ID, history_buckets(days, now))
+            await rollups.summary(TELEGRAM_ID, now)
+            timings = []
+            for _ in range(reads):
+                start = time.perf_counter()
+                await rollups.summary(TELEGRAM_ID, now)
+                timings.append(time.perf_counter() - start)
+            await rollups.close()
+            print(f"history {days:5d} days ({days * MEALS_PER_DAY:6d} meals): summary median "
+                  f"{statistics.median(timings) * 1000:.3f} ms, p99 {sorted(timings)[int(len(timings) * 0.99)] * 1000:.3f} ms")
+
+
+async def seed_backend(url: str, meals: int) -> None:
+    async with httpx.AsyncClient(base_url=url) as client:
+        user = (await client.post("/users/", json={"name": "bench", "telegram_id": TELEGRAM_ID})).json()
+        start = datetime.now(timezone.utc)
+        for batch in range(0, meals, 100):
+            await asyncio.gather(*(
+                client.post("/foods/", json={
+                    "user_id": user["id"], "calories": 600, "carb": 70, "protein": 30, "fat": 20,
+                    "created_at": (start - timedelta(hours=8 * index)).isoformat(),
+                })
+                for index in range(batch, min(batch + 100, meals))
+            ))
+
+
+async def bench_rebuild(url: str, meals: int) -> None:
+    await seed_backend(url, meals)
+    with tempfile.TemporaryDirectory() as workdir:
+        rollups = rollups_module.NutritionRollups(os.path.join(workdir, "rollups.sqlite3"))
+        start = time.perf_counter()
+        counted = await rollups.rebuild(TELEGRAM_ID)
+        seconds = time.perf_counter() - start
+        summary = await rollups.summary(TELEGRAM_ID)
+        await rollups.close()
+    pages = -(-meals // rollups.page_size)
+    print(f"rebuild: {counted} meals in {pages} pages in {seconds:.2f}s "
+          f"({counted / seconds:.0f} meals/s); this week {summary['this_week']['meals']} meals")
+
+
+def main() -> None:
+    global rollups_module
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--histories", default="30,365,3650", help="comma separated days of history")
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--rebuild-meals", type=int, default=3000)
+    parser.add_argument("--backend", default="80:20:0", help="fake backend latency_ms:jitter_ms:error_rate")
+    args = parser.parse_args()
+
+    fakes = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_services.py"), "--backend", args.backend,
+                              "--photo-variants", "1"], stdout=subprocess.PIPE, text=True)
+    try:
+        url = f"http://127.0.0.1:{json.loads(fakes.stdout.readline())['backend']}"
+        # The backend URL is read when utils is imported
+        os.environ["API_BASE_URL"] = url
+        rollups_module = importlib.import_module("utils.rollups")
+
+        async def run() -> None:
+            await bench_reads([int(days) for days in args.histories.split(",")], args.reads)
+            await bench_rebuild(url, args.rebuild_meals)
+            await importlib.import_module("utils.backend").close_client()
+
+        asyncio.run(run())
+    finally:
+        fakes.terminate()
+        fakes.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Cold start of the bot: time from launching the process until the first update is answered.
+
+Starts fake_services.py (no latency), then --runs times queues a /start update in its Bot API and
+launches `python main.py` in polling mode, as the Procfile does, pointed at the fakes. Per run it
+notes when the bot first called getUpdates (ready) and when it sent its first reply; the import
+time of main is measured in a separate interpreter. Exits with status 1 if the median time to the
+first reply exceeds --budget seconds, so CI catches startup regressions.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 5 --budget 2.5
+    python benchmarks/bench_startup.py --env WARM_UP=0
+"""
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+from bench_load import bot_environment, make_update
+
+FIRST_USER_ID = 20_000_000
+
+
+def import_time(env: dict) -> float:
+    code = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return float(result.stdout.split()[-1])
+
+
+def run_once(run: int, env: dict, client: httpx.Client, timeout: float) -> tuple:
+    """(seconds until the first getUpdates, seconds until the first reply) of one bot start."""
+    update = make_update("start", run + 1, FIRST_USER_ID + run, None, 0)
+    client.post("/_updates", json=[update]).raise_for_status()
+    before = client.get("/_stats").json()
+
+    start = time.perf_counter()
+    bot = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ready = replied = None
+    try:
+        while replied is None:
+            if time.perf_counter() - start > timeout or bot.poll() is not None:
+                raise SystemExit(f"run {run + 1}: no reply after {time.perf_counter() - start:.1f}s")
+            stats = client.get("/_stats").json()
+            now = time.perf_counter() - start
+            if ready is None and stats.get("telegram.getUpdates", 0) > before.get("telegram.getUpdates", 0):
+                ready = now
+            if stats.get("telegram.sendMessage", 0) > before.get("telegram.sendMessage", 0):
+                replied = now
+            time.sleep(0.01)
+    finally:
+        # run_polling shuts down cleanly on SIGINT and confirms the fetched update
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+    return ready if ready is not None else replied, replied
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=2.5, help="max median seconds until the first reply")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds a run may take")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="bot setting, may be repeated")
+    args = parser.parse_args()
+
+    fakes = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_services.py"), "--telegram", "0",
+                              "--openai", "0", "--backend", "0", "--photo-variants", "1"],
+                             stdout=subprocess.PIPE, text=True)
+    try:
+        ports = json.loads(fakes.stdout.readline())
+        # One keep-alive client: polling the fake's stats must not compete with the bot for the CPU
+        with tempfile.TemporaryDirectory() as workdir, \
+                httpx.Client(base_url=f"http://127.0.0.1:{ports['telegram']}") as client:
+            env = dict(os.environ, **bot_environment(ports, workdir))
+            for setting in args.env:
+                key, _, value = setting.partition("=")
+                env[key] = value
+            imports = [import_time(env) for _ in range(args.runs)]
+            runs = [run_once(run, env, client, args.timeout) for run in range(args.runs)]
+    finally:
+        fakes.terminate()
+        fakes.wait()
+
+    for run, (ready, replied) in enumerate(runs, 1):
+        print(f"run {run}: import main {imports[run - 1]:.2f}s, polling after {ready:.2f}s, first reply after {replied:.2f}s")
+    first_reply = statistics.median(replied for _, replied in runs)
+    print(f"median: import main {statistics.median(imports):.2f}s, polling after "
+          f"{statistics.median(ready for ready, _ in runs):.2f}s, first reply after {first_reply:.2f}s "
+          f"(budget {args.budget:g}s)")
+    if first_reply > args.budget:
+        print("startup budget exceeded")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
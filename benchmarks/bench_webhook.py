@@ -0,0 +1,138 @@
+"""
+Fake Telegram update sender for the webhook server.
+
+Posts synthetic text updates the way Telegram delivers webhooks and reports accepted
+updates/sec, response latency percentiles and rejections. Without --url it starts a
+WebhookServer in-process whose updates are consumed by a stub handler (--handler-ms each),
+so the ingest path is measured without Telegram or OpenAI; at the end the server is put
+into draining mode and the health check is verified to fail.
+
+Usage:
+    python benchmarks/bench_webhook.py --updates 5000 --concurrency 100
+    python benchmarks/bench_webhook.py --url http://localhost:8080/telegram --secret s3cret
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Bot
+
+from utils.webhook import SECRET_HEADER, WebhookServer
+
+
+def make_update(update_id: int, users: int) -> dict:
+    chat_id = update_id % users + 1
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": user,
+            "text": f"message {update_id}",
+        },
+    }
+
+
+async def send_updates(url: str, secret: str, updates: int, users: int, concurrency: int) -> dict:
+    latencies, statuses = [], {}
+    next_id = iter(range(1, updates + 1))
+    headers = {SECRET_HEADER: secret} if secret else {}
+
+    async def sender(session):
+        for update_id in next_id:
+            start = time.perf_counter()
+            async with session.post(url, json=make_update(update_id, users), headers=headers) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "statuses": statuses,
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[int(len(latencies) * 0.99) - 1],
+        "mean": statistics.mean(latencies),
+    }
+
+
+async def run_local(args) -> None:
+    # The server only needs an update queue and a bot to attach to the decoded updates
+    application = SimpleNamespace(update_queue=asyncio.Queue(), bot=Bot("123456:BENCHMARK"))
+    server = WebhookServer(application, path="/telegram", secret=args.secret, max_queue=args.max_queue)
+    handled = 0
+
+    async def consumer():
+        nonlocal handled
+        while True:
+            await application.update_queue.get()
+            await asyncio.sleep(args.handler_ms / 1000)
+            handled += 1
+
+    consumers = [asyncio.create_task(consumer()) for _ in range(args.workers)]
+    await server.start(args.port)
+    try:
+        result = await send_updates(f"http://127.0.0.1:{args.port}/telegram", args.secret,
+                                    args.updates, args.users, args.concurrency)
+        report(result)
+
+        server.draining = True
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{args.port}/healthz") as response:
+                health = await response.json()
+                print(f"health while draining: {response.status} {health}")
+        start = time.perf_counter()
+        while handled < server.received:
+            await asyncio.sleep(0.01)
+        print(f"queue drained in {time.perf_counter() - start:.2f}s, {handled} updates handled")
+    finally:
+        for task in consumers:
+            task.cancel()
+        await server.stop()
+
+
+def report(result: dict) -> None:
+    accepted = result["statuses"].get(200, 0)
+    print(f"responses: {result['statuses']}")
+    print(f"accepted: {accepted / result['elapsed']:.0f} updates/s over {result['elapsed']:.2f}s")
+    print(f"latency: p50 {result['p50'] * 1000:.1f} ms, p99 {result['p99'] * 1000:.1f} ms, "
+          f"mean {result['mean'] * 1000:.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="webhook URL of a running bot; omit to benchmark an in-process server")
+    parser.add_argument("--secret", default="", help="value of the secret token header")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100, help="requests in flight")
+    parser.add_argument("--port", type=int, default=8089, help="port of the in-process server")
+    parser.add_argument("--workers", type=int, default=64, help="stub handlers consuming the in-process queue")
+    parser.add_argument("--handler-ms", type=float, default=5.0, help="time a stub handler spends per update")
+    parser.add_argument("--max-queue", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.url:
+        report(asyncio.run(send_updates(args.url, args.secret, args.updates, args.users, args.concurrency)))
+    else:
+        asyncio.run(run_local(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Local stand-ins for the Telegram Bot API, the OpenAI API and the Lipo-Out backend.
+
+Each server answers just enough of its API for the bot's flows, after a latency drawn from its
+profile ("latency_ms:jitter_ms:error_rate", optionally ":slow_rate:slow_ms" for a slow tail; OpenAI
+models may get their own with --openai-model), and fails that share of requests the way the real
+service does: Telegram with 429 and retry_after, OpenAI with 500, the backend with 503. OpenAI
+answers stream at --openai-tps tokens/s after the profile's latency (the time to first token).
+Photos are served as --photo-variants distinct images derived from --photo, so the photo cache
+only answers repeats. Updates POSTed (JSON list) to /_updates on the Telegram port are delivered by
+getUpdates. Request and error counts are served as JSON at /_stats on every port.
+
+Once listening, the ports are printed as one JSON line; bench_load.py starts this script in its own
+process so the fakes do not share the bot's event loop.
+
+Usage:
+    python benchmarks/fake_services.py --telegram 50:20:0.01 --openai 1500:500:0.01 --backend 80:20:0
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Lipo-Out", "username": "lipo_out_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+FOODS = [("Spaghetti Bolognese", "🍝"), ("Hamburger", "🍔"), ("Caesar salad", "🥗"), ("Sushi", "🍣"),
+         ("Pizza Margherita", "🍕"), ("Coffee", "☕"), ("Orange juice", "🧃"), ("Pancakes", "🥞")]
+
+WORDS = ("protein fiber vegetables hydration balance energy portion calories sugar whole grains "
+         "vitamins minerals snack breakfast dinner lunch water healthy moderate activity").split()
+
+
+@dataclass
+class Profile:
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    error_rate: float = 0
+    # Share of requests that take slow_ms longer, the tail
+    slow_rate: float = 0
+    slow_ms: float = 0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Profile":
+        # "latency_ms[:jitter_ms[:error_rate[:slow_rate:slow_ms]]]"
+        return cls(*(float(value) for value in spec.split(":")))
+
+    def __str__(self) -> str:
+        spec = f"{self.latency_ms:g}:{self.jitter_ms:g}:{self.error_rate:g}"
+        return f"{spec}:{self.slow_rate:g}:{self.slow_ms:g}" if self.slow_rate else spec
+
+    def delay(self) -> float:
+        slow = self.slow_ms if random.random() < self.slow_rate else 0
+        return max(self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms) + slow, 0) / 1000
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+
+def make_photo_variants(path: str, count: int, max_edge: int = 800) -> list:
+    # A coarse random pattern blended over the photo changes its perceptual hash, so variants are not near-duplicates
+    with Image.open(path) as source:
+        base = source.convert("RGB")
+    base.thumbnail((max_edge, max_edge))
+    rng = random.Random(0)
+    variants = []
+    for _ in range(count):
+        noise = Image.frombytes("L", (9, 8), bytes(rng.randrange(256) for _ in range(72)))
+        noise = noise.resize(base.size, Image.NEAREST).convert("RGB")
+        with BytesIO() as out:
+            Image.blend(base, noise, 0.4).save(out, format="JPEG", quality=85)
+            variants.append(out.getvalue())
+    return variants
+
+
+class FakeTelegram:
+    """Bot API methods the bot calls; every message it sends is answered as if delivered."""
+
+    def __init__(self, profile: Profile, photos: list, stats: Counter):
+        self.profile = profile
+        self.photos = photos
+        self.stats = stats
+        self._message_ids = 0
+        # Updates not yet confirmed by a getUpdates offset beyond them
+        self.updates = []
+        self._new_updates = asyncio.Event()
+        self.app = web.Application(client_max_size=20 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/getUpdates", self.handle_get_updates)
+        self.app.router.add_post("/bot{token}/{method}", self.handle_method)
+        self.app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        self.app.router.add_post("/_updates", self.handle_add_updates)
+
+    def _message(self, chat_id, message_id=None, **fields) -> dict:
+        if message_id is None:
+            self._message_ids += 1
+            message_id = self._message_ids
+        return {"message_id": int(message_id), "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": int(chat_id), "type": "private"}, **fields}
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        self.stats[f"telegram.{method}"] += 1
+        await asyncio.sleep(self.profile.delay())
+        if self.profile.fails() and "chat_id" in data:
+            self.stats["telegram.errors"] += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getFile":
+            file_id = data["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self._photo(file_id)),
+                      "file_path": f"photos/{file_id}.jpg"}
+        elif method == "sendMessage":
+            result = self._message(data["chat_id"], text=data["text"])
+        elif method == "sendPhoto":
+            photo = data["photo"]
+            size = len(photo.file.read()) if isinstance(photo, web.FileField) else 0
+            self._message_ids += 1
+            file_id = photo if isinstance(photo, str) else f"chart-{self._message_ids}"
+            result = self._message(data["chat_id"], caption=data.get("caption", ""), photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 800, "file_size": size}
+            ])
+        elif method in ("editMessageText", "editMessageCaption"):
+            field = "text" if method == "editMessageText" else "caption"
+            result = self._message(data["chat_id"], data["message_id"], **{field: data.get(field, "")})
+        elif method in ("answerCallbackQuery", "deleteMessage", "setMyCommands", "deleteWebhook", "setWebhook", "sendChatAction"):
+            result = True
+        else:
+            self.stats["telegram.unknown_methods"] += 1
+            return web.json_response({"ok": False, "error_code": 404, "description": "Not Found"}, status=404)
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_add_updates(self, request: web.Request) -> web.Response:
+        self.updates.extend(await request.json())
+        self._new_updates.set()
+        return web.Response()
+
+    async def handle_get_updates(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        self.stats["telegram.getUpdates"] += 1
+        offset = int(data.get("offset") or 0)
+        if offset:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            # Long polling: answer as soon as an update arrives, or empty after the timeout
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(data.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response({"ok": True, "result": self.updates[:int(data.get("limit") or 100)]})
+
+    def _photo(self, file_id: str) -> bytes:
+        # Synthetic file_ids name their variant, any other (replayed) one is mapped onto one
+        match = re.fullmatch(r"photo-(\d+)", file_id)
+        index = int(match.group(1)) if match else zlib.crc32(file_id.encode())
+        return self.photos[index % len(self.photos)]
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.stats["telegram.file_downloads"] += 1
+        await asyncio.sleep(self.profile.delay())
+        file_id = os.path.splitext(os.path.basename(request.match_info["path"]))[0]
+        return web.Response(body=self._photo(file_id), content_type="image/jpeg")
+
+
+class FakeOpenAI:
+    """Chat completions, streamed or not; structured meal answers when a response_format asks for one."""
+
+    def __init__(self, profile: Profile, tokens_per_second: float, stats: Counter, chunk_interval: float = 0.05,
+                 model_profiles: dict = None):
+        self.profile = profile
+        # model -> Profile of the models that answer differently from the rest
+        self.model_profiles = model_profiles or {}
+        self.tokens_per_second = tokens_per_second
+        self.chunk_interval = chunk_interval
+        self.stats = stats
+        self._ids = 0
+        self.app = web.Application(client_max_size=50 * 1024 * 1024)
+        self.app.router.add_post("/v1/chat/completions", self.handle_completion)
+
+    @staticmethod
+    def _content(body: dict) -> str:
+        response_format = body.get("response_format") or {}
+        name = response_format.get("json_schema", {}).get("name")
+        if name in ("meal", "meal_album"):
+            items = [{"name": food, "emoji": emoji} for food, emoji in random.sample(FOODS, random.randint(1, 3))]
+            macros = {"calories": 250, "carbohydrates": 30, "protein": 12, "fats": 9}
+            meal = {"is_food": True, "items": items}
+            if name == "meal_album":
+                for item in items:
+                    item.update({key: round(value * random.uniform(0.5, 2)) for key, value in macros.items()})
+            else:
+                meal.update({key: round(value * random.uniform(1, 4)) for key, value in macros.items()})
+            meal["health_rating"] = random.randint(3, 9)
+            meal["analysis"] = " ".join(random.choices(WORDS, k=45)).capitalize() + ". 🥦💧"
+            return json.dumps(meal, ensure_ascii=False)
+        words = 40 if body.get("max_tokens", 0) <= 256 else 180
+        return " ".join(random.choices(WORDS, k=words)).capitalize() + "."
+
+    @staticmethod
+    def _usage(body: dict, text: str) -> dict:
+        prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+        completion_tokens = len(text) // 4
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    async def handle_completion(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["openai.chat.completions"] += 1
+        self.stats[f"openai.model.{body.get('model', '')}"] += 1
+        profile = self.model_profiles.get(body.get("model"), self.profile)
+        await asyncio.sleep(profile.delay())
+        if profile.fails():
+            self.stats["openai.errors"] += 1
+            return web.json_response({"error": {"message": "The server had an error", "type": "server_error"}},
+                                     status=500)
+
+        self._ids += 1
+        completion_id, model, created = f"chatcmpl-{self._ids}", body.get("model", ""), int(time.time())
+        text = self._content(body)
+        if not body.get("stream"):
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": self._usage(body, text),
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(choices: list, usage: dict = None) -> None:
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": choices, "usage": usage}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        # About 4 characters per token, sent in chunks every chunk_interval
+        step = max(int(self.tokens_per_second * self.chunk_interval * 4), 1)
+        await send([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for start in range(0, len(text), step):
+            await send([{"index": 0, "delta": {"content": text[start:start + step]}, "finish_reason": None}])
+            await asyncio.sleep(self.chunk_interval)
+        await send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send([], self._usage(body, text))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class FakeBackend:
+    """The Lipo-Out backend's user and food endpoints, kept in memory."""
+
+    def __init__(self, profile: Profile, stats: Counter):
+        self.profile = profile
+        self.stats = stats
+        self.users = {}
+        # Food rows without their photos, in the order they were created
+        self.foods = []
+        self.app = web.Application(client_max_size=20 * 1024 * 1024)
+        self.app.router.add_route("*", "/users/", self.handle_users)
+        self.app.router.add_route("*", "/foods/", self.handle_foods)
+
+    async def _answer(self, request: web.Request):
+        self.stats[f"backend.{request.method} {request.path}"] += 1
+        await asyncio.sleep(self.profile.delay())
+        if self.profile.fails():
+            self.stats["backend.errors"] += 1
+            return web.json_response({"detail": "Service Unavailable"}, status=503)
+        return None
+
+    async def handle_users(self, request: web.Request) -> web.Response:
+        failure = await self._answer(request)
+        if failure is not None:
+            return failure
+        query = request.query
+        if request.method == "GET":
+            if "telegram_id" in query:
+                user = self.users.get(int(query["telegram_id"]))
+                found = [user] if user else []
+            else:
+                found = [user for user in self.users.values() if user["name"] == query.get("name")][:1]
+            return web.json_response(found) if found else web.json_response({"detail": "Not found"}, status=404)
+        if request.method == "POST":
+            data = await request.json()
+            user = dict(data, id=len(self.users) + 1)
+            self.users[int(data["telegram_id"])] = user
+            return web.json_response(user, status=201)
+        if request.method == "PATCH":
+            user = self.users.get(int(query.get("telegram_id", 0)))
+            if user is None:
+                return web.json_response({"detail": "Not found"}, status=404)
+            user.update(await request.json())
+            return web.json_response(user)
+        return web.Response(status=405)
+
+    async def handle_foods(self, request: web.Request) -> web.Response:
+        failure = await self._answer(request)
+        if failure is not None:
+            return failure
+        if request.method == "GET":
+            query = request.query
+            skip, limit = int(query.get("skip", 0)), int(query.get("limit", 100))
+            rows = [food for food in self.foods if food["user_id"] == int(query["user_id"])]
+            return web.json_response(rows[skip:skip + limit])
+        if request.method == "POST":
+            data = await request.json()
+            # created_at may be given, to seed a history
+            food = dict(data, id=len(self.foods) + 1, food_photo=None,
+                        created_at=data.get("created_at") or datetime.now(timezone.utc).isoformat())
+            self.foods.append(food)
+            return web.json_response(food, status=201)
+        return web.Response(status=405)
+
+
+async def serve(args) -> None:
+    stats = Counter()
+    photos = make_photo_variants(args.photo, args.photo_variants)
+    servers = {
+        "telegram": FakeTelegram(Profile.parse(args.telegram), photos, stats),
+        "openai": FakeOpenAI(Profile.parse(args.openai), args.openai_tps, stats, model_profiles={
+            model: Profile.parse(spec) for model, _, spec in (setting.partition("=") for setting in args.openai_model)
+        }),
+        "backend": FakeBackend(Profile.parse(args.backend), stats),
+    }
+
+    async def handle_stats(request: web.Request) -> web.Response:
+        return web.json_response(dict(stats))
+
+    ports = {}
+    for name, server in servers.items():
+        server.app.router.add_get("/_stats", handle_stats)
+        runner = web.AppRunner(server.app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, args.host, 0)
+        await site.start()
+        ports[name] = runner.addresses[0][1]
+    print(json.dumps(ports), flush=True)
+    await asyncio.Event().wait()
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--telegram", default="50:20:0", help="Bot API latency_ms:jitter_ms:error_rate")
+    parser.add_argument("--openai", default="1500:500:0", help="OpenAI time to first token latency_ms:jitter_ms:error_rate")
+    parser.add_argument("--openai-model", action="append", default=[], metavar="MODEL=PROFILE",
+                        help="profile of one model, e.g. gpt-4o-mini=400:100:0; may be repeated")
+    parser.add_argument("--openai-tps", type=float, default=80, help="streamed tokens per second")
+    parser.add_argument("--backend", default="80:20:0", help="backend latency_ms:jitter_ms:error_rate")
+    parser.add_argument("--photo", default=os.path.join(ROOT, "user_photo.jpg"))
+    parser.add_argument("--photo-variants", type=int, default=200, help="distinct photos users send")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    add_profile_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
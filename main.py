@@ -16,11 +16,8 @@ bot.
 from enum import Enum
 import logging
 import os
-import base64
-from io import BytesIO
-from PIL import Image
-import requests
 import asyncio
+import time
 import dotenv
 
 dotenv.load_dotenv()
@@ -35,12 +32,34 @@ from telegram.ext import (
     MessageHandler,
     filters,
     PreCheckoutQueryHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from utils import getPhotoResponse, getTextResponse, escape_markdown_v2
-from utils.save_food_to_db import write_food_photo_to_db
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.error import BadRequest
+from utils import getPhotoResponse, getAlbumResponse, getTextResponse, getSummaryResponse, escape_markdown_v2, close_openai_client, preload_openai
+from utils.history import ChatHistory
+from utils import backend
+from utils.image import pick_photo_size, prepare_vision_image, shutdown_image_workers
+from utils.photo_cache import photo_cache
+from utils.chart import render_nutrition_chart, render_trend_chart, warm_up_chart_renderer
+from utils.chart_cache import chart_file_cache
+from utils.answer_cache import answer_cache
+from utils.routing import question_router
+from utils.deadline import ModelUnavailable, deadline_caller
+from utils.progressive import ProgressiveMessage
+from utils.save_queue import save_queue
+from utils.rollups import nutrition_rollups
+from utils.scheduler import analysis_scheduler
+from utils.album import ALBUM_MAX_PHOTOS, album_collector
+from utils.pending_uploads import PENDING_SWEEP_INTERVAL, pending_uploads
+from utils.user_cache import user_cache
 from utils.payment import pay, precheckout_callback, successful_payment_callback
+from utils.update_processor import ChatOrderedUpdateProcessor
+from utils.metrics import METRICS_PORT, instrument_handler, metrics, start_metrics_server
+from utils.rate_limiter import FloodControlRateLimiter
+from utils.persistence import PERSISTENCE_PATH, SQLiteStateStore, StatePersistence
+from utils.trace import UPDATE_TRACE_PATH, update_recorder
 
 class State(Enum):
     HEALTH_STATE=1,
@@ -58,9 +77,23 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
-API_BASE_URL = "https://lipo-out-backend-production.up.railway.app"  # Adjust this URL to your backend
+# How many updates may be handled at once; updates of the same chat always run in order. 1 disables concurrency.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+# "polling" pulls updates with getUpdates, "webhook" serves them over HTTP (see utils/webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Bot API server to use instead of api.telegram.org, e.g. a self-hosted telegram-bot-api
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# Load the OpenAI SDK and matplotlib in the background right after start; 0 leaves them to the first photo
+WARM_UP = os.getenv("WARM_UP", "1") != "0"
+
+def compact_history(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Summarize messages that left the history window in the background, after the reply was sent
+    chat_history = context.user_data["chat_history"]
+    if chat_history.needs_compaction():
+        context.application.create_task(chat_history.compact(getSummaryResponse))
 
 # pre-starter
+@instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     reply_keyboard = [["start"]]
     telegram_user_id = update.message.from_user.id  # Unique Telegram user ID
@@ -69,8 +102,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     print("id:", telegram_user_id)
 
 
-    # Define the endpoint and payload for the API request
-    user_api_url = f"{API_BASE_URL}/users/"
+    # Define the payload for the API request
     user_data = {
         "name": telegram_user_name,
         "age": 0,
@@ -80,26 +112,32 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "goal": "default"
     }
 
-    # Check if the user already exists by name
-    response = requests.get(f"{user_api_url}?name={telegram_user_name}")
-
-    if response.status_code == 404:
-        # User not found, proceed to create
-        create_response = requests.post(user_api_url, json=user_data)
-        if create_response.status_code == 201:
-            print("User created successfully.")
-        else:
-            print("Failed to create user:", create_response.json())
-    elif response.status_code == 200:
-        # User already exists
+    if user_cache.get(telegram_user_id) is not None:
+        # Known from an earlier lookup, no need to ask the backend again
         print("User already exists.")
     else:
-        # Handle other unexpected errors
-        print("Error occurred:", response.status_code, response.json())
+        # Check if the user already exists by name
+        response = await backend.get_user_by_name(telegram_user_name)
+
+        if response.status_code == 404:
+            # User not found, proceed to create
+            create_response = await backend.create_user(user_data)
+            if create_response.status_code == 201:
+                print("User created successfully.")
+                user_cache.remember(telegram_user_id, create_response.json())
+            else:
+                print("Failed to create user:", create_response.json())
+        elif response.status_code == 200:
+            # User already exists
+            print("User already exists.")
+            user_cache.remember(telegram_user_id, response.json())
+        else:
+            # Handle other unexpected errors
+            print("Error occurred:", response.status_code, response.json())
 
     # Initialize user chat history if it doesn't exist in the context
     if "chat_history" not in context.user_data:
-        context.user_data["chat_history"] = []
+        context.user_data["chat_history"] = ChatHistory()
 
     # Send a reply to the user
     reply_keyboard = [["Press to continue"]]
@@ -116,6 +154,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return State.HEALTH_STATE
 
 # Ask the user for their health goal
+@instrument_handler
 async def heathState(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # Inline keyboard with health goals
     keyboard = [
@@ -134,6 +173,7 @@ async def heathState(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return State.HEALTH_STATE
 
 # Handle the health goal choice and save it to the database
+@instrument_handler
 async def handle_goal_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()  # Acknowledge the button click
@@ -143,10 +183,12 @@ async def handle_goal_selection(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Update user's goal in the database
     telegram_user_id = update.callback_query.from_user.id
-    user_api_url = f"{API_BASE_URL}/users/?telegram_id={telegram_user_id}"
     update_data = {"goal": selected_goal}
 
-    response = requests.patch(user_api_url, json=update_data)
+    response = await backend.update_user(telegram_user_id, update_data)
+    if response.status_code == 404:
+        # The backend no longer knows this user, drop the cached identity
+        user_cache.invalidate(telegram_user_id)
     if response.status_code == 200:
         await query.edit_message_text(
             f"""Your goal is set to <b>{selected_goal}</b>! 🎯
@@ -163,6 +205,7 @@ Ready to get started? 📸 Upload a photo, and we’ll take care of the analysis
     return State.REPLY_PHOTO
 
 # Handle photo input
+@instrument_handler
 async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
     message = update.message.text
@@ -186,70 +229,150 @@ Ready to get started? 📸 Upload a photo, and we’ll take care of the analysis
     return State.REPLY_PHOTO
 
 # Handle text input
+@instrument_handler
 async def replyText(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
     user_input = update.message.text
     logger.info("Text message from %s: %s", user.first_name, user_input)
 
     # Append to user's chat history
-    context.user_data["chat_history"].append({"role": "user", "content": user_input})
-
-    # Get response from GPT API based on chat history
-    response_text = getTextResponse(context.user_data["chat_history"])
+    chat_history = context.user_data["chat_history"]
+    chat_history.append("user", user_input)
+
+    # Get response from GPT API based on chat history, showing the answer while it streams in
+    progress = ProgressiveMessage(update.message)
+    try:
+        response_text = await getTextResponse(chat_history, on_progress=progress.push)
+    except ModelUnavailable:
+        logger.warning("No answer for %s within the deadline", user.first_name)
+        await progress.finish("Sorry, I can't answer right now. Please try again in a minute. 🙏")
+        return State.REPLY_PHOTO
 
     # Append GPT response to chat history
-    context.user_data["chat_history"].append({"role": "assistant", "content": response_text})
+    chat_history.append("assistant", response_text)
+
+    await progress.finish(response_text)
+    compact_history(context)
 
-    await update.message.reply_text(response_text)
-    
     return State.REPLY_PHOTO
 
 
+async def send_chart(message: Message, response: dict, **kwargs) -> Message:
+    # Charts uploaded before are sent by file_id; a fresh upload's file_id is kept for the next time
+    chart_key = response["chart_key"]
+    if response["chart_file_id"] is not None:
+        try:
+            with metrics.timer("bot_stage_seconds", stage="chart_send_file_id"):
+                return await message.reply_photo(photo=response["chart_file_id"], **kwargs)
+        except BadRequest as e:
+            logger.warning("Cached chart could not be sent (%s), uploading it again", e)
+            chart_file_cache.invalidate(chart_key)
+    chart_png = response["chart_png"] or await render_nutrition_chart(response["meal"].nutrition())
+    with metrics.timer("bot_stage_seconds", stage="chart_upload"):
+        sent = await message.reply_photo(photo=chart_png, **kwargs)
+    chart_file_cache.put(chart_key, sent.photo[-1].file_id)
+    return sent
+
+
 # Reply to photo
+@instrument_handler
 async def replyPhoto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = update.message.from_user
-    photo_file = await update.message.photo[-1].get_file()
+    # Photos sent as an album arrive as one update each; they are answered together once the album is complete
+    media_group_id = update.message.media_group_id
+    if media_group_id is not None:
+        if album_collector.add(update.message):
+            context.application.create_task(replyAlbum(update, context, media_group_id), update=update)
+        return State.REPLY_PHOTO
+
+    await answer_photos(context, [update.message])
+    return State.REPLY_PHOTO
 
-    # Read the photo content directly into memory without saving it to disk
-    photo_bytes = await photo_file.download_as_bytearray()
+@instrument_handler
+async def replyAlbum(update: Update, context: ContextTypes.DEFAULT_TYPE, media_group_id: str) -> None:
+    # Collected outside the chat lane, the album's other photos are updates of that lane themselves
+    messages = await album_collector.collect(media_group_id)
+    processor = context.application.update_processor
+    if isinstance(processor, ChatOrderedUpdateProcessor):
+        # The answer runs in the lane like any handler, so it does not overlap the chat's later updates
+        async with processor.lane(update):
+            await answer_photos(context, messages[:ALBUM_MAX_PHOTOS])
+    else:
+        await answer_photos(context, messages[:ALBUM_MAX_PHOTOS])
 
-    # Encode the photo content to base64
-    base64_image = base64.b64encode(photo_bytes).decode("utf-8")
+async def download_photo(photo_size) -> bytearray:
+    # Read the photo content directly into memory without saving it to disk
+    photo_file = await photo_size.get_file()
+    return await photo_file.download_as_bytearray()
+
+async def answer_photos(context: ContextTypes.DEFAULT_TYPE, messages: list) -> None:
+    # One analysis, message and chart for a single photo or all photos of an album
+    message = messages[0]
+    user = message.from_user
+    metrics.inc("bot_photo_requests_total", kind="album" if len(messages) > 1 else "single")
+    vision_sizes = [pick_photo_size(m.photo) for m in messages]
+    # A saved meal keeps the full-size photo (of an album the first one); it downloads while the
+    # analysis runs, so neither the analysis nor the Yes tap waits for it
+    saved_size = message.photo[-1]
+    saved_download = None if saved_size is vision_sizes[0] else asyncio.ensure_future(download_photo(saved_size))
+    try:
+        await answer_photo_sizes(context, messages, vision_sizes, saved_download)
+    finally:
+        if saved_download is not None and not saved_download.done():
+            saved_download.cancel()
+
+async def answer_photo_sizes(context: ContextTypes.DEFAULT_TYPE, messages: list, vision_sizes: list, saved_download) -> None:
+    message = messages[0]
+    user = message.from_user
+    with metrics.timer("bot_stage_seconds", stage="photo_download"):
+        # Download the smallest size that is still big enough for the vision model
+        photos = await asyncio.gather(*(download_photo(photo_size) for photo_size in vision_sizes))
+
+    # Downscale and re-encode for GPT-4o
+    vision_images = await asyncio.gather(*(prepare_vision_image(photo_bytes) for photo_bytes in photos))
     
-    logger.info("Photo of %s: processed.", user.first_name)
+    logger.info("Photo of %s: processed (%d).", user.first_name, len(photos))
     
     # Append photo info to chat history
-    context.user_data["chat_history"].append({"role": "user", "content": "User sent a photo"})
+    chat_history = context.user_data["chat_history"]
+    chat_history.append("user", "User sent a photo" if len(photos) == 1 else f"User sent {len(photos)} photos of one meal")
 
     # Send a temporary "loading" message to the user
-    loading_message = await update.message.reply_text("Processing your image, please wait ... ✨")
-
-    # Get both the text response and chart from GPT API
-    response = getPhotoResponse(context.user_data["chat_history"], base64_image)
+    loading_message = await message.reply_text("Processing your image, please wait ... ✨")
+
+    # Get both the text response and chart from GPT API, streaming the analysis into the loading message
+    progress = ProgressiveMessage(message, loading_message)
+    callbacks = dict(
+        on_progress=lambda text: progress.push(text.replace("**", "")),  # no markup until the text is complete
+        user_id=user.id,
+        on_queued=lambda position: progress.push(
+            f"Lots of photos are being analyzed right now, yours is number {position} in line ⏳"
+        )
+    )
+    try:
+        with metrics.timer("bot_stage_seconds", stage="analysis"):
+            if len(vision_images) == 1:
+                response = await getPhotoResponse(chat_history, vision_images[0], **callbacks)
+            else:
+                response = await getAlbumResponse(chat_history, vision_images, **callbacks)
+    except ModelUnavailable:
+        logger.warning("Photo of %s: no analysis within the deadline", user.first_name)
+        await progress.finish("Sorry, the analysis is taking too long right now. Please send the photo again in a minute. 🙏")
+        return
+    logger.info("Photo of %s: analysis served by %s.", user.first_name, response["served_by"])
     response_text = response["text_response"]
-    chart_base64 = response["chart_image_base64"]
     
     # Append GPT response to chat history
-    context.user_data["chat_history"].append({"role": "assistant", "content": response_text})
+    chat_history.append("assistant", response_text)
     
     # Edit the loading message with the final text response
     response_text_escaped = escape_markdown_v2(response_text)
-    await loading_message.edit_text(response_text_escaped, parse_mode=ParseMode.MARKDOWN_V2)
+    await progress.finish(response_text_escaped, parse_mode=ParseMode.MARKDOWN_V2)
     
-    if chart_base64 is not None:
-        # Decode the chart image from base64 and send it back as a photo
-        chart_bytes = base64.b64decode(chart_base64)
-        chart_image = Image.open(BytesIO(chart_bytes))
-
-        # Convert the chart to a byte stream so it can be sent as a photo
-        with BytesIO() as image_binary:
-            chart_image.save(image_binary, format='PNG')
-            image_binary.seek(0)
-            await update.message.reply_photo(photo=image_binary)
-
-        telegram_user_id = update.message.from_user.id  # Unique Telegram user ID
+    if response["chart_key"] is not None:
+        telegram_user_id = user.id  # Unique Telegram user ID
 
-        # Ask the user if they want to save this meal to the database
+        # Send the chart (a known one by file_id, a new one as raw PNG) together with the question
+        # whether to save this meal to the database, one message instead of two
         keyboard = [
             [
                 InlineKeyboardButton("Yes", callback_data="save_yes"),
@@ -257,36 +380,100 @@ async def replyPhoto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             ]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Would you like to save this meal to your record?", reply_markup=reply_markup)
-
-        # Store photo and analysis details in context for callback use
-        context.user_data["photo_bytes"] = photo_bytes
-        context.user_data["response_text"] = response_text
+        await send_chart(
+            message, response, caption="Would you like to save this meal to your record?", reply_markup=reply_markup
+        )
+
+        # Store photo and analysis details in context for callback use; the photo itself stays in
+        # the pending upload store and user_data only keeps its handle. The backend stores one
+        # photo per meal, of an album the first one.
+        saved_photo = photos[0]
+        if saved_download is not None:
+            try:
+                saved_photo = await saved_download
+            except Exception as e:
+                logger.warning("Photo of %s: full-size download failed (%r), keeping the analyzed size", user.first_name, e)
+        previous_handle = context.user_data.get("photo_handle")
+        if previous_handle:
+            pending_uploads.discard(previous_handle)
+        context.user_data["photo_handle"] = pending_uploads.put(saved_photo)
+        context.user_data["meal"] = response["meal"]
         context.user_data["telegram_user_id"] = telegram_user_id
 
-    return State.REPLY_PHOTO
+    compact_history(context)
 
 # Callback handler to process the user’s choice
+@instrument_handler
 async def handle_save_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()  # Acknowledge the button click
 
+    photo_handle = context.user_data.pop("photo_handle", None)
+
     # Determine if the user selected "Yes" or "No"
     if query.data == "save_yes":
         # User chose to save the meal
-        photo_bytes = context.user_data.get("photo_bytes")
-        response_text = context.user_data.get("response_text")
+        photo_bytes = pending_uploads.take(photo_handle) if photo_handle else None
+        meal = context.user_data.get("meal")
         telegram_user_id = context.user_data.get("telegram_user_id")
-
-        # Call the function to store the meal in the database
-        write_food_photo_to_db(telegram_user_id, photo_bytes, response_text)
+        if photo_bytes is None or meal is None:
+            # Nobody answered for too long and the photo expired (or the Yes was tapped twice)
+            await query.edit_message_caption("This meal is no longer available, please send the photo again. ⌛")
+            return
+
+        # Journal the meal; the write-behind queue stores it in the database in the background
+        save_id = await save_queue.enqueue(telegram_user_id, photo_bytes, meal)
+        # Count it in the user's daily and weekly totals right away, /stats does not wait for the backend
+        await nutrition_rollups.add(telegram_user_id, meal, save_id=save_id)
         
-        await query.edit_message_text("Meal saved to your record! ✅")
+        # The question is the caption of the chart
+        await query.edit_message_caption("Meal saved to your record! ✅")
     else:
         # User chose not to save the meal
-        await query.edit_message_text("Meal was not saved to your record. ❌")
-
+        if photo_handle:
+            pending_uploads.discard(photo_handle)
+        await query.edit_message_caption("Meal was not saved to your record. ❌")
+
+
+def format_totals(totals: dict) -> str:
+    return (f"{round(totals['calories'])} Cal · carbs {round(totals['carbs'])}g · protein {round(totals['protein'])}g"
+            f" · fats {round(totals['fat'])}g ({totals['meals']} meals)")
+
+@instrument_handler
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Daily and weekly totals of the saved meals with a trend chart; /stats rebuild recounts them from the backend."""
+    telegram_user_id = update.message.from_user.id
+    summary = await nutrition_rollups.summary(telegram_user_id)
+
+    # Meals saved before the totals existed are only in the backend: count them once, or when asked to
+    if not summary["rebuilt"] or context.args[:1] == ["rebuild"]:
+        loading_message = await update.message.reply_text("Adding up your saved meals, please wait ... 📊")
+        try:
+            await nutrition_rollups.rebuild(telegram_user_id, save_queue)
+        except Exception:
+            logger.exception("Rebuilding the nutrition totals of %s failed", telegram_user_id)
+            await loading_message.edit_text("Your older meals could not be loaded right now, showing the ones saved here.")
+        else:
+            summary = await nutrition_rollups.summary(telegram_user_id)
+            await loading_message.delete()
+
+    if not any(day["meals"] for day in summary["trend"]) and not summary["last_week"]["meals"]:
+        await update.message.reply_text(
+            f"No meals saved in the last {len(summary['trend'])} days. Send a photo of your meal and save it to see your stats here. 📸"
+        )
+        return
+
+    week = summary["this_week"]
+    caption = (
+        f"<b>📊 Your nutrition</b>\n"
+        f"<b>Today:</b> {format_totals(summary['today'])}\n"
+        f"<b>This week:</b> {format_totals(week)}, {round(week['calories'] / summary['week_days'])} Cal per day\n"
+        f"<b>Last week:</b> {format_totals(summary['last_week'])}"
+    )
+    chart_png = await render_trend_chart(summary["trend"])
+    await update.message.reply_photo(photo=chart_png, caption=caption, parse_mode=ParseMode.HTML)
 
+@instrument_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the conversation and reset the state."""
     await update.message.reply_text(
@@ -294,15 +481,94 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     
     # Clear user data if necessary
+    photo_handle = context.user_data.get("photo_handle")
+    if photo_handle:
+        pending_uploads.discard(photo_handle)
     context.user_data.clear()
     
     return ConversationHandler.END
 
-def main() -> None:
-    token = os.getenv("BOT_TOKEN")  # Load token from environment variable
-    
+def register_metrics(application: Application) -> None:
+    # Caches and queues report their own counters; they are read whenever /metrics is scraped
+    metrics.register_collector("photo_cache", photo_cache.stats)
+    metrics.register_collector("chart_cache", chart_file_cache.stats)
+    metrics.register_collector("answer_cache", answer_cache.stats)
+    metrics.register_collector("text_routes", question_router.stats)
+    metrics.register_collector("openai_deadlines", deadline_caller.stats)
+    metrics.register_collector("user_cache", user_cache.stats)
+    metrics.register_collector("save_queue", save_queue.stats)
+    metrics.register_collector("rollups", nutrition_rollups.stats)
+    metrics.register_collector("pending_uploads", pending_uploads.stats)
+    metrics.register_collector("analysis_scheduler", analysis_scheduler.stats)
+    metrics.register_collector("albums", album_collector.stats)
+    if isinstance(application.bot.rate_limiter, FloodControlRateLimiter):
+        metrics.register_collector("telegram_rate_limiter", application.bot.rate_limiter.stats)
+    if isinstance(application.persistence, StatePersistence):
+        metrics.register_collector("persistence", application.persistence.stats)
+
+async def post_init(application: Application) -> None:
+    register_metrics(application)
+    # In webhook mode /metrics is served by the webhook server
+    if METRICS_PORT and BOT_MODE != "webhook":
+        application.bot_data["metrics_server"] = await start_metrics_server(METRICS_PORT)
+    # Resume meal saves journaled before the last shutdown
+    await save_queue.start()
+    # Expire photos nobody answered the save question for
+    if application.job_queue:
+        application.job_queue.run_repeating(sweep_pending_uploads, interval=PENDING_SWEEP_INTERVAL)
+    else:
+        application.bot_data["pending_sweeper"] = asyncio.create_task(pending_uploads.run_sweeper())
+    if WARM_UP:
+        application.bot_data["warm_up"] = asyncio.create_task(warm_up())
+
+async def warm_up() -> None:
+    # Heavy imports are deferred so the bot takes updates sooner; load them now, before the first photo needs them
+    start = time.perf_counter()
+    await asyncio.to_thread(preload_openai)
+    await asyncio.gather(*(asyncio.wrap_future(future) for future in warm_up_chart_renderer()))
+    logger.info("Warm-up done in %.2fs", time.perf_counter() - start)
+
+async def sweep_pending_uploads(context: ContextTypes.DEFAULT_TYPE) -> None:
+    pending_uploads.sweep()
+
+async def post_shutdown(application: Application) -> None:
+    for task_name in ("pending_sweeper", "warm_up"):
+        task = application.bot_data.pop(task_name, None)
+        if task:
+            task.cancel()
+    metrics_server = application.bot_data.pop("metrics_server", None)
+    if metrics_server:
+        await metrics_server.cleanup()
+    # Unanswered photos stay in PENDING_DIR, a Yes after the restart still saves them
+    pending_uploads.clear()
+    # Pending saves stay in the journal for the next start
+    await save_queue.stop()
+    await nutrition_rollups.close()
+    # Release the pooled backend and OpenAI connections and the image workers
+    await backend.close_client()
+    await close_openai_client()
+    shutdown_image_workers()
+    # Keep the photo analyses and chart file_ids for the next run (no-op unless PHOTO_CACHE_PATH / CHART_CACHE_PATH are set)
+    photo_cache.save()
+    chart_file_cache.save()
+    update_recorder.close()
+
+def build_application(token: str, base_url: str = None, base_file_url: str = None) -> Application:
+    """Creates the Application with all handlers; base_url/base_file_url point the bot at another Bot API server."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(token).build()
+    builder = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown)
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    # Keep outgoing messages under Telegram's flood limits and retry the ones answered with 429
+    builder = builder.rate_limiter(FloodControlRateLimiter())
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+    if PERSISTENCE_PATH:
+        # Conversation states and user data survive restarts and can be shared by several workers
+        builder = builder.persistence(StatePersistence(SQLiteStateStore(PERSISTENCE_PATH)))
+    application = builder.build()
     job_queue = application.job_queue
 
     # Add conversation handler with the states
@@ -325,20 +591,41 @@ def main() -> None:
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],  # Fallbacks to cancel command
-        allow_reentry=True
+        allow_reentry=True,
+        name="conversation",
+        persistent=bool(PERSISTENCE_PATH)
     )
 
     # Add additional handlers
-    application.add_handler(CommandHandler("pay", pay))
-    application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+    application.add_handler(CommandHandler("pay", instrument_handler(pay)))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(PreCheckoutQueryHandler(instrument_handler(precheckout_callback)))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, instrument_handler(successful_payment_callback)))
     application.add_handler(CallbackQueryHandler(handle_save_choice, pattern="^save_"))
 
     # Add the conversation handler to the application
     application.add_handler(conv_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if UPDATE_TRACE_PATH:
+        # Record incoming updates before any handler sees them, for replaying real traffic in load tests
+        application.add_handler(TypeHandler(Update, update_recorder.record), group=-1)
+
+    return application
+
+def main() -> None:
+    token = os.getenv("BOT_TOKEN")  # Load token from environment variable
+    if TELEGRAM_API_URL:
+        application = build_application(token, base_url=f"{TELEGRAM_API_URL}/bot", base_file_url=f"{TELEGRAM_API_URL}/file/bot")
+    else:
+        application = build_application(token)
+
+    # Run the bot until the user presses Ctrl-C (or the process gets SIGTERM)
+    if BOT_MODE == "webhook":
+        # Imported here, polling does not need the aiohttp server
+        from utils.webhook import run_webhook
+        asyncio.run(run_webhook(application, allowed_updates=Update.ALL_TYPES))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,38 @@
+import pytest
+
+from utils.answer_cache import AnswerCache
+from utils.routing import normalize_question
+
+DIFFERENT_QUESTIONS = [
+    ("What is the recommended daily intake of vitamin D for adults over fifty?",
+     "What is the recommended daily intake of vitamin C for adults over fifty?"),
+    ("how many calories should a 30 year old woman eat to lose weight",
+     "how many calories should a 30 year old man eat to lose weight"),
+]
+
+
+@pytest.mark.parametrize("similarity", [-1, 0.85])
+@pytest.mark.parametrize("cached, asked", DIFFERENT_QUESTIONS)
+def test_a_question_differing_in_one_word_is_not_answered_from_the_cache(cached, asked, similarity):
+    cache = AnswerCache(similarity=similarity)
+    cache.put(normalize_question(cached), "cached answer")
+
+    assert cache.get(normalize_question(asked)) is None
+    assert cache.stats()["near_hits"] == 0
+
+
+def test_exact_matches_only_by_default():
+    cache = AnswerCache()
+    cache.put(normalize_question("What is the recommended daily intake of vitamin D?"), "600 IU")
+
+    assert cache.get(normalize_question("what is the recommended daily intake of vitamin d")) == "600 IU"
+    assert cache.get(normalize_question("recommended daily intake of vitamin d")) is None
+
+
+def test_near_match_may_differ_in_function_words_only():
+    cache = AnswerCache(similarity=0.7)
+    cache.put(normalize_question("What is the recommended daily intake of vitamin D for adults over fifty?"), "800 IU")
+
+    assert cache.get(normalize_question("what recommended daily intake of vitamin D is for adults over fifty")) == "800 IU"
+    assert cache.get(normalize_question("what recommended daily intake of vitamin D is for adults over sixty")) is None
+    assert cache.stats()["near_hits"] == 1
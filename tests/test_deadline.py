@@ -0,0 +1,117 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from utils.deadline import CircuitBreaker, DeadlineCaller, is_transient
+
+MODEL = "gpt-4o"
+FALLBACK = "gpt-4o-mini"
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def api_error(cls, status_code: int):
+    return cls("error", response=httpx.Response(status_code, request=REQUEST), body=None)
+
+
+def caller_with_open_breaker() -> DeadlineCaller:
+    # The model's breaker is open and its cooldown over: the next call is its probe
+    caller = DeadlineCaller(fallback_model=FALLBACK)
+    caller._breakers[MODEL] = breaker = CircuitBreaker(cooldown=0)
+    breaker._open()
+    return caller
+
+
+@pytest.mark.parametrize("exc, transient", [
+    (TimeoutError(), True),
+    (openai.APIConnectionError(request=REQUEST), True),
+    (openai.APITimeoutError(request=REQUEST), True),
+    (api_error(openai.RateLimitError, 429), True),
+    (api_error(openai.InternalServerError, 500), True),
+    (api_error(openai.BadRequestError, 400), False),
+    (api_error(openai.AuthenticationError, 401), False),
+    (TypeError("bad on_text callback"), False),
+    (KeyError("choices"), False),
+])
+def test_only_timeouts_and_api_outages_are_transient(exc, transient):
+    assert is_transient(exc) is transient
+
+
+def test_probe_failing_with_a_non_transient_error_reopens_the_breaker():
+    caller = caller_with_open_breaker()
+
+    async def attempt(model, on_text):
+        raise api_error(openai.BadRequestError, 400)
+
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(caller.call("text", MODEL, attempt))
+    assert caller.breaker(MODEL).state == "open"
+
+
+def test_cancelled_probe_reopens_the_breaker():
+    caller = caller_with_open_breaker()
+
+    async def attempt(model, on_text):
+        await asyncio.sleep(10)
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(caller.call("text", MODEL, attempt))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_probe())
+    assert caller.breaker(MODEL).state == "open"
+
+
+def test_successful_probe_closes_the_breaker():
+    caller = caller_with_open_breaker()
+
+    async def attempt(model, on_text):
+        on_text("fine")
+        return "fine"
+
+    assert asyncio.run(caller.call("text", MODEL, attempt)) == ("fine", "primary")
+    assert caller.breaker(MODEL).state == "closed"
+
+
+def test_failed_probe_falls_back_and_reopens_the_breaker():
+    caller = caller_with_open_breaker()
+
+    async def attempt(model, on_text):
+        if model == MODEL:
+            raise api_error(openai.InternalServerError, 503)
+        return "from the fallback"
+
+    assert asyncio.run(caller.call("text", MODEL, attempt)) == ("from the fallback", "fallback")
+    assert caller.breaker(MODEL).state == "open"
+    assert caller.breaker(FALLBACK).state == "closed"
+
+
+def test_outcomes_of_calls_older_than_the_probe_do_not_settle_it():
+    breaker = CircuitBreaker(cooldown=0)
+    breaker._open()
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record(True, probe=True)
+    assert breaker.state == "closed"
+
+
+def test_callback_errors_are_raised_not_counted_against_the_model():
+    caller = DeadlineCaller(fallback_model=FALLBACK)
+
+    async def attempt(model, on_text):
+        on_text("partial")
+        return "done"
+
+    def broken_on_text(text):
+        raise TypeError("broken callback")
+
+    with pytest.raises(TypeError):
+        asyncio.run(caller.call("text", MODEL, attempt, on_text=broken_on_text))
+    assert caller.breaker(MODEL)._outcomes.count(False) == 0
+    assert caller.paths["fallback"] == 0
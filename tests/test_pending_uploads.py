@@ -0,0 +1,58 @@
+import os
+import time
+
+from utils.pending_uploads import PendingUploadStore
+
+PHOTO = b"\xff\xd8photo"
+
+
+def test_photo_is_taken_after_a_restart_or_on_another_replica(tmp_path):
+    store = PendingUploadStore(path=str(tmp_path))
+    handle = store.put(PHOTO)
+    # The first process shuts down; only the handle in the conversation state is left
+    store.clear()
+
+    replica = PendingUploadStore(path=str(tmp_path))
+    assert replica.take(handle) == PHOTO
+    assert replica.stats()["shared_takes"] == 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_photo_is_taken_once_across_replicas(tmp_path):
+    store = PendingUploadStore(path=str(tmp_path))
+    replica = PendingUploadStore(path=str(tmp_path))
+    handle = store.put(PHOTO)
+
+    assert replica.take(handle) == PHOTO
+    # The memory copy of the first process must not be saved a second time
+    assert store.take(handle) is None
+    assert store.memory_bytes == 0
+
+
+def test_photos_beyond_the_memory_budget_are_read_back_from_their_files(tmp_path):
+    store = PendingUploadStore(memory_budget=len(PHOTO) + 1, path=str(tmp_path))
+    first, second = store.put(PHOTO), store.put(PHOTO + b"2")
+
+    assert store.stats()["spilled_entries"] == 1
+    assert store.take(first) == PHOTO
+    assert store.take(second) == PHOTO + b"2"
+    assert store.memory_bytes == 0
+
+
+def test_sweep_deletes_expired_files_of_any_process(tmp_path):
+    store = PendingUploadStore(ttl=60, path=str(tmp_path))
+    fresh = store.put(PHOTO)
+    left_behind = PendingUploadStore(ttl=60, path=str(tmp_path)).put(PHOTO)
+    hour_ago = time.time() - 3600
+    os.utime(tmp_path / left_behind, (hour_ago, hour_ago))
+
+    assert store.sweep() == 1
+    assert os.listdir(tmp_path) == [fresh]
+    assert store.take(left_behind) is None
+    assert store.take(fresh) == PHOTO
+
+
+def test_unknown_or_malformed_handles_resolve_to_nothing(tmp_path):
+    store = PendingUploadStore(path=str(tmp_path))
+    assert store.take("0" * 32) is None
+    assert store.take("../../etc/passwd") is None
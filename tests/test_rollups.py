@@ -0,0 +1,138 @@
+import asyncio
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+from utils import backend, user_cache as user_cache_module
+from utils.meal import Meal
+from utils.rollups import NutritionRollups
+from utils.user_cache import UserIdCache
+
+TELEGRAM_ID = 42
+USER_ID = 7
+
+
+def meal(calories: int) -> Meal:
+    return Meal(True, [], calories, 10, 10, 10, 6, "")
+
+
+class FakeQueue:
+    """The parts of the save queue a rebuild reads: pending saves and the rows delivered ones became."""
+
+    def __init__(self):
+        self.pending = {}
+        self.delivered = {}
+
+    def pending_meals(self, telegram_id: int) -> list:
+        return [(save_id, queued_at, meal) for save_id, (queued_at, meal) in self.pending.items()]
+
+    def delivered_id(self, save_id: str):
+        return self.delivered.get(save_id)
+
+
+class FakeBackend:
+    """Food rows of one user; ``during_page`` runs inside every GET /foods/ after the page was cut."""
+
+    def __init__(self, rows: int = 0):
+        self.foods = []
+        self.during_page = None
+        for _ in range(rows):
+            self.store(100)
+
+    def store(self, calories: int) -> int:
+        self.foods.append({"id": len(self.foods) + 1, "user_id": USER_ID, "calories": calories, "carb": 10,
+                           "protein": 10, "fat": 10, "created_at": datetime.now(timezone.utc).isoformat()})
+        return self.foods[-1]["id"]
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        skip, limit = int(request.url.params["skip"]), int(request.url.params["limit"])
+        page = self.foods[skip:skip + limit]
+        if self.during_page is not None:
+            await self.during_page(skip)
+        return httpx.Response(200, json=page)
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    fake = FakeBackend(rows=3)
+    monkeypatch.setattr(backend, "_client", httpx.AsyncClient(base_url="http://backend", transport=httpx.MockTransport(fake.handle)))
+    cache = UserIdCache()
+    cache.put(TELEGRAM_ID, USER_ID)
+    monkeypatch.setattr(user_cache_module, "user_cache", cache)
+    return fake
+
+
+@pytest.fixture
+def rollups(tmp_path):
+    return NutritionRollups(str(tmp_path / "rollups.sqlite3"), page_size=2)
+
+
+def rebuild_today(rollups: NutritionRollups, queue: FakeQueue) -> dict:
+    async def run():
+        await rollups.rebuild(TELEGRAM_ID, queue)
+        summary = await rollups.summary(TELEGRAM_ID)
+        await rollups.close()
+        return summary["today"]
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("delivered_on_page", [0, 2])
+def test_save_delivered_during_the_rebuild_is_counted_once(fake_backend, rollups, delivered_on_page):
+    queue = FakeQueue()
+    queue.pending["s1"] = (datetime.now(timezone.utc).timestamp(), meal(500))
+
+    async def deliver(skip):
+        # The flush lands while the pages are read: on the last page, or too late for it
+        if skip == delivered_on_page and "s1" in queue.pending:
+            del queue.pending["s1"]
+            queue.delivered["s1"] = fake_backend.store(500)
+
+    fake_backend.during_page = deliver
+    today = rebuild_today(rollups, queue)
+    assert today["meals"] == 4
+    assert today["calories"] == 800
+
+
+def test_meals_added_during_the_rebuild_are_kept(fake_backend, rollups):
+    queue = FakeQueue()
+    now = datetime.now(timezone.utc).timestamp()
+    # Journaled before the rebuild started, its rollup add comes only while the rows are read
+    queue.pending["s1"] = (now, meal(500))
+
+    async def save_meanwhile(skip):
+        if skip == 0:
+            await rollups.add(TELEGRAM_ID, meal(500), now, save_id="s1")
+            # Saved and delivered while the rebuild runs, on the rows it reads
+            queue.delivered["s2"] = fake_backend.store(200)
+            await rollups.add(TELEGRAM_ID, meal(200), now, save_id="s2")
+            # Saved while the rebuild runs, not delivered yet
+            queue.pending["s3"] = (now, meal(50))
+            await rollups.add(TELEGRAM_ID, meal(50), now, save_id="s3")
+
+    fake_backend.during_page = save_meanwhile
+    today = rebuild_today(rollups, queue)
+    assert today["meals"] == 6
+    assert today["calories"] == 3 * 100 + 500 + 200 + 50
+
+
+def test_meals_added_during_a_failed_rebuild_are_kept(fake_backend, rollups, monkeypatch):
+    monkeypatch.setattr(backend, "BACKEND_RETRIES", 0)
+
+    async def fail(skip):
+        await rollups.add(TELEGRAM_ID, meal(500), save_id="s1")
+        raise httpx.ConnectError("backend down")
+
+    fake_backend.during_page = fail
+
+    async def run():
+        with pytest.raises(httpx.ConnectError):
+            await rollups.rebuild(TELEGRAM_ID, FakeQueue())
+        summary = await rollups.summary(TELEGRAM_ID)
+        await rollups.close()
+        return summary
+
+    summary = asyncio.run(run())
+    assert summary["today"]["meals"] == 1
+    assert not summary["rebuilt"]
@@ -0,0 +1,61 @@
+import asyncio
+import json
+
+from utils.meal import Meal
+from utils.save_queue import SaveQueue
+
+MEAL = Meal(True, [], 300, 40, 10, 8, 6, "")
+
+
+def journal_ops(path) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["op"] for line in f]
+
+
+def test_stop_waits_for_the_batch_being_sent(tmp_path):
+    path = str(tmp_path / "save_queue.jsonl")
+    stored = []
+
+    async def run():
+        sending = asyncio.Event()
+
+        async def slow_store(telegram_id, photo, meal):
+            sending.set()
+            await asyncio.sleep(0.2)
+            stored.append(telegram_id)
+            return len(stored)
+
+        queue = SaveQueue(path, flush_interval=0, store=slow_store)
+        await queue.start()
+        await queue.enqueue(1, b"photo", MEAL)
+        await sending.wait()
+        # The backend has the save by the time stop() returns, and the journal knows it
+        await queue.stop()
+
+        restarted = SaveQueue(path, store=slow_store)
+        await restarted.start()
+        pending = len(restarted)
+        await restarted.stop()
+        return pending
+
+    assert asyncio.run(run()) == 0
+    assert stored == [1]
+
+
+def test_stop_cancels_a_batch_past_the_timeout(tmp_path):
+    path = str(tmp_path / "save_queue.jsonl")
+
+    async def hanging_store(telegram_id, photo, meal):
+        await asyncio.sleep(60)
+
+    async def run():
+        queue = SaveQueue(path, flush_interval=0, store=hanging_store)
+        await queue.start()
+        await queue.enqueue(1, b"photo", MEAL)
+        await asyncio.sleep(0.05)
+        await queue.stop(timeout=0.1)
+        return len(queue)
+
+    # Not done, so still journaled for the next start
+    assert asyncio.run(run()) == 1
+    assert journal_ops(tmp_path / "save_queue.jsonl") == ["add"]
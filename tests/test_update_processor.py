@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update, User
+
+from utils.scheduler import AnalysisScheduler
+from utils.update_processor import ChatOrderedUpdateProcessor, released_slot
+
+
+def update(update_id: int, chat_id: int) -> Update:
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=Chat(id=chat_id, type=Chat.PRIVATE),
+                      from_user=User(id=chat_id, first_name="user", is_bot=False), text="tap")
+    return Update(update_id=update_id, message=message)
+
+
+def test_taps_of_other_chats_run_while_an_analysis_is_queued():
+    handled = []
+
+    async def run():
+        processor = ChatOrderedUpdateProcessor(1)
+        scheduler = AnalysisScheduler(max_concurrent=1)
+        # Another analysis holds the only slot, so the photo of chat 1 has to queue
+        await scheduler.acquire("busy")
+
+        async def analyse(chat_id):
+            async with scheduler.slot(chat_id, while_queued=released_slot):
+                handled.append(("photo", chat_id))
+
+        async def tap(chat_id):
+            handled.append(("tap", chat_id))
+
+        photo = asyncio.create_task(processor.do_process_update(update(1, 1), analyse(1)))
+        same_chat = asyncio.create_task(processor.do_process_update(update(2, 1), tap(1)))
+        other_chat = asyncio.create_task(processor.do_process_update(update(3, 2), tap(2)))
+        # The only running slot is free while the photo waits for its turn
+        await asyncio.wait_for(other_chat, 1)
+        assert handled == [("tap", 2)]
+
+        scheduler.release()
+        await asyncio.wait_for(asyncio.gather(photo, same_chat), 1)
+        return processor._slots._value
+
+    assert asyncio.run(run()) == 1
+    # Chat 1's tap still waits for its photo
+    assert handled == [("tap", 2), ("photo", 1), ("tap", 1)]
+
+
+def test_tasks_created_by_a_handler_do_not_give_its_slot_away():
+    async def run():
+        processor = ChatOrderedUpdateProcessor(1)
+
+        async def spawned():
+            async with released_slot():
+                return processor._slots.locked()
+
+        locked = []
+
+        async def handler():
+            # The task copies the handler's context, the running slot included
+            locked.append(await asyncio.create_task(spawned()))
+
+        await processor.do_process_update(update(1, 1), handler())
+        return locked
+
+    assert asyncio.run(run()) == [True]
@@ -0,0 +1,144 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import main
+from utils import backend, save_food_to_db, user_cache as user_cache_module
+from utils.meal import Meal
+from utils.user_cache import UserIdCache
+
+TELEGRAM_ID = 42
+MEAL = Meal(True, [{"name": "toast", "emoji": "🍞"}], 300, 40, 10, 8, 6, "")
+
+
+class FakeBackend:
+    """Users and food rows of the backend, behind an httpx.MockTransport that logs every request."""
+
+    def __init__(self):
+        self.users = {}
+        self.foods = []
+        self.requests = []
+
+    def add_user(self, telegram_id: int, name: str = "alice") -> dict:
+        user = {"id": len(self.users) + 1, "name": name, "telegram_id": telegram_id}
+        self.users[telegram_id] = user
+        return user
+
+    def count(self, method: str, path: str) -> int:
+        return sum(1 for request in self.requests if request.method == method and request.url.path == path)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        params = request.url.params
+        if request.url.path == "/users/" and request.method == "GET":
+            if "telegram_id" in params:
+                matches = [user for user in self.users.values() if user["telegram_id"] == int(params["telegram_id"])]
+            else:
+                matches = [user for user in self.users.values() if user["name"] == params["name"]]
+            return httpx.Response(200, json=matches) if matches else httpx.Response(404, json={"detail": "not found"})
+        if request.url.path == "/users/" and request.method == "POST":
+            payload = json.loads(request.content)
+            return httpx.Response(201, json=self.add_user(payload["telegram_id"], payload["name"]))
+        if request.url.path == "/foods/" and request.method == "POST":
+            food = json.loads(request.content)
+            if food["user_id"] not in {user["id"] for user in self.users.values()}:
+                return httpx.Response(404, json={"detail": "user not found"})
+            self.foods.append(dict(food, id=len(self.foods) + 1))
+            return httpx.Response(201, json=self.foods[-1])
+        return httpx.Response(404, json={"detail": "not found"})
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    fake = FakeBackend()
+    monkeypatch.setattr(backend, "_client", httpx.AsyncClient(base_url="http://backend", transport=httpx.MockTransport(fake.handle)))
+    return fake
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    # A fresh cache in every module holding the singleton
+    cache = UserIdCache(max_entries=100, ttl=3600)
+    for module in (user_cache_module, save_food_to_db, main):
+        monkeypatch.setattr(module, "user_cache", cache)
+    return cache
+
+
+def start_update(telegram_id: int, username: str):
+    async def reply_text(*args, **kwargs):
+        pass
+
+    message = SimpleNamespace(from_user=SimpleNamespace(id=telegram_id, username=username), reply_text=reply_text)
+    return SimpleNamespace(message=message), SimpleNamespace(user_data={})
+
+
+def test_saves_look_the_user_up_once(fake_backend, cache):
+    fake_backend.add_user(TELEGRAM_ID)
+
+    async def save_three_meals():
+        return [await save_food_to_db.write_food_photo_to_db(TELEGRAM_ID, b"photo", MEAL) for _ in range(3)]
+
+    assert asyncio.run(save_three_meals()) == [1, 2, 3]
+    assert fake_backend.count("GET", "/users/") == 1
+    assert fake_backend.count("POST", "/foods/") == 3
+
+
+def test_repeat_start_skips_the_lookup(fake_backend, cache):
+    async def start_twice_and_save():
+        for _ in range(2):
+            await main.start(*start_update(TELEGRAM_ID, "bob"))
+        return await save_food_to_db.write_food_photo_to_db(TELEGRAM_ID, b"photo", MEAL)
+
+    assert asyncio.run(start_twice_and_save()) == 1
+    # The first /start looks the name up and creates the user; the second and the save use the cached id
+    assert fake_backend.count("GET", "/users/") == 1
+    assert fake_backend.count("POST", "/users/") == 1
+    assert cache.get(TELEGRAM_ID) == fake_backend.users[TELEGRAM_ID]["id"]
+
+
+def test_stale_user_id_is_invalidated_on_404(fake_backend, cache):
+    user = fake_backend.add_user(TELEGRAM_ID)
+    cache.put(TELEGRAM_ID, 999)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(save_food_to_db.write_food_photo_to_db(TELEGRAM_ID, b"photo", MEAL))
+    assert TELEGRAM_ID not in cache
+    assert cache.stats()["invalidations"] == 1
+
+    # The retry of the save looks the user up again and stores the meal
+    assert asyncio.run(save_food_to_db.write_food_photo_to_db(TELEGRAM_ID, b"photo", MEAL)) == 1
+    assert fake_backend.count("GET", "/users/") == 1
+    assert cache.get(TELEGRAM_ID) == user["id"]
+
+
+def test_entries_expire_and_least_recently_used_are_evicted():
+    now = [1000.0]
+    cache = UserIdCache(max_entries=2, ttl=60)
+    cache.clock = lambda: now[0]
+
+    cache.put(1, 10)
+    cache.put(2, 20)
+    assert cache.get(1) == 10
+    cache.put(3, 30)
+    # 2 was used least recently
+    assert cache.get(2) is None
+    assert cache.get(1) == 10
+
+    now[0] += 61
+    assert cache.get(1) is None
+    assert cache.get(3) is None
+    assert len(cache) == 0
+
+
+def test_stats_hit_rate():
+    cache = UserIdCache(max_entries=10, ttl=60)
+    cache.put(1, 10)
+    for telegram_id in (1, 1, 1, 2):
+        cache.get(telegram_id)
+    cache.invalidate(1)
+    cache.invalidate(1)
+
+    assert cache.stats() == {"entries": 0, "hits": 3, "misses": 1, "invalidations": 1, "hit_rate": 0.75}
@@ -1 +1,13 @@
-from .gpt4 import *
\ No newline at end of file
+# The OpenAI helpers of utils.gpt4 are loaded on first access (PEP 562), so importing a submodule
+# such as utils.metrics does not load the whole analysis stack
+_GPT4_NAMES = {
+    "getPhotoResponse", "getAlbumResponse", "getTextResponse", "getSummaryResponse", "escape_markdown_v2",
+    "get_openai_client", "close_openai_client", "preload_openai", "create_chat_completion", "stream_chat_completion",
+}
+
+
+def __getattr__(name):
+    if name in _GPT4_NAMES:
+        from . import gpt4
+        return getattr(gpt4, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
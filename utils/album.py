@@ -0,0 +1,59 @@
+# album.py
+
+import asyncio
+import os
+
+from telegram import Message
+
+# Seconds without a new photo after which an album is considered complete, and the most photos
+# analyzed together (Telegram albums hold at most 10)
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))
+ALBUM_MAX_PHOTOS = int(os.getenv("ALBUM_MAX_PHOTOS", "10"))
+
+
+class AlbumCollector:
+    """Gathers the messages of a media group, which Telegram delivers as separate updates.
+
+    ``add`` returns True for the first message of an album; whoever got True then awaits
+    ``collect``, which returns all messages once none arrived for ``window`` seconds.
+    """
+
+    def __init__(self, window: float = ALBUM_WINDOW):
+        self.window = window
+        # media_group_id -> [messages, loop time of the last arrival]
+        self._albums = {}
+        self.albums = 0
+        self.photos = 0
+
+    def add(self, message: Message) -> bool:
+        now = asyncio.get_running_loop().time()
+        self.photos += 1
+        album = self._albums.get(message.media_group_id)
+        if album is not None:
+            album[0].append(message)
+            album[1] = now
+            return False
+        self._albums[message.media_group_id] = [[message], now]
+        self.albums += 1
+        return True
+
+    async def collect(self, media_group_id: str) -> list:
+        loop = asyncio.get_running_loop()
+        while True:
+            messages, last = self._albums[media_group_id]
+            remaining = last + self.window - loop.time()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        del self._albums[media_group_id]
+        return sorted(messages, key=lambda message: message.message_id)
+
+    def stats(self) -> dict:
+        return {
+            "albums": self.albums,
+            "photos": self.photos,
+            "collecting": len(self._albums),
+        }
+
+
+album_collector = AlbumCollector()
@@ -0,0 +1,121 @@
+# answer_cache.py
+
+import hashlib
+import math
+import os
+
+from .lru import LRUCache
+
+# Answers kept, their lifetime in seconds and the cosine similarity of two questions' local
+# embeddings (hashed words and word pairs) from which they are answered alike (-1 = only equal
+# normalized questions). Even then the questions must share every content word and number: one
+# word ("vitamin c" vs "vitamin d", "woman" vs "man") changes the answer while barely moving the
+# similarity. Questions shorter than ANSWER_CACHE_MIN_WORDS only match exactly.
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "-1"))
+ANSWER_CACHE_MIN_WORDS = 4
+
+# Words a near match may add, drop or reorder; negations, modals and single letters are content
+FUNCTION_WORDS = frozenset({
+    "the", "an", "is", "are", "was", "were", "be", "am", "do", "does", "did", "of", "for", "to",
+    "in", "on", "at", "please", "me", "my", "tell", "so", "um", "uh",
+})
+
+EMBEDDING_DIMENSIONS = 1 << 16
+
+
+def embed(normalized: str) -> dict:
+    """Sparse unit vector of a normalized question: its words and word pairs, hashed."""
+    words = normalized.split()
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    vector = {}
+    for feature in features:
+        index = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=4).digest(), "little")
+        index %= EMBEDDING_DIMENSIONS
+        vector[index] = vector.get(index, 0.0) + 1.0
+    norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+    return {index: value / norm for index, value in vector.items()}
+
+
+def content_words(normalized: str) -> frozenset:
+    return frozenset(word for word in normalized.split() if word not in FUNCTION_WORDS)
+
+
+class AnswerCache(LRUCache):
+    """LRU/TTL cache of answers to context-free questions, keyed by normalized text.
+
+    Each entry remembers what producing it cost (estimated USD and seconds), so hits add up to
+    the cost and latency the cache saved.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        # normalized question -> (embedding, answer, cost, seconds)
+        super().__init__(max_entries, ttl)
+        self.similarity = similarity
+        # embedding dimension -> {normalized question: weight}; a lookup only visits questions sharing a feature
+        self._postings = {}
+        self.cost_saved = 0.0
+        self.seconds_saved = 0.0
+
+    def _find_similar(self, normalized: str):
+        if self.similarity < 0 or len(normalized.split()) < ANSWER_CACHE_MIN_WORDS:
+            return None
+        # Cosine similarities with every question sharing a feature, accumulated feature by feature
+        similarities = {}
+        for index, value in embed(normalized).items():
+            for key, weight in self._postings.get(index, {}).items():
+                similarities[key] = similarities.get(key, 0.0) + value * weight
+        words = content_words(normalized)
+        for key in sorted(similarities, key=similarities.get, reverse=True):
+            if similarities[key] < self.similarity:
+                break
+            if content_words(key) == words:
+                return key
+        return None
+
+    def _remove(self, normalized: str):
+        entry = super()._remove(normalized)
+        for index in entry[0] or ():
+            postings = self._postings[index]
+            del postings[normalized]
+            if not postings:
+                del self._postings[index]
+        return entry
+
+    def get(self, normalized: str):
+        exact = normalized in self
+        key = normalized if exact else self._find_similar(normalized)
+        entry = None if key is None else self.peek(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        _, answer, cost, seconds = entry
+        if exact:
+            self.hits += 1
+        else:
+            self.near_hits += 1
+        self.cost_saved += cost
+        self.seconds_saved += seconds
+        return answer
+
+    def put(self, normalized: str, answer: str, cost: float = 0.0, seconds: float = 0.0) -> None:
+        # Short questions are only matched exactly, they need no embedding
+        vector = embed(normalized) if len(normalized.split()) >= ANSWER_CACHE_MIN_WORDS else None
+        if normalized in self:
+            self._remove(normalized)
+        for index, weight in (vector or {}).items():
+            self._postings.setdefault(index, {})[normalized] = weight
+        super().put(normalized, (vector, answer, cost, seconds))
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "near_hits": self.near_hits,
+            "cost_saved_usd": self.cost_saved,
+            "seconds_saved": self.seconds_saved,
+        }
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,114 @@
+# backend.py
+
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+API_BASE_URL = os.getenv("API_BASE_URL", "https://lipo-out-backend-production.up.railway.app")  # Adjust this URL to your backend
+
+# Per-call timeout (seconds) and retry policy for backend requests
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", "10"))
+BACKEND_RETRIES = int(os.getenv("BACKEND_RETRIES", "3"))
+BACKEND_BACKOFF = float(os.getenv("BACKEND_BACKOFF", "0.5"))
+
+# Connection pool shared by every handler
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "100"))
+BACKEND_MAX_KEEPALIVE = int(os.getenv("BACKEND_MAX_KEEPALIVE", "20"))
+
+# Gateway errors from Railway are worth another attempt for idempotent methods, anything else is returned as is
+RETRY_STATUS_CODES = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE"}
+
+_client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    # One pooled keep-alive client per process, created lazily inside the running loop
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=API_BASE_URL,
+            timeout=httpx.Timeout(BACKEND_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=BACKEND_MAX_CONNECTIONS,
+                max_keepalive_connections=BACKEND_MAX_KEEPALIVE,
+                keepalive_expiry=30,
+            ),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _should_retry(method: str, exc: httpx.TransportError) -> bool:
+    # A POST is only safe to resend if it never reached the backend
+    if method in IDEMPOTENT_METHODS:
+        return True
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+async def request(method: str, path: str, *, timeout: float = None, retries: int = None, **kwargs) -> httpx.Response:
+    """Sends a request to the backend, retrying transient failures with exponential backoff."""
+    method = method.upper()
+    retries = BACKEND_RETRIES if retries is None else retries
+    client = get_client()
+
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = await client.request(
+                method, path,
+                timeout=httpx.USE_CLIENT_DEFAULT if timeout is None else timeout,
+                **kwargs
+            )
+        except httpx.TransportError as exc:
+            metrics.inc("backend_errors_total", method=method, path=path, error=type(exc).__name__)
+            if attempt == retries or not _should_retry(method, exc):
+                raise
+            logger.warning("Backend %s %s failed (%r), retrying", method, path, exc)
+        else:
+            metrics.observe("backend_request_seconds", time.perf_counter() - start, method=method, path=path)
+            metrics.inc("backend_responses_total", method=method, path=path, status=response.status_code)
+            # A gateway error may arrive after the backend committed a POST, resending it would duplicate the row
+            if response.status_code not in RETRY_STATUS_CODES or method not in IDEMPOTENT_METHODS or attempt == retries:
+                return response
+            logger.warning("Backend %s %s returned %s, retrying", method, path, response.status_code)
+
+        await asyncio.sleep(BACKEND_BACKOFF * 2 ** attempt)
+
+
+async def get_user_by_name(name: str) -> httpx.Response:
+    return await request("GET", "/users/", params={"name": name})
+
+
+async def get_user_by_telegram_id(telegram_id: int) -> httpx.Response:
+    return await request("GET", "/users/", params={"telegram_id": telegram_id})
+
+
+async def create_user(user_data: dict) -> httpx.Response:
+    return await request("POST", "/users/", json=user_data)
+
+
+async def update_user(telegram_id: int, update_data: dict) -> httpx.Response:
+    return await request("PATCH", "/users/", params={"telegram_id": telegram_id}, json=update_data)
+
+
+async def create_food(food_data: dict) -> httpx.Response:
+    return await request("POST", "/foods/", json=food_data)
+
+
+async def list_foods(user_id: int, skip: int, limit: int) -> httpx.Response:
+    # One page of a user's food rows; the macros are all a rebuild of the totals needs, not the photos
+    return await request("GET", "/foods/", params={"user_id": user_id, "skip": skip, "limit": limit, "include_photo": "false"})
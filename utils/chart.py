@@ -1,138 +1,205 @@
+import asyncio
 import io
-import re
-import matplotlib.pyplot as plt
-import base64
-import numpy as np
-
-def extract_nutrition_data(response_text: str) -> dict:
-    # Initializing the nutrition data dictionary
-    data = {
-        "calories": 0,
-        "carbohydrates": 0,
-        "protein": 0,
-        "fats": 0
-    }
-    
-    # Regex patterns to capture the nutritional values with potential whitespace variations
-    calorie_pattern = re.compile(r"Total calories.*?([\d{1,3}(,\d{3})*]+\.?\d*)\s*kcal")
-    carb_pattern = re.compile(r"Total carbohydrates.*?(\d+\.?\d*)\s*grams")
-    protein_pattern = re.compile(r"Total protein.*?(\d+\.?\d*)\s*grams")
-    fat_pattern = re.compile(r"Total fats.*?(\d+\.?\d*)\s*grams")
-
-    # Find the calorie valuefats
-    match = calorie_pattern.search(response_text)
-    if match:
-        # Remove commas and convert the number to float
-        data["calories"] = float(match.group(1).replace(',', ''))
-    # Find the carbohydrate value
-    match = carb_pattern.search(response_text)
-    if match:
-        data["carbohydrates"] = float(match.group(1))
-
-    # Find the protein value
-    match = protein_pattern.search(response_text)
-    if match:
-        data["protein"] = float(match.group(1))
-
-    # Find the fat value
-    match = fat_pattern.search(response_text)
-    if match:
-        data["fats"] = float(match.group(1))
-
-    return data
-
-def create_nutrition_chart(data: dict) -> str:
-    # Define the data for the pie chart
-    labels = ['Carbs', 'Protein', 'Fats']
-    sizes = [data['carbohydrates'], data['protein'], data['fats']]  # gram values
-    colors = ['#ffcc00', '#ff6666', '#66b3ff']  # Colors for pie chart
-    explode = (0.1, 0.1, 0.1)  # Exploding the slices to enhance the 3D effect
-
-    # Total calories (sum of the sizes for simplicity)
-    total_calories = data["calories"]
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PIL import Image
+from .metrics import metrics
+
+BACKGROUND_COLOR = '#2e3b4e'
+MACROS = [('CARBS', 'carbohydrates'), ('PROTEIN', 'protein'), ('FATS', 'fats')]
+COLORS = ['#ffcc00', '#ff6666', '#66b3ff']  # Colors for pie chart
+EXPLODE = (0.1, 0.1, 0.1)  # Exploding the slices to enhance the 3D effect
+LABEL_ROWS = [0.5, 0, -0.5]  # Heading heights of the labels left of the pie, values go 0.15 below
+
+# Charts are rendered on a small thread pool; each thread keeps its own figure because
+# matplotlib artists must not be shared between threads. matplotlib itself is imported by the
+# first chart (or warm_up_chart_renderer), it takes most of a second.
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))
+_executor = ThreadPoolExecutor(max_workers=CHART_WORKERS, thread_name_prefix="chart")
+_local = threading.local()
+
+
+class _ChartLayout:
+    """Per-thread figure holding the static parts of the nutrition chart.
+
+    The background, axes setup and macro headings are drawn once and kept as an Agg
+    snapshot; every chart restores that snapshot and only draws the wedges and values.
+    """
+
+    def __init__(self):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.figure = Figure(facecolor=BACKGROUND_COLOR)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.subplots()
+        self.ax.set(frame_on=False, xticks=[], yticks=[], xlim=(-1.25, 1.25), ylim=(-1.25, 1.25))
+        # Set the aspect ratio to be equal, so the pie chart is a circle
+        self.ax.set_aspect('equal')
+
+        # Add custom labels to the left of the pie chart
+        for (label, _), color, y in zip(MACROS, COLORS, LABEL_ROWS):
+            self.ax.text(-1.95, y, label, fontsize=14, fontweight='bold', color=color, ha='left')
+
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    def render(self, sizes: list, total_calories) -> bytes:
+        ax = self.ax
+        patches_before = len(ax.patches)
+
+        # Create the pie chart with a shadow effect
+        wedges, _ = ax.pie(sizes, explode=EXPLODE, colors=COLORS, startangle=140, shadow=True)
+        dynamic = list(ax.patches[patches_before:])
+
+        # Add the gram values under each heading
+        for size, color, y in zip(sizes, COLORS, LABEL_ROWS):
+            dynamic.append(ax.text(-1.95, y - 0.15, f"{size}g", fontsize=18, fontweight='bold', color=color, ha='left'))
+
+        # Calculate total grams to determine percentages
+        total_grams = sum(sizes)
+
+        # Calculate the position (x, y) for each wedge's centroid and add percentage values inside the pie chart
+        for wedge, size in zip(wedges, sizes):
+            # Angle for the center of each wedge
+            angle = math.radians((wedge.theta2 + wedge.theta1) / 2)
+
+            # Compute the x and y position for the text (slightly inward from the wedge center)
+            x = math.cos(angle) * 0.7  # 0.7 scales the distance to center the text
+            y = math.sin(angle) * 0.7
+
+            # Add the percentage inside the wedges
+            percentage = (size / total_grams) * 100
+            dynamic.append(ax.text(x, y, f'{percentage:.1f}%', ha='center', va='center', fontsize=14, color='white', fontweight='bold'))
+
+        # Add total calories at the top of the figure
+        dynamic.append(ax.text(0, 1.3, f'{total_calories} Cal', ha='center', va='center', fontsize=20, fontweight='bold', color='white'))
+
+        # Restore the cached background and draw only what changed, shadows first
+        self.canvas.restore_region(self.background)
+        dynamic.sort(key=lambda artist: artist.get_zorder())
+        for artist in dynamic:
+            ax.draw_artist(artist)
+        png = _encode_png(self.canvas)
+
+        # Leave the figure as it was for the next chart rendered on this thread
+        for artist in dynamic:
+            artist.remove()
+        return png
+
+
+def _encode_png(canvas) -> bytes:
+    width, height = canvas.get_width_height()
+    image = Image.frombuffer("RGBA", (width, height), canvas.buffer_rgba(), "raw", "RGBA", 0, 1)
+    with metrics.timer("bot_stage_seconds", stage="png_encode"), io.BytesIO() as buf:
+        image.save(buf, format='PNG')
+        return buf.getvalue()
+
+
+def _get_layout() -> _ChartLayout:
+    layout = getattr(_local, "layout", None)
+    if layout is None:
+        layout = _local.layout = _ChartLayout()
+    return layout
+
+
+@lru_cache(maxsize=1)
+def _healthy_chart_png() -> bytes:
+    # Congratulatory image when the diet is very healthy (no macronutrients); it never changes
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(facecolor=BACKGROUND_COLOR)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots()
+
+    # Display motivational message
+    ax.text(0.5, 0.5, "Your diet is really healthy!\nKeep it on!",
+            ha='center', va='center', fontsize=24, fontweight='bold', color='white')
+    ax.set_axis_off()  # Hide the axis
+
+    canvas.draw()
+    return _encode_png(canvas)
+
+
+def chart_key(data: dict) -> tuple:
+    """Rounded (calories, carbs, protein, fats) a chart is drawn from; equal keys give identical charts."""
+    sizes = tuple(round(data[key]) for _, key in MACROS)
+    if not any(sizes):
+        # The congratulatory image does not show the calories
+        return (0, 0, 0, 0)
+    return (round(data["calories"]),) + sizes
+
+
+def create_nutrition_chart(data: dict) -> bytes:
+    # Whole calories and gram values of the pie chart slices
+    calories, *sizes = chart_key(data)
 
     # Check if all sizes are zero (no carbs, fats, or protein)
     if sum(sizes) == 0:
-        # Create a congratulatory image when the diet is very healthy (no macronutrients)
-        fig, ax = plt.subplots()
-        fig.patch.set_facecolor('#2e3b4e')  # Set background color
-        
-        # Display motivational message
-        ax.text(0.5, 0.5, "Your diet is really healthy!\nKeep it on!", 
-                ha='center', va='center', fontsize=24, fontweight='bold', color='white')
-        ax.set_axis_off()  # Hide the axis
-        
-        # Save image to a buffer and return it as base64
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-        buf.close()
-
-        return img_base64
-
-    # Proceed with normal pie chart generation
-    fig, ax = plt.subplots()
-    fig.patch.set_facecolor('#2e3b4e')  # Set background color
-
-    # Create the pie chart with a shadow effect
-    wedges, texts, autotexts = ax.pie(sizes, explode=explode, labels=labels, colors=colors,
-                                      autopct='%1.1f%%', startangle=140, shadow=True)
-
-    # Set the percentage colors to match the pie chart slice colors
-    for i, autotext in enumerate(autotexts):
-        autotext.set_color(colors[i])
-
-    # Remove labels from pie chart itself
-    for text in texts:
-        text.set_text("")
-
-    # Add custom labels to the left of the pie chart
-    ax.text(-1.95, 0.5, "CARBS", fontsize=14, fontweight='bold', color=colors[0], ha='left')
-    ax.text(-1.95, 0.35, f"{sizes[0]}g", fontsize=18, fontweight='bold', color=colors[0], ha='left')
-
-    ax.text(-1.95, 0, "PROTEIN", fontsize=14, fontweight='bold', color=colors[1], ha='left')
-    ax.text(-1.95, -0.15, f"{sizes[1]}g", fontsize=18, fontweight='bold', color=colors[1], ha='left')
-
-    ax.text(-1.95, -0.5, "FATS", fontsize=14, fontweight='bold', color=colors[2], ha='left')
-    ax.text(-1.95, -0.65, f"{sizes[2]}g", fontsize=18, fontweight='bold', color=colors[2], ha='left')
-
-    # Calculate total grams to determine percentages
-    total_grams = sum(sizes)
-
-    # Calculate the position (x, y) for each wedge's centroid and add percentage values inside the pie chart
-    for i, (wedge, size) in enumerate(zip(wedges, sizes)):
-        # Angle for the center of each wedge
-        angle = (wedge.theta2 + wedge.theta1) / 2
-
-        # Compute the x and y position for the text (slightly inward from the wedge center)
-        x = np.cos(np.radians(angle)) * 0.7  # 0.7 scales the distance to center the text
-        y = np.sin(np.radians(angle)) * 0.7
-
-        # Calculate the percentage for the current slice
-        percentage = (size / total_grams) * 100
-
-        # Add the percentage inside the wedges
-        ax.text(x, y, f'{percentage:.1f}%', ha='center', va='center', fontsize=14, color='white', fontweight='bold')
-
-    # Add total calories at the top of the figure
-    ax.text(0, 1.3, f'{total_calories} Cal', ha='center', va='center', fontsize=20, fontweight='bold', color='white')
-
-    # Set the aspect ratio to be equal, so the pie chart is a circle
-    ax.set_aspect('equal')
-
-    # Convert plot to PNG image and encode to base64
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-    buf.close()
-
-    return img_base64
-
-def is_food(text: str) -> bool:
-    # Check if the specified phrase is in the text
-    if "Food Rating" in text:
-        return True
+        png = _healthy_chart_png()
     else:
-        return False
+        png = _get_layout().render(sizes, calories)
+
+    # Raw PNG bytes, ready to be uploaded as is
+    return png
+
+
+async def render_nutrition_chart(data: dict) -> bytes:
+    # Agg rendering is CPU bound, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    with metrics.timer("bot_stage_seconds", stage="chart_render"):
+        return await loop.run_in_executor(_executor, create_nutrition_chart, data)
+
+
+def create_trend_chart(days: list) -> bytes:
+    # Macro grams per day stacked in the colors of the nutrition chart, calories above each bar
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    # Trend charts are rare, each gets its own figure instead of a cached per-thread layout
+    fig = Figure(figsize=(8, 4.5), facecolor=BACKGROUND_COLOR)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.set_facecolor(BACKGROUND_COLOR)
+
+    positions = range(len(days))
+    bottoms = [0.0] * len(days)
+    for (label, _), color, key in zip(MACROS, COLORS, ("carbs", "protein", "fat")):
+        grams = [day[key] for day in days]
+        ax.bar(positions, grams, bottom=bottoms, color=color, label=label, width=0.7)
+        bottoms = [bottom + value for bottom, value in zip(bottoms, grams)]
+
+    top = max(bottoms) or 1
+    for position, bottom, day in zip(positions, bottoms, days):
+        if day["meals"]:
+            ax.text(position, bottom + top * 0.02, f"{round(day['calories'])}", ha='center', va='bottom',
+                    fontsize=8, color='white')
+
+    ax.set_ylim(0, top * 1.15)
+    ax.set_xticks(list(positions), [day["day"][8:] for day in days], color='white', fontsize=9)
+    ax.tick_params(axis='y', colors='white', labelsize=9)
+    ax.set_ylabel("grams", color='white')
+    for side in ("top", "right"):
+        ax.spines[side].set_visible(False)
+    for side in ("left", "bottom"):
+        ax.spines[side].set_color('white')
+    ax.set_title(f"Last {len(days)} days (Cal above the bars)", color='white', fontsize=14, fontweight='bold')
+    ax.legend(loc='upper left', frameon=False, labelcolor='white', ncol=3)
+
+    canvas.draw()
+    return _encode_png(canvas)
+
+
+async def render_trend_chart(days: list) -> bytes:
+    loop = asyncio.get_running_loop()
+    with metrics.timer("bot_stage_seconds", stage="trend_chart_render"):
+        return await loop.run_in_executor(_executor, create_trend_chart, days)
+
+
+def warm_up_chart_renderer() -> list:
+    # Import matplotlib and build the layout of every worker thread ahead of the first request
+    return [_executor.submit(_get_layout) for _ in range(CHART_WORKERS)]
@@ -0,0 +1,53 @@
+# chart_cache.py
+
+import json
+import logging
+import os
+
+from .lru import LRUCache, replace_file
+
+logger = logging.getLogger(__name__)
+
+# Charts remembered (LRU) and an optional file the cache is saved to on shutdown
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "4096"))
+CHART_CACHE_PATH = os.getenv("CHART_CACHE_PATH", "")
+
+
+class ChartFileCache(LRUCache):
+    """Telegram file_ids of charts already uploaded, keyed by chart.chart_key().
+
+    A chart whose key is known is sent by file_id: no rendering and no upload.
+    """
+
+    def __init__(self, max_entries: int = CHART_CACHE_SIZE, path: str = CHART_CACHE_PATH):
+        # file_ids stay valid on Telegram's side, entries never expire
+        super().__init__(max_entries)
+        self.path = path
+        self.uploads = 0
+        if path:
+            self.load()
+
+    def put(self, key: tuple, file_id: str) -> None:
+        super().put(key, file_id)
+        self.uploads += 1
+
+    def stats(self) -> dict:
+        return {**super().stats(), "uploads": self.uploads}
+
+    def load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception:
+            logger.exception("Could not load the chart cache from %s", self.path)
+            return
+        self.restore((tuple(key), None, file_id) for key, file_id in entries)
+
+    def save(self) -> None:
+        if self.path:
+            replace_file(self.path, json.dumps([[list(key), file_id] for key, file_id in self.items()]).encode())
+
+
+chart_file_cache = ChartFileCache()
@@ -0,0 +1,328 @@
+# deadline.py
+
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Time budgets (seconds) of the answers users wait for: until the first streamed token, and
+# until the answer is complete. A model that misses the first one is given up for the fallback
+# model, which gets whatever is left of the second.
+PHOTO_FIRST_TOKEN_TIMEOUT = float(os.getenv("PHOTO_FIRST_TOKEN_TIMEOUT", "12"))
+PHOTO_DEADLINE = float(os.getenv("PHOTO_DEADLINE", "45"))
+TEXT_FIRST_TOKEN_TIMEOUT = float(os.getenv("TEXT_FIRST_TOKEN_TIMEOUT", "8"))
+TEXT_DEADLINE = float(os.getenv("TEXT_DEADLINE", "30"))
+
+# Faster model answering when the requested one is too slow, failing or switched off by its breaker
+OPENAI_FALLBACK_MODEL = os.getenv("OPENAI_FALLBACK_MODEL", "gpt-4o-mini")
+
+# Hedging (1 = on): when a request has no first token after the HEDGE_QUANTILE of the recent
+# first-token times of its model, an identical second request is sent and the first one to
+# stream wins. Hedges cost tokens, at most OPENAI_HEDGE_MAX_RATIO of the requests get one.
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "0") == "1"
+OPENAI_HEDGE_QUANTILE = float(os.getenv("OPENAI_HEDGE_QUANTILE", "0.95"))
+OPENAI_HEDGE_MAX_RATIO = float(os.getenv("OPENAI_HEDGE_MAX_RATIO", "0.1"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.5
+
+# Circuit breaker per model: of its last BREAKER_WINDOW calls, at least BREAKER_MIN_CALLS made and
+# BREAKER_ERROR_RATE failed or timed out opens it; requests then go to the fallback model at once
+# until BREAKER_COOLDOWN seconds later a single probe request may try the model again.
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+
+@dataclass(frozen=True)
+class Budget:
+    first_token: float
+    total: float
+
+
+BUDGETS = {
+    "photo": Budget(PHOTO_FIRST_TOKEN_TIMEOUT, PHOTO_DEADLINE),
+    "text": Budget(TEXT_FIRST_TOKEN_TIMEOUT, TEXT_DEADLINE),
+}
+
+
+class ModelUnavailable(Exception):
+    """Neither the requested model nor the fallback answered within the deadline."""
+
+
+def is_transient(exc: BaseException) -> bool:
+    # Timeouts, connection errors, 429 and 5xx of the API; anything else (a 400, a bug in an
+    # on_text callback, ...) would fail on any model and is not the model's fault
+    if isinstance(exc, TimeoutError):
+        return True
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+    return isinstance(exc, (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError))
+
+
+class CircuitBreaker:
+    """Closed, open or half-open (one probe in flight) circuit of one model."""
+
+    def __init__(self, window: int = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 error_rate: float = BREAKER_ERROR_RATE, cooldown: float = BREAKER_COOLDOWN):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self._outcomes = deque(maxlen=window)
+        self.state = "closed"
+        self._opened_at = 0.0
+        self.opened = 0
+
+    def allow(self) -> bool:
+        """Whether a call may go to the model; the call that turns the breaker half-open is its probe."""
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+            self.state = "half_open"
+            return True
+        return self.state == "closed"
+
+    def record(self, ok: bool, probe: bool = False) -> None:
+        if self.state != "closed":
+            # Only the probe decides a half-open breaker; calls started before it opened do not count
+            if probe and self.state == "half_open":
+                if ok:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._open()
+            return
+        self._outcomes.append(ok)
+        failures = self._outcomes.count(False)
+        if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+            self._open()
+
+    def release(self, probe: bool) -> None:
+        # A probe that ended without an outcome (cancelled, or an error not held against the model)
+        # must not leave the breaker half-open, where it lets no call through
+        if probe and self.state == "half_open":
+            self._open()
+
+    def _open(self) -> None:
+        if self.state == "half_open":
+            self.opened += 1
+            logger.warning("Circuit breaker probe did not succeed, open for another %gs", self.cooldown)
+        elif self.state != "open":
+            self.opened += 1
+            logger.warning("Circuit breaker opened after %d failures in %d calls",
+                           self._outcomes.count(False), len(self._outcomes))
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+
+class _Attempt:
+    """One streamed request; ``first_token`` is set when its first text arrives."""
+
+    def __init__(self, path: str, model: str, probe: bool):
+        self.path = path
+        self.model = model
+        # Probe of the model's half-open breaker
+        self.probe = probe
+        self.started = time.monotonic()
+        self.first_token = asyncio.Event()
+        self.task = None
+
+
+class DeadlineCaller:
+    """Runs streamed completions under a time budget, with hedging, model fallback and circuit breakers.
+
+    ``call(kind, model, attempt)`` streams through ``attempt(model, on_text)`` and returns the
+    text and the path that served it: "primary", "hedge" (the hedged duplicate was faster) or
+    "fallback". Text of an attempt only reaches ``on_text`` once it won; ``on_restart()`` is called
+    before the fallback starts, so partial output of the given up attempt can be dropped.
+    """
+
+    def __init__(self, fallback_model: str = OPENAI_FALLBACK_MODEL, hedge: bool = OPENAI_HEDGE):
+        self.fallback_model = fallback_model
+        self.hedge = hedge
+        self._breakers = {}
+        # model -> recent seconds until the first token, for the hedge delay
+        self._first_token_times = {}
+        self.paths = Counter()
+        self.calls = 0
+        self.hedges = 0
+        self.first_token_timeouts = 0
+        self.deadline_exceeded = 0
+        self.unavailable = 0
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker()
+        return self._breakers[model]
+
+    def hedge_delay(self, model: str):
+        """Seconds after which a request to this model gets hedged, None when hedging does not apply."""
+        samples = self._first_token_times.get(model)
+        if not self.hedge or samples is None or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        if self.hedges >= OPENAI_HEDGE_MAX_RATIO * self.calls:
+            return None
+        ordered = sorted(samples)
+        return max(ordered[min(int(len(ordered) * OPENAI_HEDGE_QUANTILE), len(ordered) - 1)], HEDGE_MIN_DELAY)
+
+    async def call(self, kind: str, model: str, attempt, on_text=None, on_restart=None) -> tuple:
+        budget = BUDGETS[kind]
+        start = time.monotonic()
+        deadline = start + budget.total
+        self.calls += 1
+        error = None
+
+        breaker = self.breaker(model)
+        if breaker.allow():
+            probe = breaker.state == "half_open"
+            try:
+                text, path = await self._race(model, attempt, on_text, start + budget.first_token, deadline, probe)
+                return text, self._served(kind, path, start)
+            except asyncio.TimeoutError as e:
+                error = e
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                error = e
+            finally:
+                breaker.release(probe)
+            logger.warning("%s answer from %s failed after %.1fs: %r", kind, model, time.monotonic() - start, error)
+        else:
+            metrics.inc("openai_breaker_rejections_total", model=model)
+
+        remaining = deadline - time.monotonic()
+        fallback_breaker = self.breaker(self.fallback_model)
+        if remaining > 0 and fallback_breaker.allow():
+            probe = fallback_breaker.state == "half_open"
+            if on_restart is not None:
+                on_restart()
+            try:
+                async with asyncio.timeout(remaining):
+                    text = await attempt(self.fallback_model, on_text)
+                fallback_breaker.record(True, probe)
+                return text, self._served(kind, "fallback", start)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                fallback_breaker.record(False, probe)
+                error = e
+            finally:
+                fallback_breaker.release(probe)
+        if isinstance(error, asyncio.TimeoutError):
+            self.deadline_exceeded += 1
+        self.unavailable += 1
+        metrics.inc("openai_calls_total", kind=kind, path="unavailable")
+        raise ModelUnavailable(f"no {kind} answer within {budget.total:g}s") from error
+
+    async def _race(self, model: str, attempt, on_text, first_token_deadline: float, deadline: float,
+                    probe: bool) -> tuple:
+        # The first attempt to stream a token wins and the others are cancelled
+        attempts = []
+        winner = None
+
+        def launch(path: str) -> None:
+            current = _Attempt(path, model, probe)
+
+            def on_attempt_text(text: str) -> None:
+                nonlocal winner
+                if not current.first_token.is_set():
+                    current.first_token.set()
+                    self._first_token_times.setdefault(model, deque(maxlen=200)).append(
+                        time.monotonic() - current.started)
+                if winner is None:
+                    winner = current
+                if winner is current and on_text is not None:
+                    on_text(text)
+
+            current.task = asyncio.ensure_future(attempt(model, on_attempt_text))
+            attempts.append(current)
+
+        launch("primary")
+        hedge_delay = self.hedge_delay(model)
+        hedge_at = None if hedge_delay is None else attempts[0].started + hedge_delay
+        if hedge_at is not None and hedge_at >= first_token_deadline:
+            # Too late to help, the fallback takes over at the first token deadline anyway
+            hedge_at = None
+        try:
+            while winner is None:
+                for a in attempts:
+                    if a.task.done() and not a.task.cancelled() and a.task.exception() is None:
+                        # Answered without streaming any text
+                        self._record(a, ok=True)
+                        return a.task.result(), a.path
+                running = [a for a in attempts if not a.task.done()]
+                if not running:
+                    # Every attempt failed before streaming anything
+                    error = attempts[-1].task.exception()
+                    if is_transient(error):
+                        self._record(attempts[-1], ok=False)
+                    raise error
+
+                until = first_token_deadline if hedge_at is None else hedge_at
+                waiters = [asyncio.ensure_future(a.first_token.wait()) for a in running]
+                done, _ = await asyncio.wait(waiters + [a.task for a in running],
+                                             timeout=max(until - time.monotonic(), 0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+                if done:
+                    continue
+                if hedge_at is not None:
+                    hedge_at = None
+                    self.hedges += 1
+                    launch("hedge")
+                    continue
+                self.first_token_timeouts += 1
+                self._record(attempts[0], ok=False)
+                raise asyncio.TimeoutError(f"no first token from {model} in time")
+
+            for a in attempts:
+                if a is not winner:
+                    a.task.cancel()
+            try:
+                async with asyncio.timeout(max(deadline - time.monotonic(), 0)):
+                    text = await winner.task
+            except Exception as e:
+                if is_transient(e):
+                    self._record(winner, ok=False)
+                raise
+            self._record(winner, ok=True)
+            return text, winner.path
+        finally:
+            for a in attempts:
+                if not a.task.done():
+                    a.task.cancel()
+
+    def _record(self, attempt: _Attempt, ok: bool) -> None:
+        self.breaker(attempt.model).record(ok, attempt.probe)
+
+    def _served(self, kind: str, path: str, start: float) -> str:
+        self.paths[path] += 1
+        metrics.inc("openai_calls_total", kind=kind, path=path)
+        metrics.observe("openai_call_seconds", time.monotonic() - start, kind=kind, path=path)
+        return path
+
+    def stats(self) -> dict:
+        stats = {
+            **{f"served_{path}": count for path, count in self.paths.items()},
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "first_token_timeouts": self.first_token_timeouts,
+            "deadline_exceeded": self.deadline_exceeded,
+            "unavailable": self.unavailable,
+        }
+        for model, breaker in self._breakers.items():
+            # Model names become part of gauge names, which only take word characters
+            name = re.sub(r"\W", "_", model)
+            stats[f"breaker_open_{name}"] = int(breaker.state == "open")
+            stats[f"breaker_opened_{name}"] = breaker.opened
+        return stats
+
+
+deadline_caller = DeadlineCaller()
@@ -1,119 +1,270 @@
+import asyncio
+import base64
 import os
 import re
-from openai import OpenAI
-from .chart import extract_nutrition_data, create_nutrition_chart, is_food
-from .health_rating import extract_health_rating, generate_star_rating,replace_health_rating_with_stars
+import time
+import httpx
+from .chart import chart_key, render_nutrition_chart
+from .chart_cache import chart_file_cache
+from .image import VISION_DETAIL, fingerprint_image
+from .photo_cache import photo_cache
+from .scheduler import ANALYSIS_TOKENS, analysis_scheduler
+from .update_processor import released_slot
+from .history import ChatHistory, estimate_tokens
+from .answer_cache import answer_cache
+from .routing import estimate_cost, normalize_question, question_router
+from .metrics import metrics
+from .deadline import deadline_caller
+from .meal import MEAL_ALBUM_RESPONSE_FORMAT, MEAL_RESPONSE_FORMAT, NUTRITION_KEYS, Meal, format_meal, parse_partial_json
+
+# Client tuning: request timeout (seconds), SDK retries and how many completions may be in flight at once
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+
+_client = None
+_request_slots = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+def preload_openai() -> None:
+    # The SDK is imported on first use, it takes a good part of a second; call this to load it ahead
+    import openai  # noqa: F401
+
+def get_openai_client():
+    # One process-wide client so every call reuses the same HTTP connection pool
+    global _client
+    if _client is None:
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        _client = AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            timeout=OPENAI_TIMEOUT,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONCURRENCY,
+                    max_keepalive_connections=OPENAI_MAX_CONCURRENCY,
+                )
+            ),
+        )
+    return _client
+
+async def close_openai_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+def _record_usage(model: str, usage) -> None:
+    if usage is not None:
+        metrics.inc("openai_tokens_total", usage.prompt_tokens, model=model, kind="prompt")
+        metrics.inc("openai_tokens_total", usage.completion_tokens, model=model, kind="completion")
+
+async def create_chat_completion(**kwargs):
+    # Bound the number of concurrent completions so a burst cannot exhaust the pool
+    model = kwargs.get("model", "")
+    async with _request_slots:
+        start = time.perf_counter()
+        try:
+            response = await get_openai_client().chat.completions.create(**kwargs)
+        except Exception as e:
+            metrics.inc("openai_errors_total", model=model, error=type(e).__name__)
+            raise
+        metrics.observe("openai_request_seconds", time.perf_counter() - start, model=model)
+    _record_usage(model, response.usage)
+    return response
+
+async def stream_chat_completion(on_text=None, **kwargs) -> str:
+    # Streams a completion and returns its text; on_text(text_so_far) is called as the text grows
+    model = kwargs.get("model", "")
+    text = ""
+    usage = None
+    async with _request_slots:
+        start = time.perf_counter()
+        try:
+            # The last chunk then carries the token usage of the whole request
+            stream = await get_openai_client().chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **kwargs
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if not text:
+                            metrics.observe("openai_first_token_seconds", time.perf_counter() - start, model=model)
+                        text += chunk.choices[0].delta.content
+                        if on_text is not None:
+                            on_text(text)
+            finally:
+                # A request given up for a hedge or the fallback must not keep its connection busy
+                await stream.close()
+        except Exception as e:
+            metrics.inc("openai_errors_total", model=model, error=type(e).__name__)
+            raise
+        metrics.observe("openai_request_seconds", time.perf_counter() - start, model=model)
+    _record_usage(model, usage)
+    return text
+
+# Escape all special characters for MarkdownV2 except asterisks (**) for bold
+MARKDOWN_V2_SPECIAL_CHARS = re.compile(f"([{re.escape(r'_[]()~`>#+-=|{}.!')}])")
 
 def escape_markdown_v2(text: str) -> str:
-    # Escape all special characters for MarkdownV2 except asterisks (**) for bold
-    special_chars = r'_[]()~`>#+-=|{}.!'  # Avoid escaping * so that bold formatting works
-    return re.sub(f'([{re.escape(special_chars)}])', r'\\\1', text)
+    return MARKDOWN_V2_SPECIAL_CHARS.sub(r'\\\1', text)
+
+def _start_chart(nutrition: dict) -> dict:
+    # A chart that was uploaded before is sent again by its Telegram file_id, otherwise it is rendered
+    key = chart_key(nutrition)
+    file_id = chart_file_cache.get(key)
+    task = asyncio.create_task(render_nutrition_chart(nutrition)) if file_id is None else None
+    return {"key": key, "file_id": file_id, "task": task}
 
-def getPhotoResponse(chat_history: list, base64_image) -> dict:
-    # Initialize OpenAI client
-    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+async def _photo_response(meal: Meal, text_response: str, chart: dict = None, served_by: str = "cache") -> dict:
+    chart_png = chart_file_id = key = None
+    if meal.is_food:
+        # Generate chart image (raw PNG bytes), unless it was already started while streaming
+        if chart is None:
+            chart = _start_chart(meal.nutrition())
+        key, chart_file_id = chart["key"], chart["file_id"]
+        if chart["task"] is not None:
+            chart_png = await chart["task"]
+    elif chart is not None and chart["task"] is not None:
+        chart["task"].cancel()
+
+    return {
+        "meal": meal,
+        "text_response": text_response,
+        "chart_png": chart_png,
+        "chart_file_id": chart_file_id,  # set instead of chart_png when the chart can be sent by file_id
+        "chart_key": key,
+        "served_by": served_by  # "cache", or the path of the model call (see DeadlineCaller)
+    }
+
+async def getPhotoResponse(chat_history: ChatHistory, image: bytes, on_progress=None, user_id=None, on_queued=None) -> dict:
+    # Re-sent and forwarded photos are answered from the cache without a vision call
+    digest, phash = await fingerprint_image(image)
+    cached = photo_cache.get(digest, phash)
+    if cached is not None:
+        return await _photo_response(cached["meal"], cached["text_response"])
 
     gpt_user_prompt = "\n This is what I eat or drink now."
     
-    # Add emoji instructions to the system prompt
-    gpt_assistant_prompt = """You are a health assistant specialized in analyzing food photos. For every meal described or analyzed, your task is to:
-    1. List each **dish** or **beverage** in the meal in the original language, using relevant emojis for each item (e.g., 🍝 for pasta, 🍔 for hamburger, ☕ for coffee, 🫖 for tea, etc.). **You do not need to list individual ingredients within the dish** (e.g., for a hamburger, list "hamburger" instead of "tomato, lettuce, beef, etc.").
-    2. Estimate the total calories, carbohydrates, proteins, and fats of the meal, and include the following emojis next to each macronutrient:
-        - 🔥 for calories
-        - 🍞 for carbohydrates
-        - 🍗 for proteins
-        - 🥑 for fats
-    3. Provide a health rating from 1 to 10, and represent it with stars (e.g., 🌟🌟🌟🌟🌟).
-    4. Mention whether the meal is rich in nutrients or contains too much of any specific macronutrient (e.g., high in fats, carbohydrates, etc.).
-    5. If the meal only contains drinks like water, coffee, tea, you still need to analyze and include them, even if they have minimal or no macronutrients. Highlight their contribution (e.g., hydration, low-calorie nature) in the analysis.
-    6. End with a friendly suggestion or offer to provide more detailed nutritional information if requested.
-
-    Format your response consistently as follows, integrating emojis:
-
-    **Food Rating**
-    This meal contains:
-    [List of food items (dishes and beverages), each with an emoji, including drinks like coffee, tea, or water. Do not list individual ingredients.]
-
-    **Total calories** 🔥 [Estimated total calories] kcal  
-    **Total carbohydrates** 🍞 [Estimated total carbohydrates] grams  
-    **Total protein** 🍗 [Estimated total protein] grams  
-    **Total fats** 🥑 [Estimated total fats] grams  
-
-    **Health rating** [Health rating] 🌟 (Out of 10)  
-    [Short analysis of the meal, mentioning nutritional balance, including the contribution of drinks like coffee, tea, or water, and giving friendly advice.]
-
-    If you would like more detailed nutritional information, please let me know.
-
-    Always follow this structure for consistency and clarity, and make the response visually engaging by integrating the appropriate emojis.
-
-    If you think there is no food or drink in the image, reply with one of the following:
-    1. "Hmm... this doesn't look like a delicious dish! How about trying to send another food photo? 🤡"
-    2. "This isn't something you'd want to eat! My stomach only recognizes food! How about trying a pizza or sushi? 🤡🍕🍣"
-    3. "Wow, this surely isn't tonight's dinner! 🤡 I can only help you analyze food—how about sending a picture of a meal?"
-    4. "Looks cool, but I can only recognize food... I guess you didn't want to eat this, right? 🤡 How about sending another food picture?"
-    5. "This picture is unique! But as a food expert, I can only identify meals 🤡 Want to send a tasty food photo instead?"
-    6. "Hey, this is testing my intelligence! This isn't food, is it? 🤡 Send another food photo; I'm getting hungry!"
-    7. "This seems inedible! How about sending a picture of something that looks tastier? I can't wait to analyze it! 🤡"
-    8. "Hmm... I only recognize food! How about considering sending a photo that'll make me hungry? 🤡"
+    # The answer is a JSON meal object (see MEAL_SCHEMA), the message shown to the user is rendered locally
+    gpt_assistant_prompt = """You are a health assistant specialized in analyzing food photos. Fill in the meal object for the photo:
+    - is_food: false if there is no food or drink in the image. Then leave items empty, set all numbers to 0 and analysis to "".
+    - items: each dish or beverage in the meal, named in the original language, with one relevant emoji each (e.g., 🍝 for pasta, 🍔 for hamburger, ☕ for coffee, 🫖 for tea). Do not list individual ingredients within a dish (e.g., "hamburger", not "tomato, lettuce, beef"). Include drinks like water, coffee or tea even if they have minimal or no macronutrients.
+    - calories (kcal), carbohydrates, protein and fats (grams): estimated totals for the whole meal.
+    - health_rating: from 1 to 10.
+    - analysis: at most 60 words on whether the meal is rich in nutrients or contains too much of a specific macronutrient (e.g., high in fats or carbohydrates), the contribution of drinks (e.g., hydration, low-calorie nature), and a friendly suggestion. Use a few fitting emojis.
     """
     
-    # Construct messages including the image as base64
-    messages = [{"role": "system", "content": gpt_assistant_prompt}] + chat_history
-    messages += [
-        {
-            "role": "user", 
-            "content": [
-                {"type": "text", "text": gpt_user_prompt},
-                {"type": "image_url", "image_url": {
-                    "url": f"data:image/png;base64,{base64_image}"}
-                }
-            ]
-        }
-    ]
-    
-    chart_base64 = None
-    response_text_with_stars = None
-    # Call the GPT-4 API
-    response = client.chat.completions.create(
-        model="gpt-4o",  # Use correct model ID
-        messages=messages,
-        temperature=0.2,
-        max_tokens=512,
-        frequency_penalty=0.0
+    result = await _analyse_meal(
+        chat_history, [image], gpt_user_prompt, gpt_assistant_prompt, MEAL_RESPONSE_FORMAT,
+        on_progress=on_progress, user_id=user_id, on_queued=on_queued
     )
+    # Only the analysis is cached, the chart is found again through the chart cache; answers of the
+    # fallback model are not, the photo gets the better model when it is sent again
+    if result["served_by"] != "fallback":
+        photo_cache.put(digest, phash, {"meal": result["meal"], "text_response": result["text_response"]})
+    return result
+
+async def getAlbumResponse(chat_history: ChatHistory, images: list, on_progress=None, user_id=None, on_queued=None) -> dict:
+    # Several photos of one meal sent as an album: one request, a breakdown per item and one combined chart
+    gpt_user_prompt = f"\n These {len(images)} photos are what I eat or drink now, all part of one meal."
+
+    # The answer is a JSON meal object (see MEAL_ALBUM_SCHEMA); the totals are added up locally
+    gpt_assistant_prompt = """You are a health assistant specialized in analyzing food photos. The user sent several photos of one meal. Fill in the meal object for all of them together:
+    - is_food: false if there is no food or drink in any of the images. Then leave items empty, set health_rating to 0 and analysis to "".
+    - items: each dish or beverage across the photos, listed once even if it appears in several photos, named in the original language, with one relevant emoji each (e.g., 🍝 for pasta, 🍔 for hamburger, ☕ for coffee, 🫖 for tea), and its estimated calories (kcal), carbohydrates, protein and fats (grams). Do not list individual ingredients within a dish (e.g., "hamburger", not "tomato, lettuce, beef"). Include drinks like water, coffee or tea even if they have minimal or no macronutrients.
+    - health_rating: from 1 to 10, for the whole meal.
+    - analysis: at most 60 words on whether the meal is rich in nutrients or contains too much of a specific macronutrient (e.g., high in fats or carbohydrates), the contribution of drinks (e.g., hydration, low-calorie nature), and a friendly suggestion. Use a few fitting emojis.
+    """
+
+    return await _analyse_meal(
+        chat_history, images, gpt_user_prompt, gpt_assistant_prompt, MEAL_ALBUM_RESPONSE_FORMAT,
+        on_progress=on_progress, user_id=user_id, on_queued=on_queued
+    )
+
+async def _analyse_meal(chat_history: ChatHistory, images: list, gpt_user_prompt: str, gpt_assistant_prompt: str,
+                        response_format: dict, on_progress=None, user_id=None, on_queued=None) -> dict:
+    # Construct messages including the images as base64
+    content = [{"type": "text", "text": gpt_user_prompt}]
+    with metrics.timer("bot_stage_seconds", stage="base64_encode"):
+        for image in images:
+            base64_image = base64.b64encode(image).decode("utf-8")
+            content.append({"type": "image_url", "image_url": {
+                "url": f"data:image/jpeg;base64,{base64_image}",
+                "detail": VISION_DETAIL}
+            })
+    messages = [{"role": "system", "content": gpt_assistant_prompt}] + chat_history.messages()
+    messages += [{"role": "user", "content": content}]
     
-    # Extract response text
-    response_text = response.choices[0].message.content
-    tokens_used = response.usage.total_tokens
-
-    if is_food(response_text):
-        # Extract nutrient data from the GPT response
-        nutrient_data = extract_nutrition_data(response_text)
-
-        # Extract the health rating using the regex function
-        health_rating = extract_health_rating(response_text)
-        
-        # Generate the dynamic star rating
-        star_rating = generate_star_rating(health_rating)
-        
-        response_text_with_stars = replace_health_rating_with_stars(response_text, health_rating, star_rating)
-        # Generate chart image (encoded in base64)
-        chart_base64 = create_nutrition_chart(nutrient_data)
-    else:
-        chart_base64 = None
-        response_text_with_stars = response_text
+    chart = None
 
-    return {
-        "text_response": response_text_with_stars,
-        "chart_image_base64": chart_base64
-    }
+    def on_text(text: str) -> None:
+        nonlocal chart
+        partial = parse_partial_json(text)
+        if partial.get("is_food") is not True:
+            return
+        # Start rendering the chart while the rest of the answer is still streaming
+        if chart is None and "fats" in partial:
+            chart = _start_chart({key: partial[key] for key in NUTRITION_KEYS})
+        if on_progress is not None:
+            on_progress(format_meal(partial, complete=False))
+
+    def on_restart() -> None:
+        # The model was too slow or failing: drop the chart of its partial answer, the fallback starts over
+        nonlocal chart
+        if chart is not None and chart["task"] is not None:
+            chart["task"].cancel()
+        chart = None
+        if on_progress is not None:
+            on_progress("This is taking longer than usual, switching to a faster model ⏳")
+
+    async def attempt(model: str, on_model_text) -> str:
+        return await stream_chat_completion(
+            on_text=on_model_text,
+            model=model,
+            messages=messages,
+            temperature=0.2,
+            max_tokens=512 + 128 * (len(images) - 1),
+            frequency_penalty=0.0,
+            response_format=response_format
+        )
+
+    # Call the GPT-4 API, streaming the answer, once the scheduler lets this user's request through;
+    # on_queued(position) is called while it waits. While queued the handler gives its update slot
+    # back, so other chats' taps are not stuck behind the queue. The call runs under the photo time
+    # budget and falls back to a faster model when GPT-4o is too slow or failing.
+    try:
+        async with analysis_scheduler.slot(user_id, cost=ANALYSIS_TOKENS * len(images), on_position=on_queued,
+                                           while_queued=released_slot):
+            response_json, served_by = await deadline_caller.call(
+                "photo", "gpt-4o", attempt, on_text=on_text, on_restart=on_restart
+            )
+        # Parse the meal once; chart, stars, display text and DB record all come from it
+        with metrics.timer("bot_stage_seconds", stage="meal_parse"):
+            meal = Meal.from_json(response_json)
+    except BaseException:
+        if chart is not None and chart["task"] is not None:
+            chart["task"].cancel()
+        raise
+
+    return await _photo_response(meal, meal.to_text(), chart, served_by)
 
     
-def getTextResponse(chat_history: list) -> str:
-    # Initialize OpenAI client
-    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+async def getTextResponse(chat_history: ChatHistory, on_progress=None) -> str:
+    # The question is the last message of the history
+    question = chat_history.turns[-1]["content"] if chat_history.turns else ""
+    normalized = normalize_question(question)
+    route = question_router.route(normalized)
+    start = time.perf_counter()
+    if route.cacheable:
+        cached = answer_cache.get(normalized)
+        if cached is not None:
+            metrics.observe("text_answer_seconds", time.perf_counter() - start, route=route.name, cached="yes")
+            return cached
 
-    gpt_assistant_prompt = """
+    gpt_assistant_prompt = f"""
     You are a professional health assistant. 
     
     Your sole purpose is to provide expert advice and information related to health, nutrition, and wellness. 
@@ -126,21 +277,59 @@ def getTextResponse(chat_history: list) -> str:
 
     Maintain a professional, informative, and respectful tone at all times.
 
-    Your answer should not exceed 500 words.
+    Your answer should not exceed {route.max_words} words.
     """
     
-    # Construct the messages with the chat history
-    messages = [{"role": "system", "content": gpt_assistant_prompt}] + chat_history
+    # Construct the messages with the chat history; questions that do not refer to it are sent alone,
+    # so their answers fit every user and can be cached
+    if route.use_history:
+        history = chat_history.messages()
+    else:
+        history = [{"role": "user", "content": question}]
+        question_router.skip_history(route, sum(estimate_tokens(m["content"]) for m in chat_history.messages()[:-1]))
+    messages = [{"role": "system", "content": gpt_assistant_prompt}] + history
     
-    # Call the GPT-4 API with the complete chat history
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",  # Use correct model ID
+    async def attempt(model: str, on_model_text) -> str:
+        return await stream_chat_completion(
+            on_text=on_model_text,
+            model=model,
+            messages=messages,
+            temperature=0.2,
+            max_tokens=route.max_tokens,
+            frequency_penalty=0.0
+        )
+
+    # Call the GPT-4 API with the chat history, streaming the answer, under the text time budget
+    response_text, served_by = await deadline_caller.call("text", route.model, attempt, on_text=on_progress)
+    seconds = time.perf_counter() - start
+    metrics.observe("text_answer_seconds", seconds, route=route.name, cached="no")
+    # Fallback answers are not cached, the question gets the route's model next time
+    if route.cacheable and response_text and served_by != "fallback":
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        cost = estimate_cost(route.model, prompt_tokens, estimate_tokens(response_text))
+        answer_cache.put(normalized, response_text, cost=cost, seconds=seconds)
+    return response_text
+
+async def getSummaryResponse(summary: str, chat_messages: list) -> str:
+    gpt_assistant_prompt = """
+    You maintain a running summary of a conversation between a user and a health assistant.
+
+    Merge the previous summary with the new messages into one short summary. Keep facts that matter for later advice:
+    the user's goal, meals they sent with their calories and macronutrients, preferences, restrictions and open questions.
+
+    Answer with the summary only, in at most 150 words.
+    """
+
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in chat_messages)
+    messages = [
+        {"role": "system", "content": gpt_assistant_prompt},
+        {"role": "user", "content": f"Previous summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"}
+    ]
+
+    response = await create_chat_completion(
+        model="gpt-4o-mini",
         messages=messages,
-        temperature=0.2,
-        max_tokens=1024,
-        frequency_penalty=0.0
+        temperature=0.0,
+        max_tokens=256
     )
-    
-    # Extract response text
-    response_text = response.choices[0].message.content
-    return response_text
\ No newline at end of file
+    return response.choices[0].message.content
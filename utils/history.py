@@ -0,0 +1,82 @@
+# history.py
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Recent messages are sent verbatim as long as they fit both limits; older ones are folded into a summary
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "12"))
+# Evicted messages kept for the summarizer if it keeps failing
+HISTORY_MAX_PENDING = 50
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text, plus the per-message overhead of the chat format
+    return len(text) // 4 + 4
+
+
+class ChatHistory:
+    """Per-user conversation kept within a token budget.
+
+    Messages that fall out of the sliding window wait in ``pending`` until ``compact`` folds
+    them into ``summary``. Compaction is meant to run in the background, outside the reply path.
+    """
+
+    def __init__(self, token_budget: int = HISTORY_TOKEN_BUDGET, window: int = HISTORY_WINDOW):
+        self.token_budget = token_budget
+        self.window = window
+        self.summary = ""
+        self.turns = []
+        self.pending = []
+        self._tokens = 0
+        self._compacting = False
+
+    def __getstate__(self) -> dict:
+        # A compaction in flight does not survive a restart
+        state = self.__dict__.copy()
+        state["_compacting"] = False
+        return state
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def append(self, role: str, content: str) -> None:
+        self.turns.append({"role": role, "content": content})
+        self._tokens += estimate_tokens(content)
+        self._trim()
+
+    def _trim(self) -> None:
+        while len(self.turns) > 1 and (len(self.turns) > self.window or self._tokens > self.token_budget):
+            message = self.turns.pop(0)
+            self._tokens -= estimate_tokens(message["content"])
+            self.pending.append(message)
+        del self.pending[:-HISTORY_MAX_PENDING]
+
+    def messages(self) -> list:
+        # The summary goes first, as context for the verbatim window
+        if not self.summary:
+            return list(self.turns)
+        summary = {"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"}
+        return [summary] + self.turns
+
+    def needs_compaction(self) -> bool:
+        return bool(self.pending) and not self._compacting
+
+    async def compact(self, summarize) -> None:
+        """Folds the pending messages into the summary with ``await summarize(summary, messages)``."""
+        if not self.needs_compaction():
+            return
+        self._compacting = True
+        batch = list(self.pending)
+        try:
+            self.summary = await summarize(self.summary, batch)
+        except Exception:
+            # Keep the messages pending, the next compaction retries them
+            logger.exception("Chat history compaction failed")
+        else:
+            # New messages may have been evicted meanwhile, only drop the summarized ones
+            del self.pending[:len(batch)]
+        finally:
+            self._compacting = False
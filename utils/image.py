@@ -0,0 +1,98 @@
+# image.py
+
+import asyncio
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageOps
+from .metrics import metrics
+
+# Long edge (pixels) of the image sent to the vision model, JPEG quality of the re-encode
+# and the detail level requested from GPT-4o ("low", "high" or "auto"). A 512px long edge fits
+# one 512px tile, 255 image tokens at high detail; 768 needs four (765 tokens), like the original.
+VISION_MAX_EDGE = int(os.getenv("VISION_MAX_EDGE", "512"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "75"))
+VISION_DETAIL = os.getenv("VISION_DETAIL", "auto")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+_executor = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    # Spawned (not forked) workers, the bot process already runs threads
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown_image_workers() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def pick_photo_size(photo_sizes: list, max_edge: int = VISION_MAX_EDGE):
+    # Telegram lists the sizes of a photo from smallest to largest; the smallest one that
+    # still covers max_edge is enough, anything bigger is downscaled by us anyway
+    for photo_size in photo_sizes:
+        if max(photo_size.width, photo_size.height) >= max_edge:
+            return photo_size
+    return photo_sizes[-1]
+
+
+def preprocess_image(data: bytes, max_edge: int = VISION_MAX_EDGE, quality: int = VISION_JPEG_QUALITY) -> bytes:
+    with Image.open(BytesIO(data)) as image:
+        # A small JPEG without metadata is already what we would produce
+        if image.format == "JPEG" and max(image.size) <= max_edge and "exif" not in image.info:
+            return data
+
+        # Let the JPEG decoder scale down by a power of two while decoding
+        if image.format == "JPEG":
+            image.draft("RGB", (max_edge, max_edge))
+
+        # Apply the EXIF orientation before dropping the metadata
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        # Saving without exif=... strips EXIF (GPS, device data) from the upload
+        with BytesIO() as out:
+            image.save(out, format="JPEG", quality=quality, optimize=True)
+            return out.getvalue()
+
+
+async def prepare_vision_image(data: bytes) -> bytes:
+    # Decoding and resizing are CPU bound, run them in the process pool
+    loop = asyncio.get_running_loop()
+    with metrics.timer("bot_stage_seconds", stage="image_preprocess"):
+        return await loop.run_in_executor(_get_executor(), preprocess_image, bytes(data), VISION_MAX_EDGE, VISION_JPEG_QUALITY)
+
+
+def perceptual_hash(data: bytes, size: int = 8) -> int:
+    # dHash: compare neighbouring pixels of a tiny grayscale thumbnail, robust to re-compression and resizing
+    with Image.open(BytesIO(data)) as image:
+        image.draft("L", (size * 4, size * 4))
+        pixels = image.convert("L").resize((size + 1, size), Image.BILINEAR).tobytes()
+
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            offset = row * (size + 1) + col
+            bits = (bits << 1) | (pixels[offset] > pixels[offset + 1])
+    return bits
+
+
+def image_fingerprint(data: bytes) -> tuple:
+    return hashlib.sha256(data).hexdigest(), perceptual_hash(data)
+
+
+async def fingerprint_image(data: bytes) -> tuple:
+    # (exact sha256 hex digest, 64-bit perceptual hash) of an image
+    loop = asyncio.get_running_loop()
+    with metrics.timer("bot_stage_seconds", stage="fingerprint"):
+        return await loop.run_in_executor(_get_executor(), image_fingerprint, bytes(data))
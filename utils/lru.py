@@ -0,0 +1,101 @@
+# lru.py
+
+import os
+import time
+from collections import OrderedDict
+
+
+def replace_file(path: str, data: bytes) -> None:
+    # Write to a temporary file first so a crash never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class LRUCache:
+    """Up to ``max_entries`` values, least recently used evicted first, each optionally expiring ``ttl`` seconds after it was put.
+
+    Counts hits, misses and invalidations for ``stats()``. Subclasses with a secondary index
+    override ``_remove``, the one place entries leave the cache.
+    """
+
+    def __init__(self, max_entries: int, ttl: float = None, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (expiry timestamp or None, value)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def items(self):
+        return ((key, value) for key, (_, value) in self._entries.items())
+
+    def peek(self, key):
+        """The value of a key that has not expired, marked as recently used, without counting a lookup."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= self.clock():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key):
+        value = self.peek(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (None if self.ttl is None else self.clock() + self.ttl, value)
+        self._trim()
+
+    def invalidate(self, key) -> None:
+        if key in self._entries:
+            self._remove(key)
+            self.invalidations += 1
+
+    def _remove(self, key):
+        return self._entries.pop(key)[1]
+
+    def _trim(self) -> None:
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def snapshot(self) -> list:
+        """(key, expiry, value) of every entry, least recently used first, for saving."""
+        return [(key, expires, value) for key, (expires, value) in self._entries.items()]
+
+    def restore(self, entries) -> None:
+        now = self.clock()
+        for key, expires, value in entries:
+            if expires is None or expires > now:
+                self._entries[key] = (expires, value)
+                self._entries.move_to_end(key)
+        self._trim()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,209 @@
+# meal.py
+
+import json
+import random
+from dataclasses import asdict, dataclass, field
+from .health_rating import generate_star_rating
+
+# JSON schema the vision model must answer with (OpenAI structured outputs, strict mode).
+# The key order is the order the fields are streamed in: macros come before the long analysis.
+MEAL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_food": {"type": "boolean"},
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "emoji": {"type": "string"},
+                },
+                "required": ["name", "emoji"],
+                "additionalProperties": False,
+            },
+        },
+        "calories": {"type": "number"},
+        "carbohydrates": {"type": "number"},
+        "protein": {"type": "number"},
+        "fats": {"type": "number"},
+        "health_rating": {"type": "integer"},
+        "analysis": {"type": "string"},
+    },
+    "required": ["is_food", "items", "calories", "carbohydrates", "protein", "fats", "health_rating", "analysis"],
+    "additionalProperties": False,
+}
+
+MEAL_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "meal", "strict": True, "schema": MEAL_SCHEMA},
+}
+
+# Album variant: macros per item instead of totals, the totals are added up locally
+ALBUM_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "emoji": {"type": "string"},
+        "calories": {"type": "number"},
+        "carbohydrates": {"type": "number"},
+        "protein": {"type": "number"},
+        "fats": {"type": "number"},
+    },
+    "required": ["name", "emoji", "calories", "carbohydrates", "protein", "fats"],
+    "additionalProperties": False,
+}
+
+MEAL_ALBUM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_food": {"type": "boolean"},
+        "items": {"type": "array", "items": ALBUM_ITEM_SCHEMA},
+        "health_rating": {"type": "integer"},
+        "analysis": {"type": "string"},
+    },
+    "required": ["is_food", "items", "health_rating", "analysis"],
+    "additionalProperties": False,
+}
+
+MEAL_ALBUM_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "meal_album", "strict": True, "schema": MEAL_ALBUM_SCHEMA},
+}
+
+NOT_FOOD_REPLIES = [
+    "Hmm... this doesn't look like a delicious dish! How about trying to send another food photo? 🤡",
+    "This isn't something you'd want to eat! My stomach only recognizes food! How about trying a pizza or sushi? 🤡🍕🍣",
+    "Wow, this surely isn't tonight's dinner! 🤡 I can only help you analyze food—how about sending a picture of a meal?",
+    "Looks cool, but I can only recognize food... I guess you didn't want to eat this, right? 🤡 How about sending another food picture?",
+    "This picture is unique! But as a food expert, I can only identify meals 🤡 Want to send a tasty food photo instead?",
+    "Hey, this is testing my intelligence! This isn't food, is it? 🤡 Send another food photo; I'm getting hungry!",
+    "This seems inedible! How about sending a picture of something that looks tastier? I can't wait to analyze it! 🤡",
+    "Hmm... I only recognize food! How about considering sending a photo that'll make me hungry? 🤡",
+]
+
+NUTRITION_KEYS = ("calories", "carbohydrates", "protein", "fats")
+
+MACRO_LINES = [
+    ("calories", "**Total calories** 🔥 {} kcal"),
+    ("carbohydrates", "**Total carbohydrates** 🍞 {} grams"),
+    ("protein", "**Total protein** 🍗 {} grams"),
+    ("fats", "**Total fats** 🥑 {} grams"),
+]
+
+
+@dataclass
+class Meal:
+    is_food: bool
+    items: list = field(default_factory=list)
+    calories: float = 0
+    carbohydrates: float = 0
+    protein: float = 0
+    fats: float = 0
+    health_rating: int = 0
+    analysis: str = ""
+
+    @classmethod
+    def from_json(cls, text: str) -> "Meal":
+        data = json.loads(text)
+        items = []
+        for item in data["items"]:
+            # Album answers carry macros per item
+            items.append({key: item[key] if key in ("name", "emoji") else float(item[key])
+                          for key in ("name", "emoji") + NUTRITION_KEYS if key in item})
+        # Without totals (album answers) they are the sum of the items
+        totals = {key: float(data[key]) if key in data else sum(item.get(key, 0) for item in items)
+                  for key in NUTRITION_KEYS}
+        return cls(
+            is_food=bool(data["is_food"]),
+            items=items,
+            health_rating=min(max(int(data["health_rating"]), 0), 10),
+            analysis=data["analysis"],
+            **totals,
+        )
+
+    def nutrition(self) -> dict:
+        # The shape expected by the chart module
+        return {key: getattr(self, key) for key in NUTRITION_KEYS}
+
+    def to_text(self) -> str:
+        if not self.is_food:
+            return random.choice(NOT_FOOD_REPLIES)
+        return format_meal(asdict(self))
+
+
+def _number(value) -> str:
+    return f"{value:g}"
+
+
+def format_meal(data: dict, complete: bool = True) -> str:
+    """Renders a meal as the food rating message; fields missing from a partial meal are left out."""
+    lines = ["**Food Rating**", "This meal contains:"]
+    for item in data.get("items", []):
+        line = f"{item.get('emoji', '')} {item.get('name', '')}".strip()
+        if "calories" in item:
+            line += f" ({_number(item['calories'])} kcal)"
+        lines.append(line)
+
+    macros = [template.format(_number(data[key])) for key, template in MACRO_LINES if key in data]
+    if macros:
+        lines += [""] + macros
+
+    if "health_rating" in data:
+        rating = min(max(int(data["health_rating"]), 0), 10)
+        lines += ["", f"**Health rating** {rating}/10 {generate_star_rating(rating)}"]
+        if data.get("analysis"):
+            lines.append(data["analysis"])
+
+    if complete:
+        lines += ["", "If you would like more detailed nutritional information, please let me know."]
+    return "\n".join(lines)
+
+
+def parse_partial_json(text: str) -> dict:
+    """Parses the complete part of a JSON object that is still being streamed.
+
+    Members whose value is not finished yet are left out, except strings, which are cut
+    where the stream currently is. A number is only taken once the next token arrived.
+    """
+    stack = []
+    in_string = escaped = value_string = False
+    last_significant = ""
+    safe_end, safe_stack = 0, []
+
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+            value_string = bool(stack) and (stack[-1] == "[" or last_significant == ":")
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            safe_end, safe_stack = i + 1, list(stack)
+        elif ch == ",":
+            safe_end, safe_stack = i, list(stack)
+        if not ch.isspace():
+            last_significant = ch
+
+    def close(containers: list) -> str:
+        return "".join("}" if c == "{" else "]" for c in reversed(containers))
+
+    if in_string and value_string:
+        candidate = (text[:-1] if escaped else text) + '"' + close(stack)
+    else:
+        candidate = text[:safe_end] + close(safe_stack)
+
+    try:
+        data = json.loads(candidate)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
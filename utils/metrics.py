@@ -0,0 +1,154 @@
+# metrics.py
+
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Port of the Prometheus endpoint in polling mode (0 disables it; in webhook mode /metrics is
+# served by the webhook server)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Registry:
+    """Counters and histograms with labels, rendered in the Prometheus text format.
+
+    Recording is a dict lookup and a few additions under a lock (chart rendering and image
+    work record from worker threads). Gauges are not stored: components with a stats() method
+    are registered as collectors and read when the metrics are scraped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> {sorted label items: value}
+        self._counters = {}
+        # name -> {sorted label items: [bucket counts..., sum, count]}
+        self._histograms = {}
+        self._collectors = {}
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observes the seconds spent in the block; works the same inside coroutines."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_collector(self, prefix: str, stats) -> None:
+        # stats() returns a dict; its numeric values become gauges named <prefix>_<key>
+        self._collectors[prefix] = stats
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {key: list(counts) for key, counts in series.items()}
+                          for name, series in self._histograms.items()}
+        gauges = {}
+        for prefix, stats in self._collectors.items():
+            try:
+                values = stats()
+            except Exception:
+                logger.exception("Metrics collector %s failed", prefix)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[f"{prefix}_{key}"] = value
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def render(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, series in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_labels(key)} {value:g}")
+        for name, series in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, counts in series.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(key + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {counts[-1]}")
+                lines.append(f"{name}_sum{_labels(key)} {counts[-2]:g}")
+                lines.append(f"{name}_count{_labels(key)} {counts[-1]}")
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key: tuple) -> str:
+    if not key:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+metrics = Registry()
+
+
+def instrument_handler(handler):
+    """Times an update handler and counts its calls and failures, labelled with its name."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", handler=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - start, handler=name)
+
+    return wrapper
+
+
+# aiohttp is imported only where it is used, it is not needed to start the bot in polling mode
+
+async def handle_metrics(request):
+    from aiohttp import web
+
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(port: int = METRICS_PORT):
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info("Metrics on port %d", port)
+    return runner
@@ -0,0 +1,180 @@
+# pending_uploads.py
+
+import asyncio
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+
+# Bytes of photos kept in memory, how long (seconds) a photo waits for the Yes/No answer, how
+# often expired ones are swept, and the directory every photo is written to. Point PENDING_DIR at
+# a volume all replicas share, so a Yes tap handled by another replica, or after a restart,
+# still finds the photo.
+PENDING_MEMORY_BUDGET = int(os.getenv("PENDING_MEMORY_BUDGET", str(32 * 1024 * 1024)))
+PENDING_TTL = float(os.getenv("PENDING_TTL", "3600"))
+PENDING_SWEEP_INTERVAL = float(os.getenv("PENDING_SWEEP_INTERVAL", "60"))
+PENDING_DIR = os.getenv("PENDING_DIR", "pending_uploads")
+
+_HANDLE = re.compile(r"[0-9a-f]{32}")
+
+
+class PendingUploadStore:
+    """Photos waiting for the user's save choice, referenced from user_data by a handle.
+
+    Every photo is written to ``path`` under its handle, which is what the conversation state
+    keeps; up to ``memory_budget`` bytes of the newest ones are also held in memory. A handle this
+    process does not know (put by another replica or before a restart) is resolved from the
+    directory. Photos expire ``ttl`` seconds after they were put, by the age of their file.
+    """
+
+    def __init__(self, memory_budget: int = PENDING_MEMORY_BUDGET, ttl: float = PENDING_TTL,
+                 path: str = PENDING_DIR):
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.path = path
+        self._dir_ready = False
+        # handle -> [data or None, size, expiry timestamp], oldest first; photos put by this process
+        self._entries = OrderedDict()
+        self.memory_bytes = 0
+        self.spills = 0
+        self.expired = 0
+        self.shared_takes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _file(self, handle: str) -> str:
+        if not self._dir_ready:
+            os.makedirs(self.path, exist_ok=True)
+            self._dir_ready = True
+        return os.path.join(self.path, handle)
+
+    def _spill(self) -> None:
+        # Drop the oldest photos from memory until the budget holds again, their files stay
+        for entry in self._entries.values():
+            if self.memory_bytes <= self.memory_budget:
+                break
+            if entry[0] is None:
+                continue
+            entry[0] = None
+            self.memory_bytes -= entry[1]
+            self.spills += 1
+
+    def _forget(self, handle: str) -> None:
+        entry = self._entries.pop(handle, None)
+        if entry is not None and entry[0] is not None:
+            self.memory_bytes -= entry[1]
+
+    def _claim(self, handle: str, read: bool = True):
+        # Renaming is atomic, so of two processes taking the same photo only one gets it
+        path = self._file(handle)
+        claimed = f"{path}.{uuid.uuid4().hex}.taken"
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        try:
+            if os.path.getmtime(claimed) + self.ttl <= time.time():
+                self.expired += 1
+                return None
+            if not read:
+                return b""
+            with open(claimed, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(claimed)
+
+    def put(self, data: bytes) -> str:
+        """Keeps a photo and returns the handle to fetch it with."""
+        handle = uuid.uuid4().hex
+        with open(self._file(handle), "wb") as f:
+            f.write(data)
+        self._entries[handle] = [data, len(data), time.time() + self.ttl]
+        self.memory_bytes += len(data)
+        if self.memory_bytes > self.memory_budget:
+            self._spill()
+        return handle
+
+    def take(self, handle: str):
+        """Removes a photo and returns its bytes, or None if it is unknown, expired or already taken."""
+        if not _HANDLE.fullmatch(handle):
+            return None
+        entry = self._entries.get(handle)
+        if entry is None:
+            data = self._claim(handle)
+            if data is not None:
+                self.shared_takes += 1
+            return data
+        self._forget(handle)
+        if entry[2] <= time.time():
+            self._discard_file(handle)
+            self.expired += 1
+            return None
+        # The file is the photo; without it (taken elsewhere) the memory copy must not be saved twice
+        data = self._claim(handle, read=entry[0] is None)
+        return None if data is None else (data if entry[0] is None else entry[0])
+
+    def _discard_file(self, handle: str) -> None:
+        try:
+            os.remove(self._file(handle))
+        except OSError:
+            pass
+
+    def discard(self, handle: str) -> None:
+        if not _HANDLE.fullmatch(handle):
+            return
+        self._forget(handle)
+        self._discard_file(handle)
+
+    def sweep(self) -> int:
+        """Drops expired photos: this process's entries, and files of any process by their age."""
+        now = time.time()
+        expired = []
+        # Entries are in insertion order, so the expired ones come first
+        for handle, entry in self._entries.items():
+            if entry[2] > now:
+                break
+            expired.append(handle)
+        for handle in expired:
+            self.discard(handle)
+
+        # Files left by other replicas or before a restart
+        try:
+            files = list(os.scandir(self.path))
+        except FileNotFoundError:
+            files = []
+        for file in files:
+            try:
+                if file.stat().st_mtime + self.ttl <= now:
+                    os.remove(file.path)
+                    expired.append(file.name)
+            except OSError:
+                pass
+        self.expired += len(expired)
+        return len(expired)
+
+    async def run_sweeper(self, interval: float = PENDING_SWEEP_INTERVAL) -> None:
+        # Used when the application has no job queue
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def clear(self) -> None:
+        # Only the memory copies; the files outlive the process until the sweeper expires them
+        self._entries.clear()
+        self.memory_bytes = 0
+
+    def stats(self) -> dict:
+        spilled = sum(1 for entry in self._entries.values() if entry[0] is None)
+        return {
+            "entries": len(self._entries),
+            "memory_bytes": self.memory_bytes,
+            "spilled_entries": spilled,
+            "spills": self.spills,
+            "expired": self.expired,
+            "shared_takes": self.shared_takes,
+        }
+
+
+pending_uploads = PendingUploadStore()
@@ -0,0 +1,265 @@
+# persistence.py
+
+import asyncio
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from hashlib import blake2b
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# SQLite file holding conversation state and user data ("" disables persistence) and how often
+# (seconds) the application hands changed users over to be written
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "bot_state.sqlite3")
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+
+
+class StateStore(ABC):
+    """Key-value store behind StatePersistence.
+
+    Entries live in namespaces ("user", "chat", "bot", "conversation:<name>") under string keys.
+    Every write stores an opaque version token with the value, so a process can tell whether an
+    entry was changed by someone else since it last read or wrote it. A networked store (Redis,
+    Postgres, ...) only needs to implement these four methods.
+    """
+
+    @abstractmethod
+    async def load(self, namespace: str) -> dict:
+        """Returns {key: (version, value)} of all entries in a namespace."""
+
+    @abstractmethod
+    async def get(self, namespace: str, key: str):
+        """Returns (version, value) of one entry, or None."""
+
+    @abstractmethod
+    async def write(self, changes: list) -> None:
+        """Applies (namespace, key, version, value) changes atomically; a value of None deletes."""
+
+    async def close(self) -> None:
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    """StateStore in a local SQLite file (WAL mode, so several processes on one host can share it)."""
+
+    def __init__(self, path: str = PERSISTENCE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, version TEXT NOT NULL, value BLOB NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+
+    def _load(self, namespace: str) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT key, version, value FROM state WHERE namespace = ?", (namespace,))
+            return {key: (version, value) for key, version, value in rows}
+
+    def _get(self, namespace: str, key: str):
+        with self._lock:
+            return self._db.execute(
+                "SELECT version, value FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+
+    def _write(self, changes: list) -> None:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for namespace, key, version, value in changes:
+                    if value is None:
+                        self._db.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+                    else:
+                        self._db.execute(
+                            "INSERT INTO state (namespace, key, version, value) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (namespace, key) DO UPDATE SET version = excluded.version, value = excluded.value",
+                            (namespace, key, version, value),
+                        )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    async def load(self, namespace: str) -> dict:
+        return await asyncio.to_thread(self._load, namespace)
+
+    async def get(self, namespace: str, key: str):
+        return await asyncio.to_thread(self._get, namespace, key)
+
+    async def write(self, changes: list) -> None:
+        await asyncio.to_thread(self._write, changes)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def _digest(value: bytes) -> bytes:
+    return blake2b(value, digest_size=16).digest()
+
+
+class StatePersistence(BasePersistence):
+    """Application persistence writing each changed user (and conversation state) separately.
+
+    User data is loaded on demand, when an update of that user arrives, and written back only if
+    its pickle changed; nothing is ever pickled as a whole, so the cost per flush depends on the
+    users who were active, not on how many there are. Writes are group-committed: changes that
+    arrive while a write is running go to the store together in the next transaction.
+    """
+
+    def __init__(self, store: StateStore, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        # (namespace, key) -> version token last read or written by this process, and digest of the value
+        self._versions = {}
+        self._digests = {}
+        # (namespace, key) -> (version, value) waiting to be written
+        self._dirty = {}
+        self._writing = {}
+        self._writer = None
+        self.writes = 0
+        self.skipped = 0
+        self.refreshed = 0
+
+    # Write coalescing
+
+    def _stage(self, namespace: str, key: str, value) -> None:
+        entry = (namespace, key)
+        if value is not None:
+            digest = _digest(value)
+            if self._digests.get(entry) == digest:
+                self.skipped += 1
+                return
+            self._digests[entry] = digest
+        else:
+            self._digests.pop(entry, None)
+        version = uuid.uuid4().hex
+        self._versions[entry] = version
+        self._dirty[entry] = (version, value)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_dirty())
+
+    async def _write_dirty(self) -> None:
+        while self._dirty:
+            self._writing, self._dirty = self._dirty, {}
+            changes = [(namespace, key, version, value) for (namespace, key), (version, value) in self._writing.items()]
+            try:
+                await self.store.write(changes)
+            except Exception:
+                logger.exception("Writing %d state entries failed, they are retried with the next change", len(changes))
+                # Newer changes staged meanwhile win over the failed ones
+                self._writing.update(self._dirty)
+                self._dirty, self._writing = self._writing, {}
+                return
+            self._writing = {}
+            self.writes += len(changes)
+
+    def _pending(self, entry: tuple) -> bool:
+        return entry in self._dirty or entry in self._writing
+
+    async def _refresh(self, namespace: str, key: str, data: dict) -> None:
+        entry = (namespace, key)
+        # While our own change is not written yet, it is the newest
+        if self._pending(entry):
+            return
+        row = await self.store.get(namespace, key)
+        if row is None or self._pending(entry):
+            return
+        version, value = row
+        if self._versions.get(entry) == version:
+            return
+        # First time this process sees the entry, or another process wrote it since
+        data.clear()
+        data.update(pickle.loads(value))
+        self._versions[entry] = version
+        self._digests[entry] = _digest(value)
+        self.refreshed += 1
+
+    def stats(self) -> dict:
+        return {
+            "pending_writes": len(self._dirty),
+            "writes": self.writes,
+            "unchanged_skipped": self.skipped,
+            "refreshed": self.refreshed,
+        }
+
+    # User data: loaded lazily through refresh_user_data instead of all at start
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh("user", str(user_id), user_data)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage("user", str(user_id), pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage("user", str(user_id), None)
+
+    # Chat data (not stored by this bot, see store_data)
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh("chat", str(chat_id), chat_data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._stage("chat", str(chat_id), pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage("chat", str(chat_id), None)
+
+    # Bot and callback data (not stored by this bot)
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    # Conversation states
+
+    async def get_conversations(self, name: str) -> dict:
+        namespace = f"conversation:{name}"
+        conversations = {}
+        for key, (version, value) in (await self.store.load(namespace)).items():
+            self._versions[(namespace, key)] = version
+            self._digests[(namespace, key)] = _digest(value)
+            conversations[tuple(json.loads(key))] = pickle.loads(value)
+        return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        value = None if new_state is None else pickle.dumps(new_state, protocol=pickle.HIGHEST_PROTOCOL)
+        self._stage(f"conversation:{name}", json.dumps(list(key)), value)
+
+    async def flush(self) -> None:
+        # Called by Application.shutdown() after the last update_* round
+        if self._writer is not None:
+            await self._writer
+        await self._write_dirty()
+        await self.store.close()
@@ -0,0 +1,73 @@
+# photo_cache.py
+
+import logging
+import os
+import pickle
+
+from .lru import LRUCache, replace_file
+
+logger = logging.getLogger(__name__)
+
+# Entries kept, their lifetime in seconds, the largest perceptual hash distance (in bits, out of 64)
+# still treated as the same photo (-1 disables near-duplicate matching) and an optional file to persist to
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "1024"))
+PHOTO_CACHE_TTL = float(os.getenv("PHOTO_CACHE_TTL", str(7 * 24 * 3600)))
+PHOTO_CACHE_DISTANCE = int(os.getenv("PHOTO_CACHE_DISTANCE", "4"))
+PHOTO_CACHE_PATH = os.getenv("PHOTO_CACHE_PATH", "")
+
+
+class PhotoAnalysisCache(LRUCache):
+    """LRU/TTL cache of photo analyses keyed by exact hash, with a perceptual hash fallback."""
+
+    def __init__(self, max_entries: int = PHOTO_CACHE_SIZE, ttl: float = PHOTO_CACHE_TTL,
+                 max_distance: int = PHOTO_CACHE_DISTANCE, path: str = PHOTO_CACHE_PATH):
+        # digest -> (perceptual hash, analysis); wall clock expiry, the entries outlive the process
+        super().__init__(max_entries, ttl)
+        self.max_distance = max_distance
+        self.path = path
+        if path:
+            self.load()
+
+    def _find_similar(self, phash: int):
+        best, best_distance = None, self.max_distance + 1
+        for digest, (other, _) in self.items():
+            distance = (phash ^ other).bit_count()
+            if distance < best_distance:
+                best, best_distance = digest, distance
+        return best
+
+    def get(self, digest: str, phash: int):
+        exact = digest in self
+        key = digest if exact else (self._find_similar(phash) if self.max_distance >= 0 else None)
+        entry = None if key is None else self.peek(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if exact:
+            self.hits += 1
+        else:
+            self.near_hits += 1
+        return entry[1]
+
+    def put(self, digest: str, phash: int, analysis: dict) -> None:
+        super().put(digest, (phash, analysis))
+
+    def stats(self) -> dict:
+        return {**super().stats(), "near_hits": self.near_hits}
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "rb") as f:
+                entries = pickle.load(f)
+            self.restore(entries)
+        except FileNotFoundError:
+            return
+        except Exception:
+            logger.exception("Could not load the photo cache from %s", self.path)
+
+    def save(self) -> None:
+        if self.path:
+            replace_file(self.path, pickle.dumps(self.snapshot(), protocol=pickle.HIGHEST_PROTOCOL))
+
+
+photo_cache = PhotoAnalysisCache()
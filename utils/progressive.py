@@ -0,0 +1,88 @@
+# progressive.py
+
+import asyncio
+import logging
+import os
+
+from telegram import Message
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Minimum seconds between two edits of the same message; Telegram starts answering 429 around one per second
+EDIT_INTERVAL = float(os.getenv("EDIT_INTERVAL", "1.5"))
+
+
+def _is_not_modified(exc: BadRequest) -> bool:
+    return "not modified" in exc.message.lower()
+
+
+class ProgressiveMessage:
+    """A Telegram message that shows text while it is still being generated.
+
+    ``push`` is cheap and can be called for every streamed token: edits are coalesced so the
+    message changes at most once per ``interval``, always to the latest text. ``finish`` sends
+    the final text right away. Without an existing ``message`` the first push replies to ``reply_to``.
+    """
+
+    def __init__(self, reply_to: Message, message: Message = None, interval: float = EDIT_INTERVAL):
+        self.reply_to = reply_to
+        self.message = message
+        self.interval = interval
+        self._latest = None
+        self._shown = message.text if message is not None else None
+        self._next_edit = 0.0
+        self._task = None
+
+    def push(self, text: str) -> None:
+        self._latest = text[:MessageLimit.MAX_TEXT_LENGTH]
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        delay = self._next_edit - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Everything pushed during the wait is sent in this one edit
+        if self._latest and self._latest != self._shown:
+            try:
+                await self._send(self._latest)
+            except TelegramError as exc:
+                # Partial updates are best effort, the final text still goes out in finish()
+                logger.warning("Progressive edit failed: %s", exc)
+
+    async def _send(self, text: str, **kwargs) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            if self.message is None:
+                self.message = await self.reply_to.reply_text(text, **kwargs)
+            else:
+                await self.message.edit_text(text, **kwargs)
+            self._shown = text
+        except RetryAfter as exc:
+            self._next_edit = loop.time() + exc.retry_after
+            raise
+        except BadRequest as exc:
+            if not _is_not_modified(exc):
+                raise
+        self._next_edit = max(self._next_edit, loop.time() + self.interval)
+
+    async def finish(self, text: str, **kwargs) -> Message:
+        if self._task is not None and not self._task.done():
+            if self.message is None:
+                # The first reply is on its way, cancelling could leave a duplicate message behind
+                await self._task
+            else:
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+
+        try:
+            await self._send(text, **kwargs)
+        except RetryAfter as exc:
+            await asyncio.sleep(exc.retry_after)
+            await self._send(text, **kwargs)
+        return self.message
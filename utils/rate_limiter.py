@@ -0,0 +1,132 @@
+# rate_limiter.py
+
+import asyncio
+import contextlib
+import logging
+import os
+from collections import OrderedDict
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from .scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Telegram's documented flood limits: about 30 messages per second overall, one per second in a
+# private chat (short bursts are tolerated) and 20 per minute in a group. Requests that got a 429
+# are retried up to TELEGRAM_MAX_RETRIES times after the retry_after Telegram asked for.
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+
+# Idle chats whose limits are forgotten first once there are more than this many
+MAX_CHAT_LIMITERS = 10000
+
+
+class FloodControlRateLimiter(BaseRateLimiter):
+    """Rate limiter for the bot's Telegram requests.
+
+    Requests aimed at a chat (sends, edits, ...) pass a global bucket and one bucket per chat;
+    requests without a chat (getUpdates, getFile, answerCallbackQuery) are not limited. After a
+    429 the chat is paused for retry_after and the request is sent again. ``rate_limit_args``
+    of a call overrides the number of retries.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, group_rate: float = TELEGRAM_GROUP_RATE,
+                 max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chat_limiters = OrderedDict()
+        # chat_id -> loop time until which Telegram asked us not to send
+        self._paused_until = {}
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.retry_after_hits = 0
+        self.retries = 0
+        self.failed = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_limiter(self, chat_id) -> tuple:
+        # (bucket, lock); the lock lets the requests of one chat through in the order they came
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            # Negative ids and @usernames are groups and channels
+            if isinstance(chat_id, str) or chat_id < 0:
+                limiter = (TokenBucket(self.group_rate, self.chat_burst), asyncio.Lock())
+            else:
+                limiter = (TokenBucket(self.chat_rate, self.chat_burst), asyncio.Lock())
+            self._chat_limiters[chat_id] = limiter
+            if len(self._chat_limiters) > MAX_CHAT_LIMITERS:
+                self._chat_limiters.popitem(last=False)
+        else:
+            self._chat_limiters.move_to_end(chat_id)
+        return limiter
+
+    async def _wait_for_turn(self, chat_id) -> None:
+        loop = asyncio.get_running_loop()
+        chat_bucket, lock = self._chat_limiter(chat_id)
+        waited = 0.0
+        async with lock:
+            while True:
+                delay = max(
+                    self._paused_until.get(chat_id, 0.0) - loop.time(),
+                    chat_bucket.wait_time(1),
+                    self.global_bucket.wait_time(1),
+                )
+                if delay <= 0:
+                    break
+                waited += delay
+                await asyncio.sleep(delay)
+            self._paused_until.pop(chat_id, None)
+            chat_bucket.take(1)
+            self.global_bucket.take(1)
+        if waited:
+            self.throttled += 1
+            self.throttled_seconds += waited
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+
+        self.requests += 1
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        for attempt in range(max_retries + 1):
+            await self._wait_for_turn(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                self.retry_after_hits += 1
+                if attempt == max_retries:
+                    self.failed += 1
+                    raise
+                logger.info("Flood control on %s for chat %s, retrying in %ss", endpoint, chat_id, exc.retry_after)
+                self.retries += 1
+                loop = asyncio.get_running_loop()
+                self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0.0),
+                                                  loop.time() + exc.retry_after)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "throttled_seconds": self.throttled_seconds,
+            "retry_after_hits": self.retry_after_hits,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
@@ -0,0 +1,289 @@
+# rollups.py
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from . import backend
+from .meal import Meal
+from .user_cache import resolve_user_id
+
+logger = logging.getLogger(__name__)
+
+# SQLite file with the per-user daily and weekly nutrition totals behind /stats, the UTC offset
+# (hours) days start at, how many days the trend chart shows and the backend page size of a rebuild
+ROLLUP_PATH = os.getenv("ROLLUP_PATH", "nutrition_rollups.sqlite3")
+STATS_UTC_OFFSET = float(os.getenv("STATS_UTC_OFFSET", "0"))
+STATS_TREND_DAYS = int(os.getenv("STATS_TREND_DAYS", "14"))
+ROLLUP_PAGE_SIZE = int(os.getenv("ROLLUP_PAGE_SIZE", "100"))
+
+TOTALS = ("meals", "calories", "carbs", "protein", "fat")
+
+
+def _local_date(timestamp: float) -> date:
+    return datetime.fromtimestamp(timestamp, timezone(timedelta(hours=STATS_UTC_OFFSET))).date()
+
+
+def buckets_of(timestamp: float) -> tuple:
+    """(day, week) bucket keys of a moment: the local date and the Monday of its week, ISO formatted."""
+    day = _local_date(timestamp)
+    return day.isoformat(), (day - timedelta(days=day.weekday())).isoformat()
+
+
+def _meal_totals(meal: Meal) -> tuple:
+    return (1, meal.calories, meal.carbohydrates, meal.protein, meal.fats)
+
+
+def _row_timestamp(row: dict):
+    # Backend food rows carry their creation time as ISO 8601; naive times are UTC
+    created_at = row.get("created_at")
+    if not created_at:
+        return None
+    moment = datetime.fromisoformat(created_at)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def _add_totals(buckets: dict, timestamp: float, totals: tuple) -> None:
+    day, week = buckets_of(timestamp)
+    for key in (("day", day), ("week", week)):
+        buckets[key] = tuple(a + b for a, b in zip(buckets.get(key, (0,) * len(TOTALS)), totals))
+
+
+class NutritionRollups:
+    """Daily and weekly meal totals per user, updated incrementally on every saved meal.
+
+    /stats reads a handful of rows by primary key instead of fetching the user's food history
+    (with its photos) from the backend. The totals can be rebuilt from the backend, page by page,
+    e.g. for users who saved meals before the rollups existed. Meals added while a rebuild of their
+    user runs are applied after it replaced the totals, unless the rebuild counted them already.
+    """
+
+    def __init__(self, path: str = ROLLUP_PATH, page_size: int = ROLLUP_PAGE_SIZE):
+        self.path = path
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._db = None
+        # telegram_id -> running rebuild, so concurrent /stats of one user share it
+        self._rebuilds = {}
+        # telegram_id -> (save id, timestamp, totals) of meals added while its rebuild runs
+        self._late = {}
+        self.added = 0
+        self.reads = 0
+        self.rebuilds = 0
+        self.rebuild_rows = 0
+        self.last_rebuild_seconds = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, by whichever worker thread gets there first
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rollups ("
+                "telegram_id INTEGER NOT NULL, period TEXT NOT NULL, bucket TEXT NOT NULL, "
+                "meals INTEGER NOT NULL, calories REAL NOT NULL, carbs REAL NOT NULL, protein REAL NOT NULL, "
+                "fat REAL NOT NULL, PRIMARY KEY (telegram_id, period, bucket)) WITHOUT ROWID"
+            )
+            # Users whose totals were rebuilt from the backend, and when
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rebuilt (telegram_id INTEGER PRIMARY KEY, rebuilt_at REAL NOT NULL)"
+            )
+        return self._db
+
+    # Blocking parts, run on worker threads
+
+    def _add(self, telegram_id: int, timestamp: float, totals: tuple) -> None:
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for period, bucket in zip(("day", "week"), buckets_of(timestamp)):
+                    db.execute(
+                        "INSERT INTO rollups (telegram_id, period, bucket, meals, calories, carbs, protein, fat) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (telegram_id, period, bucket) DO UPDATE SET "
+                        "meals = meals + excluded.meals, calories = calories + excluded.calories, "
+                        "carbs = carbs + excluded.carbs, protein = protein + excluded.protein, fat = fat + excluded.fat",
+                        (telegram_id, period, bucket, *totals),
+                    )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def _replace(self, telegram_id: int, buckets: dict) -> None:
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DELETE FROM rollups WHERE telegram_id = ?", (telegram_id,))
+                db.executemany(
+                    "INSERT INTO rollups (telegram_id, period, bucket, meals, calories, carbs, protein, fat) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(telegram_id, period, bucket, *totals) for (period, bucket), totals in buckets.items()],
+                )
+                db.execute(
+                    "INSERT INTO rebuilt (telegram_id, rebuilt_at) VALUES (?, ?) "
+                    "ON CONFLICT (telegram_id) DO UPDATE SET rebuilt_at = excluded.rebuilt_at",
+                    (telegram_id, time.time()),
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def _summary(self, telegram_id: int, now: float) -> dict:
+        today, this_week = buckets_of(now)
+        first_day = (date.fromisoformat(today) - timedelta(days=STATS_TREND_DAYS - 1)).isoformat()
+        last_week = (date.fromisoformat(this_week) - timedelta(weeks=1)).isoformat()
+        with self._lock:
+            db = self._connect()
+            # Primary key ranges: at most STATS_TREND_DAYS + 2 rows, however long the user's history
+            days = db.execute(
+                "SELECT bucket, meals, calories, carbs, protein, fat FROM rollups "
+                "WHERE telegram_id = ? AND period = 'day' AND bucket >= ? AND bucket <= ?",
+                (telegram_id, first_day, today),
+            ).fetchall()
+            weeks = db.execute(
+                "SELECT bucket, meals, calories, carbs, protein, fat FROM rollups "
+                "WHERE telegram_id = ? AND period = 'week' AND bucket IN (?, ?)",
+                (telegram_id, this_week, last_week),
+            ).fetchall()
+            rebuilt = db.execute("SELECT 1 FROM rebuilt WHERE telegram_id = ?", (telegram_id,)).fetchone()
+        empty = dict.fromkeys(TOTALS, 0)
+        by_day = {bucket: dict(zip(TOTALS, totals)) for bucket, *totals in days}
+        by_week = {bucket: dict(zip(TOTALS, totals)) for bucket, *totals in weeks}
+        trend = []
+        for offset in range(STATS_TREND_DAYS - 1, -1, -1):
+            day = (date.fromisoformat(today) - timedelta(days=offset)).isoformat()
+            trend.append(dict(by_day.get(day, empty), day=day))
+        return {
+            "today": by_day.get(today, empty),
+            "this_week": by_week.get(this_week, empty),
+            "last_week": by_week.get(last_week, empty),
+            # Days of this week so far, for the daily average
+            "week_days": date.fromisoformat(today).weekday() + 1,
+            "trend": trend,
+            "rebuilt": rebuilt is not None,
+        }
+
+    def _close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # Public API
+
+    async def add(self, telegram_id: int, meal: Meal, timestamp: float = None, save_id: str = None) -> None:
+        """Adds a saved meal to the day and week it was eaten in; ``save_id`` is its save queue record id."""
+        timestamp = time.time() if timestamp is None else timestamp
+        late = self._late.get(telegram_id)
+        if late is not None:
+            # The running rebuild would wipe it, it is applied once the totals are replaced
+            late.append((save_id, timestamp, _meal_totals(meal)))
+        else:
+            await asyncio.to_thread(self._add, telegram_id, timestamp, _meal_totals(meal))
+        self.added += 1
+
+    async def summary(self, telegram_id: int, now: float = None) -> dict:
+        """Totals of today, this week and last week, and the daily totals of the trend chart."""
+        self.reads += 1
+        return await asyncio.to_thread(self._summary, telegram_id, time.time() if now is None else now)
+
+    async def rebuild(self, telegram_id: int, queue=None) -> int:
+        """Recomputes a user's totals from the backend's food rows and returns how many were counted.
+
+        ``queue`` is the save queue (``pending_meals`` and ``delivered_id``): saves not in the backend
+        yet are counted too, and saves delivered while the rows are read are counted once.
+        Rebuilds of the same user at the same time are done once.
+        """
+        task = self._rebuilds.get(telegram_id)
+        if task is None:
+            task = self._rebuilds[telegram_id] = asyncio.ensure_future(self._rebuild(telegram_id, queue))
+            task.add_done_callback(lambda _: self._rebuilds.pop(telegram_id, None))
+        return await asyncio.shield(task)
+
+    async def _rebuild(self, telegram_id: int, queue) -> int:
+        start = time.perf_counter()
+        # The cut: saves pending now are counted from the queue unless the backend rows have them,
+        # meals added from now on are applied after the replace
+        late = self._late[telegram_id] = []
+        pending = [] if queue is None else queue.pending_meals(telegram_id)
+        delivered_id = (lambda save_id: None) if queue is None else queue.delivered_id
+        # Only the totals and the row ids are kept, so memory stays at one page of rows plus those
+        buckets = {}
+        seen = set()
+        counted_saves = set()
+        counted = skipped = 0
+        replaced = False
+        try:
+            user_id = await resolve_user_id(telegram_id)
+            skip = 0
+            while user_id is not None:
+                response = await backend.list_foods(user_id, skip, self.page_size)
+                if response.status_code == 404:
+                    break
+                response.raise_for_status()
+                rows = response.json()
+                for row in rows:
+                    timestamp = _row_timestamp(row)
+                    if timestamp is None:
+                        skipped += 1
+                        continue
+                    _add_totals(buckets, timestamp, (1, row.get("calories") or 0, row.get("carb") or 0,
+                                                     row.get("protein") or 0, row.get("fat") or 0))
+                    if row.get("id") is not None:
+                        seen.add(row["id"])
+                    counted += 1
+                if len(rows) < self.page_size:
+                    break
+                skip += len(rows)
+            for save_id, timestamp, meal in pending:
+                # Delivered while the pages were read, and on one of them
+                if delivered_id(save_id) in seen:
+                    continue
+                _add_totals(buckets, timestamp, _meal_totals(meal))
+                counted_saves.add(save_id)
+                counted += 1
+            await asyncio.to_thread(self._replace, telegram_id, buckets)
+            replaced = True
+        finally:
+            # Late meals the rebuild did not count (all of them if it failed); more may come while these are written
+            while late:
+                batch = late[:]
+                late.clear()
+                for save_id, timestamp, totals in batch:
+                    if replaced and save_id is not None and (save_id in counted_saves or delivered_id(save_id) in seen):
+                        continue
+                    await asyncio.to_thread(self._add, telegram_id, timestamp, totals)
+            del self._late[telegram_id]
+
+        self.rebuilds += 1
+        self.rebuild_rows += counted
+        self.last_rebuild_seconds = time.perf_counter() - start
+        if skipped:
+            logger.warning("Rebuild of %s skipped %d food rows without created_at", telegram_id, skipped)
+        logger.info("Rebuilt nutrition totals of %s from %d meals in %.2fs", telegram_id, counted, self.last_rebuild_seconds)
+        return counted
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close)
+
+    def stats(self) -> dict:
+        return {
+            "added": self.added,
+            "reads": self.reads,
+            "rebuilds": self.rebuilds,
+            "rebuild_rows": self.rebuild_rows,
+            "last_rebuild_seconds": self.last_rebuild_seconds,
+        }
+
+
+nutrition_rollups = NutritionRollups()
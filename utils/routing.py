@@ -0,0 +1,105 @@
+# routing.py
+
+import os
+import re
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass
+
+from .metrics import metrics
+
+# Model of the text answers, and of the long ones (plans, detailed explanations)
+TEXT_MODEL = os.getenv("TEXT_MODEL", "gpt-4o-mini")
+TEXT_DETAILED_MODEL = os.getenv("TEXT_DETAILED_MODEL", TEXT_MODEL)
+
+# USD per million (prompt, completion) tokens, for the cost estimates in the stats
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    model: str
+    max_tokens: int
+    max_words: int
+    use_history: bool
+    cacheable: bool
+
+
+# Greetings and thanks get a short answer. General health questions are answered without the chat
+# history, so their answers do not depend on the user and can be cached. Follow-ups ("is this
+# meal ok?") need the history; so do plans and detailed explanations, which get the full budget.
+ROUTES = {
+    "smalltalk": Route("smalltalk", TEXT_MODEL, 120, 60, use_history=False, cacheable=True),
+    "general": Route("general", TEXT_MODEL, 450, 250, use_history=False, cacheable=True),
+    "followup": Route("followup", TEXT_MODEL, 700, 350, use_history=True, cacheable=False),
+    "detailed": Route("detailed", TEXT_DETAILED_MODEL, 1024, 500, use_history=True, cacheable=False),
+}
+
+SMALLTALK_WORDS = {
+    "hi", "hello", "hey", "thanks", "thank", "you", "ok", "okay", "cool", "great", "nice", "bye", "good",
+    "morning", "evening", "night", "awesome", "perfect", "thx", "ty",
+}
+# Words that point back at the conversation: the meal just analyzed, an earlier answer
+FOLLOWUP_WORDS = {"this", "that", "it", "these", "those", "above", "previous", "earlier", "again", "same", "instead"}
+FOLLOWUP_PHRASES = ("my meal", "the meal", "my photo", "the photo", "you said", "what about", "and if")
+DETAILED_WORDS = {"plan", "plans", "schedule", "program", "routine", "recipe", "recipes", "week", "weekly",
+                  "detail", "detailed", "explain", "compare", "list"}
+DETAILED_MIN_WORDS = 25
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+
+
+def normalize_question(text: str) -> str:
+    # Case, accents of compatibility characters, punctuation, emoji and spacing do not change a question
+    text = unicodedata.normalize("NFKC", text).lower()
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+class QuestionRouter:
+    """Picks model, token budget and whether the history is needed for a text message."""
+
+    def __init__(self, routes: dict = ROUTES):
+        self.routes = routes
+        self.counts = Counter()
+        # History left out of the prompts of routes that do not need it
+        self.history_tokens_skipped = 0
+        self.history_cost_skipped = 0.0
+
+    def classify(self, normalized: str) -> str:
+        words = normalized.split()
+        if not words or all(word in SMALLTALK_WORDS for word in words):
+            return "smalltalk"
+        if len(words) >= DETAILED_MIN_WORDS or DETAILED_WORDS.intersection(words):
+            return "detailed"
+        if FOLLOWUP_WORDS.intersection(words) or any(phrase in normalized for phrase in FOLLOWUP_PHRASES):
+            return "followup"
+        return "general"
+
+    def route(self, normalized: str) -> Route:
+        route = self.routes[self.classify(normalized)]
+        self.counts[route.name] += 1
+        metrics.inc("text_questions_total", route=route.name)
+        return route
+
+    def skip_history(self, route: Route, tokens: int) -> None:
+        self.history_tokens_skipped += tokens
+        self.history_cost_skipped += estimate_cost(route.model, tokens, 0)
+
+    def stats(self) -> dict:
+        return {
+            **self.counts,
+            "history_tokens_skipped": self.history_tokens_skipped,
+            "history_cost_skipped_usd": self.history_cost_skipped,
+        }
+
+
+question_router = QuestionRouter()
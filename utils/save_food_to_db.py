@@ -1,45 +1,41 @@
 # save_food_to_db.py
 
-import requests
 import base64
-from .chart import extract_nutrition_data
+from . import backend
+from .meal import Meal
+from .user_cache import resolve_user_id, user_cache
 
-API_BASE_URL = "https://lipo-out-backend-production.up.railway.app"  # Adjust this URL to your backend
+async def write_food_photo_to_db(telegram_id: int, photo: bytes, meal: Meal):
+    """Stores a meal and returns the id of its food row (True if the backend did not say);
+    returns False if the backend rejected it, raises if it could not be reached."""
+    # Step 1: Get the user id, from the identity cache when possible
+    user_id = await resolve_user_id(telegram_id)
+    if user_id is None:
+        return False  # Optionally handle user not found by creating a new user or raising an error
 
-def write_food_photo_to_db(telegram_id: int, photo: bytes, response_text: str):
-    # Step 1: Get the user by telegram_id
-    user_response = requests.get(f"{API_BASE_URL}/users/?telegram_id={telegram_id}")
-    
-    if user_response.status_code == 404 or not user_response.json():
-        print("User not found.")
-        return  # Optionally handle user not found by creating a new user or raising an error
-    elif user_response.status_code != 200:
-        print("Failed to fetch user:", user_response.json())
-        return
-
-    # Extract user_id from the response (assuming the first result)
-    user_data = user_response.json()[0]  # Access the first item in the list
-    user_id = user_data["id"]
-
-    # Step 2: Extract nutrition data
-    nutrition_data = extract_nutrition_data(response_text)
-    
-    # Prepare data for the POST request
+    # Step 2: Prepare data for the POST request from the already parsed meal
     food_data = {
         "user_id": user_id,
-        "food_analysis": response_text,
+        "food_analysis": meal.to_text(),
         "food_photo": base64.b64encode(photo).decode("utf-8"),  # Encode photo in base64
-        "calories": nutrition_data["calories"],
-        "carb": nutrition_data["carbohydrates"],
-        "protein": nutrition_data["protein"],
-        "fat": nutrition_data["fats"]
+        "calories": meal.calories,
+        "carb": meal.carbohydrates,
+        "protein": meal.protein,
+        "fat": meal.fats
     }
 
     # Step 3: Make the POST request to create a food entry
-    response = requests.post(f"{API_BASE_URL}/foods/", json=food_data)
+    response = await backend.create_food(food_data)
     
     # Check if the request was successful
+    if response.status_code >= 500:
+        response.raise_for_status()
     if response.status_code == 201:
         print("Photo and analysis successfully stored in the database.")
-    else:
-        print("Failed to store photo and analysis:", response.json())
\ No newline at end of file
+        return response.json().get("id") or True
+    if response.status_code == 404:
+        # The cached user id is stale; forget it and fail, so the retry looks the user up again
+        user_cache.invalidate(telegram_id)
+        response.raise_for_status()
+    print("Failed to store photo and analysis:", response.json())
+    return False
\ No newline at end of file
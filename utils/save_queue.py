@@ -0,0 +1,327 @@
+# save_queue.py
+
+import asyncio
+import base64
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict
+
+from .meal import Meal
+from .save_food_to_db import write_food_photo_to_db
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; run a single process per journal there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Journal file, how many saves are sent together, how long to wait for a batch to fill up (seconds)
+# and the retry backoff of saves the backend could not take (seconds, doubled per attempt up to the max)
+SAVE_QUEUE_PATH = os.getenv("SAVE_QUEUE_PATH", "save_queue.jsonl")
+SAVE_BATCH_SIZE = int(os.getenv("SAVE_BATCH_SIZE", "10"))
+SAVE_FLUSH_INTERVAL = float(os.getenv("SAVE_FLUSH_INTERVAL", "0.5"))
+SAVE_RETRY_BACKOFF = float(os.getenv("SAVE_RETRY_BACKOFF", "2"))
+SAVE_RETRY_MAX_BACKOFF = float(os.getenv("SAVE_RETRY_MAX_BACKOFF", "300"))
+# Seconds stop() waits for a batch being sent to finish before cancelling it
+SAVE_STOP_TIMEOUT = float(os.getenv("SAVE_STOP_TIMEOUT", "15"))
+
+# Processes sharing SAVE_QUEUE_PATH (replicas on one volume) each claim a journal of their own:
+# the first of SAVE_QUEUE_PATH, save_queue.1.jsonl, save_queue.2.jsonl, ... not locked by another
+SAVE_QUEUE_MAX_SLOTS = 64
+
+# Recently delivered saves whose backend food row id is remembered, for rebuilds of the /stats totals
+SAVE_DELIVERED_KEPT = 10000
+
+
+class SaveQueue:
+    """Write-behind queue for meal saves, journaled to disk so queued saves survive restarts.
+
+    The journal is a JSON-lines file of ``add`` and ``done`` records; on start the adds without
+    a matching done are queued again and the file is rewritten with only those. A process holds an
+    exclusive lock on its journal while it runs, so two processes never replay the same saves; the
+    saves left in the journals of processes that are gone are taken over on start.
+    """
+
+    def __init__(self, path: str = SAVE_QUEUE_PATH, batch_size: int = SAVE_BATCH_SIZE,
+                 flush_interval: float = SAVE_FLUSH_INTERVAL, store=write_food_photo_to_db):
+        self.base_path = path
+        # Journal this process claimed, set on start
+        self.path = path
+        self._lock_fd = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.store = store
+        self._pending = {}
+        # record id -> id of the backend food row it became, of the last SAVE_DELIVERED_KEPT deliveries
+        self._delivered = OrderedDict()
+        self._done_records = 0
+        # Journal writes happen on worker threads; one at a time so lines never interleave
+        self._journal_lock = threading.Lock()
+        # Held while a new save is journaled and while the journal is compacted, so no add gets lost
+        self._compaction_guard = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._stopping = False
+        self.stored = 0
+        self.rejected = 0
+        self.retries = 0
+        self.last_flush_seconds = 0.0
+        self.last_save_delay = 0.0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    # Journal
+
+    def _append(self, *records: dict) -> None:
+        with self._journal_lock, open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _slot_path(self, slot: int) -> str:
+        if slot == 0:
+            return self.base_path
+        root, ext = os.path.splitext(self.base_path)
+        return f"{root}.{slot}{ext}"
+
+    def _try_lock(self, path: str):
+        # The lock file is never deleted, so every process locks the same inode
+        fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _claim(self) -> None:
+        if fcntl is None:
+            return
+        for slot in range(SAVE_QUEUE_MAX_SLOTS):
+            fd = self._try_lock(self._slot_path(slot))
+            if fd is not None:
+                self._lock_fd = fd
+                self.path = self._slot_path(slot)
+                if slot:
+                    logger.info("Save queue journal %s is in use, journaling to %s", self.base_path, self.path)
+                return
+        raise RuntimeError(f"All {SAVE_QUEUE_MAX_SLOTS} save queue journals next to {self.base_path} are in use")
+
+    def _release(self) -> None:
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    @staticmethod
+    def _read(path: str) -> list:
+        records = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash in the middle of an append leaves a truncated last line
+                        continue
+                    if record["op"] == "add":
+                        records[record["id"]] = record
+                    else:
+                        records.pop(record["id"], None)
+        except FileNotFoundError:
+            pass
+        return list(records.values())
+
+    def _orphaned_journals(self) -> list:
+        root, ext = os.path.splitext(self.base_path)
+        slot_pattern = re.compile(re.escape(root) + r"\.\d+" + re.escape(ext) + "$")
+        paths = [self.base_path] + sorted(path for path in glob.glob(f"{glob.escape(root)}.*{glob.escape(ext)}")
+                                          if slot_pattern.match(path))
+        return [path for path in paths if path != self.path and os.path.exists(path)]
+
+    def _load(self) -> None:
+        self._claim()
+        records = self._read(self.path)
+
+        # Journals of processes that stopped (e.g. after scaling down) would otherwise never be replayed
+        adopted = []
+        if fcntl is not None:
+            for path in self._orphaned_journals():
+                fd = self._try_lock(path)
+                if fd is None:
+                    continue
+                try:
+                    orphans = self._read(path)
+                    # Ours first, then the orphan is gone: a crash in between replays, never loses
+                    self._rewrite(records + adopted + orphans)
+                    adopted += orphans
+                    os.remove(path)
+                finally:
+                    os.close(fd)
+                if orphans:
+                    logger.info("Took over %d queued meal saves from %s", len(orphans), path)
+        records += adopted
+
+        for record in records:
+            self._pending[record["id"]] = self._entry(record)
+        self._rewrite(records)
+        if self._pending:
+            logger.info("Restored %d queued meal saves from %s", len(self._pending), self.path)
+
+    def _rewrite(self, records: list) -> None:
+        # Compact the journal down to the saves that are still pending
+        tmp_path = f"{self.path}.tmp"
+        with self._journal_lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _entry(record: dict) -> dict:
+        return {"record": record, "attempts": 0, "next_attempt": 0.0}
+
+    # Public API
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self._load)
+        self._stopping = False
+        self._worker = asyncio.create_task(self._run())
+        if self._pending:
+            self._wakeup.set()
+
+    async def stop(self, timeout: float = SAVE_STOP_TIMEOUT) -> None:
+        # Whatever is still pending stays in the journal for the next start. A batch being sent is
+        # awaited first: cancelled, the saves the backend committed would get no done record and
+        # be sent again on the next start.
+        if self._worker is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._worker), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Save queue batch still running after %gs, cancelling it", timeout)
+                self._worker.cancel()
+                try:
+                    await self._worker
+                except asyncio.CancelledError:
+                    pass
+            self._worker = None
+        self._release()
+
+    async def enqueue(self, telegram_id: int, photo: bytes, meal: Meal) -> str:
+        """Journals a save and returns as soon as it is on disk; the backend write happens later."""
+        record = {
+            "op": "add",
+            "id": uuid.uuid4().hex,
+            "telegram_id": telegram_id,
+            "photo": base64.b64encode(photo).decode("utf-8"),
+            "meal": asdict(meal),
+            "queued_at": time.time(),
+        }
+        async with self._compaction_guard:
+            await asyncio.to_thread(self._append, record)
+            self._pending[record["id"]] = self._entry(record)
+        self._wakeup.set()
+        return record["id"]
+
+    def pending_meals(self, telegram_id: int) -> list:
+        """(record id, queued_at, Meal) of a user's saves the backend does not have yet."""
+        return [
+            (record_id, entry["record"]["queued_at"], Meal(**entry["record"]["meal"]))
+            for record_id, entry in self._pending.items() if entry["record"]["telegram_id"] == telegram_id
+        ]
+
+    def delivered_id(self, record_id: str):
+        """Backend food row id a recently delivered save became, None if not known."""
+        return self._delivered.get(record_id)
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._pending),
+            "stored": self.stored,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "last_flush_seconds": self.last_flush_seconds,
+            "last_save_delay_seconds": self.last_save_delay,
+        }
+
+    # Worker
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            # Give concurrent saves a moment to join the batch
+            await asyncio.sleep(self.flush_interval)
+
+            while not self._stopping:
+                now = time.time()
+                due = [entry for entry in self._pending.values() if entry["next_attempt"] <= now]
+                if not due:
+                    break
+                await self._flush(due[:self.batch_size])
+
+            # Come back when the earliest failed save may be retried
+            if self._pending:
+                next_attempt = min(entry["next_attempt"] for entry in self._pending.values())
+                loop.call_later(max(next_attempt - time.time(), 0), self._wakeup.set)
+
+    async def _flush(self, batch: list) -> None:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(self._deliver(entry["record"]) for entry in batch), return_exceptions=True)
+        self.last_flush_seconds = time.perf_counter() - start
+
+        finished = []
+        for entry, result in zip(batch, results):
+            record = entry["record"]
+            if isinstance(result, BaseException):
+                entry["attempts"] += 1
+                entry["next_attempt"] = time.time() + min(SAVE_RETRY_BACKOFF * 2 ** (entry["attempts"] - 1), SAVE_RETRY_MAX_BACKOFF)
+                self.retries += 1
+                logger.warning("Saving meal %s failed (attempt %d): %r", record["id"], entry["attempts"], result)
+                continue
+            if result:
+                self.stored += 1
+                self.last_save_delay = time.time() - record["queued_at"]
+                # The store answers with the food row id; bool is an int too, but True is no row
+                if type(result) is int:
+                    self._delivered[record["id"]] = result
+                    if len(self._delivered) > SAVE_DELIVERED_KEPT:
+                        self._delivered.popitem(last=False)
+            else:
+                # The backend refused it (e.g. unknown user), retrying will not help
+                self.rejected += 1
+            finished.append(record["id"])
+
+        if finished:
+            for record_id in finished:
+                self._pending.pop(record_id, None)
+            await asyncio.to_thread(self._append, *({"op": "done", "id": record_id} for record_id in finished))
+            self._done_records += len(finished)
+            if self._done_records > 100 and self._done_records > len(self._pending):
+                self._done_records = 0
+                async with self._compaction_guard:
+                    await asyncio.to_thread(self._rewrite, [entry["record"] for entry in self._pending.values()])
+
+    async def _deliver(self, record: dict) -> bool:
+        photo = base64.b64decode(record["photo"])
+        return await self.store(record["telegram_id"], photo, Meal(**record["meal"]))
+
+
+save_queue = SaveQueue()
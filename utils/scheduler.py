@@ -0,0 +1,186 @@
+# scheduler.py
+
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, nullcontext
+
+# Vision analyses running at once, the OpenAI tier limits they must stay under (requests and
+# tokens per minute), how many seconds of that quota may be used in one burst (OpenAI enforces
+# the limits over windows shorter than a minute) and the tokens one analysis is estimated to use
+# (prompt, image and answer)
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "8"))
+ANALYSIS_RPM = float(os.getenv("ANALYSIS_RPM", "500"))
+ANALYSIS_TPM = float(os.getenv("ANALYSIS_TPM", "30000"))
+ANALYSIS_BURST = float(os.getenv("ANALYSIS_BURST", "10"))
+ANALYSIS_TOKENS = int(os.getenv("ANALYSIS_TOKENS", "2000"))
+
+
+class TokenBucket:
+    """Refills ``rate`` units per second up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # Seconds until ``amount`` is available (0 if it is now); asking for more than fits is capped
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+
+class _Waiter:
+    __slots__ = ("user_id", "cost", "future", "on_position", "position")
+
+    def __init__(self, user_id, cost: float, future: asyncio.Future, on_position):
+        self.user_id = user_id
+        self.cost = cost
+        self.future = future
+        self.on_position = on_position
+        self.position = None
+
+
+class AnalysisScheduler:
+    """Admission control for vision analyses.
+
+    Requests queue per user and users are served round-robin, so someone sending twenty photos
+    gets one analysis per turn like everybody else. A request starts when a concurrency slot is
+    free and both token buckets (requests and tokens per minute) can pay for it. Queued requests
+    are told their position (1 = next) whenever it changes.
+    """
+
+    def __init__(self, max_concurrent: int = ANALYSIS_CONCURRENCY, rpm: float = ANALYSIS_RPM,
+                 tpm: float = ANALYSIS_TPM, burst: float = ANALYSIS_BURST):
+        self.max_concurrent = max_concurrent
+        self.requests = TokenBucket(rpm / 60, max(rpm / 60 * burst, 1))
+        self.tokens = TokenBucket(tpm / 60, tpm / 60 * burst)
+        # user_id -> deque of waiters, in the order users get their turn
+        self._queues = OrderedDict()
+        self._running = 0
+        self._timer = None
+        self.started = 0
+        self.queued = 0
+        self.max_wait = 0.0
+
+    def __len__(self) -> int:
+        return sum(len(waiters) for waiters in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, user_id, cost: float = ANALYSIS_TOKENS, on_position=None, while_queued=None):
+        """Waits for the user's turn; on_position(n) is called while n requests are ahead of it.
+
+        If the request has to queue, the wait runs inside the ``while_queued()`` context manager
+        (e.g. one that frees resources the caller holds but does not need until its turn).
+        """
+        await self.acquire(user_id, cost, on_position, while_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, user_id, cost: float = ANALYSIS_TOKENS, on_position=None, while_queued=None) -> None:
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(user_id, cost, loop.create_future(), on_position)
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        enqueued = time.monotonic()
+        self._dispatch()
+        if not waiter.future.done():
+            self.queued += 1
+            self._report_positions()
+        try:
+            if not waiter.future.done():
+                async with (while_queued() if while_queued is not None else nullcontext()):
+                    await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just before the cancellation arrived
+                self.release()
+            else:
+                self._remove(waiter)
+            raise
+        self.max_wait = max(self.max_wait, time.monotonic() - enqueued)
+
+    def release(self) -> None:
+        self._running -= 1
+        self._dispatch()
+        self._report_positions()
+
+    def _remove(self, waiter: _Waiter) -> None:
+        waiters = self._queues.get(waiter.user_id)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del self._queues[waiter.user_id]
+        self._report_positions()
+
+    def _dispatch(self) -> None:
+        while self._running < self.max_concurrent and self._queues:
+            user_id, waiters = next(iter(self._queues.items()))
+            waiter = waiters[0]
+            delay = max(self.requests.wait_time(1), self.tokens.wait_time(waiter.cost))
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+                return
+            self.requests.take(1)
+            self.tokens.take(waiter.cost)
+            waiters.popleft()
+            # The user goes to the back of the line for their next request
+            del self._queues[user_id]
+            if waiters:
+                self._queues[user_id] = waiters
+            self._running += 1
+            self.started += 1
+            waiter.future.set_result(None)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+        self._report_positions()
+
+    def _report_positions(self) -> None:
+        # Walk the queue in the order it will be served: first request of every user, then the second, ...
+        position = 0
+        depth = 0
+        lines = list(self._queues.values())
+        while lines:
+            remaining = []
+            for waiters in lines:
+                if depth < len(waiters):
+                    position += 1
+                    waiter = waiters[depth]
+                    if waiter.position != position:
+                        waiter.position = position
+                        if waiter.on_position is not None:
+                            waiter.on_position(position)
+                    if depth + 1 < len(waiters):
+                        remaining.append(waiters)
+            lines = remaining
+            depth += 1
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "queued": len(self),
+            "queued_users": len(self._queues),
+            "started": self.started,
+            "had_to_wait": self.queued,
+            "max_wait_seconds": self.max_wait,
+        }
+
+
+analysis_scheduler = AnalysisScheduler()
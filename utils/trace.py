@@ -0,0 +1,44 @@
+# trace.py
+
+import json
+import logging
+import os
+import time
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# File incoming updates are appended to as JSON lines, to replay real traffic with
+# benchmarks/bench_load.py --replay; empty disables recording. A trace holds user ids and
+# message texts, keep it as private as the production database.
+UPDATE_TRACE_PATH = os.getenv("UPDATE_TRACE_PATH", "")
+
+
+class UpdateRecorder:
+    """Appends every incoming update with its arrival time (unix seconds) to a trace file."""
+
+    def __init__(self, path: str = UPDATE_TRACE_PATH):
+        self.path = path
+        self._file = None
+        self.recorded = 0
+
+    async def record(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if self._file is None:
+            # Line buffered: a crash loses at most the update being written
+            self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+            logger.info("Recording updates to %s", self.path)
+        self._file.write(json.dumps({"ts": round(time.time(), 3), "update": update.to_dict()}, ensure_ascii=False) + "\n")
+        self.recorded += 1
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self) -> dict:
+        return {"recorded": self.recorded}
+
+
+update_recorder = UpdateRecorder()
@@ -0,0 +1,140 @@
+# update_processor.py
+
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class _ChatLane:
+    # Lock that serializes one chat's updates, plus how many updates are holding or waiting on it
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class _RunningSlot:
+    # One of the processor's running slots, as held by the handler (or lane body) of the current task
+    __slots__ = ("semaphore", "owner", "held")
+
+    def __init__(self, semaphore: asyncio.Semaphore):
+        self.semaphore = semaphore
+        self.owner = asyncio.current_task()
+        self.held = False
+
+    async def acquire(self) -> None:
+        await self.semaphore.acquire()
+        self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+
+_running_slot = contextvars.ContextVar("running_slot", default=None)
+
+
+@asynccontextmanager
+async def released_slot():
+    """Gives the current handler's running slot back while the body waits, e.g. in a queue.
+
+    The chat lane stays held, so the chat's later updates still wait; other chats' updates can
+    use the slot meanwhile. It is taken back before the body's caller continues. Outside a
+    ChatOrderedUpdateProcessor handler this does nothing.
+    """
+    slot = _running_slot.get()
+    # Tasks a handler creates inherit its context, but not its slot
+    if slot is None or not slot.held or slot.owner is not asyncio.current_task():
+        yield
+        return
+    slot.release()
+    try:
+        yield
+    finally:
+        await slot.acquire()
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping the updates of a single chat in order.
+
+    ``max_concurrent_updates`` caps how many handlers run at once across all chats. Updates
+    waiting for their chat's previous update do not occupy one of those slots; at most
+    ``max_pending_updates`` updates may be accepted (running or waiting) at a time.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = None):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        # The base class semaphore bounds accepted updates, our own one bounds running handlers
+        super().__init__(max_pending_updates or max_concurrent_updates * 16)
+        self._running_limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._lanes = {}
+
+    @property
+    def running_limit(self) -> int:
+        return self._running_limit
+
+    @staticmethod
+    def ordering_key(update: object):
+        # Updates without a chat (e.g. pre-checkout queries) fall back to the user, or are not ordered at all
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    @asynccontextmanager
+    async def lane(self, update: object):
+        """Runs the body in the update's chat lane and a running slot, like a handler of that chat.
+
+        For work a handler hands off to a task (e.g. an album answered once all of its photos
+        arrived) that must still not overlap the chat's other updates.
+        """
+        key = self.ordering_key(update)
+        if key is None:
+            async with self._running():
+                yield
+            return
+
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _ChatLane()
+        lane.users += 1
+        try:
+            # asyncio.Lock wakes waiters in FIFO order, so a chat's updates run in arrival order
+            async with lane.lock:
+                async with self._running():
+                    yield
+        finally:
+            lane.users -= 1
+            if lane.users == 0:
+                del self._lanes[key]
+
+    @asynccontextmanager
+    async def _running(self):
+        slot = _RunningSlot(self._slots)
+        await slot.acquire()
+        token = _running_slot.set(slot)
+        try:
+            yield
+        finally:
+            _running_slot.reset(token)
+            slot.release()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        async with self.lane(update):
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
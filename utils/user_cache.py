@@ -0,0 +1,52 @@
+# user_cache.py
+
+import os
+import time
+
+from . import backend
+from .lru import LRUCache
+
+# Identities kept (LRU) and how long a cached telegram_id -> user_id mapping is trusted (seconds)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", str(24 * 3600)))
+
+
+class UserIdCache(LRUCache):
+    """In-process LRU/TTL cache of backend user ids by Telegram user id."""
+
+    def __init__(self, max_entries: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        super().__init__(max_entries, ttl, clock=time.monotonic)
+
+    def remember(self, telegram_id: int, payload):
+        # Backend user lookups answer with a list, creates with the user itself
+        users = payload if isinstance(payload, list) else [payload]
+        for user in users:
+            if isinstance(user, dict) and "id" in user and user.get("telegram_id", telegram_id) == telegram_id:
+                self.put(telegram_id, user["id"])
+                return user["id"]
+        return None
+
+
+user_cache = UserIdCache()
+
+
+async def resolve_user_id(telegram_id: int):
+    """Returns the backend user id of a Telegram user, or None if the backend does not know them.
+
+    Raises httpx.HTTPStatusError on server errors so callers can retry later.
+    """
+    user_id = user_cache.get(telegram_id)
+    if user_id is not None:
+        return user_id
+
+    response = await backend.get_user_by_telegram_id(telegram_id)
+    if response.status_code >= 500:
+        response.raise_for_status()
+    if response.status_code == 404 or not response.json():
+        print("User not found.")
+        return None
+    elif response.status_code != 200:
+        print("Failed to fetch user:", response.json())
+        return None
+
+    return user_cache.remember(telegram_id, response.json())
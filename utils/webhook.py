@@ -0,0 +1,124 @@
+# webhook.py
+
+import asyncio
+import logging
+import os
+import signal
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from .metrics import handle_metrics
+
+logger = logging.getLogger(__name__)
+
+# Public base URL Telegram posts to, the path of the webhook route, the secret Telegram echoes
+# back in a header, the listening port, how many updates may wait before Telegram is asked to retry
+# later, and how long (seconds) in-flight updates get to finish on shutdown
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_QUEUE = int(os.getenv("WEBHOOK_MAX_QUEUE", "1000"))
+PORT = int(os.getenv("PORT", "8080"))
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """aiohttp server feeding Telegram webhook updates into an Application's update queue.
+
+    GET /healthz answers 200 while the replica accepts updates and 503 once it is draining,
+    so a load balancer stops routing to it before it goes away. GET /metrics serves the
+    Prometheus metrics.
+    """
+
+    def __init__(self, application: Application, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 max_queue: int = WEBHOOK_MAX_QUEUE):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.max_queue = max_queue
+        self.draining = False
+        self.received = 0
+        self.rejected = 0
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get("/healthz", self.handle_health)
+        self.app.router.add_get("/metrics", handle_metrics)
+        self._runner = None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=403)
+        # Any non-2xx makes Telegram deliver the update again later, possibly to another replica
+        if self.draining or self.application.update_queue.qsize() >= self.max_queue:
+            self.rejected += 1
+            return web.Response(status=503)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        await self.application.update_queue.put(update)
+        self.received += 1
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        status = 503 if self.draining else 200
+        return web.json_response({
+            "status": "draining" if self.draining else "ok",
+            "queued_updates": self.application.update_queue.qsize(),
+            "received": self.received,
+            "rejected": self.rejected,
+        }, status=status)
+
+    async def start(self, port: int = PORT) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, port=port).start()
+        logger.info("Webhook server listening on port %d", port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def run_webhook(application: Application, allowed_updates: list = None, port: int = PORT) -> None:
+    """Serves the bot through a webhook until SIGINT/SIGTERM, then drains in-flight updates."""
+    stop_signal = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_signal.set)
+
+    server = WebhookServer(application)
+    await application.initialize()
+    # run_polling would call these hooks itself
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}{server.path}",
+                secret_token=server.secret or None,
+                allowed_updates=allowed_updates,
+            )
+        await application.start()
+        await server.start(port)
+
+        await stop_signal.wait()
+
+        # Fail the health check and refuse new updates, then let the queued ones finish
+        logger.info("Draining updates before shutdown")
+        server.draining = True
+        try:
+            # Application.stop() handles everything left in the update queue and awaits its tasks
+            await asyncio.wait_for(asyncio.shield(application.stop()), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Updates still running after %.0fs, shutting down anyway", DRAIN_TIMEOUT)
+        await server.stop()
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()